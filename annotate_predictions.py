@@ -1,45 +1,180 @@
 import os
 import glob
+import itertools
 import sys
 import cv2
-import numpy as np
 
-import requests.exceptions
+from association import is_ball
+from inference_dispatcher import InferenceDispatcher
+from keyframe_tracking import KeyframeTracker
+from metrics import metrics
+from motion_gate import dead_time_prediction
+from render_annotations import draw_predictions, draw_speed, render_frames
+from speed_calculations import live_runs
 
 
-def annotate_images(model):
+def find_ball_position(prediction_json, track=0):
     """
-    Annotates images in a specified folder using a given model for object detection, applies a sharpening filter,
-    and extracts the positions of detected objects.
+    Extracts the position of the tennis ball from a prediction result.
 
-    This function processes each image in the 'extracted_images' folder, using the model to detect objects
-    in the images. It particularly focuses on detecting and recording the positions of a specific object
-    class, such as a tennis ball. After annotation, a sharpening filter is applied to enhance the visual
-    clarity of the annotations. Annotated images are saved in the 'annotated_images' folder.
+    Parameters:
+    prediction_json (dict): The prediction result in the JSON format returned by the model.
+    track (int, optional): The ball, when several were associated by `associate_predictions`. Defaults to 0.
+
+    Returns:
+    tuple or None: The (x, y) position of the first detected tennis ball, or `None` if no
+                   tennis ball was detected.
+    """
+    for prediction in prediction_json.get("predictions", []):
+        if is_ball(prediction, track):
+            return prediction["x"], prediction["y"]
+    return None
+
+
+class LocalPrediction:
+    """
+    A prediction result that is not backed by a call to the Roboflow API, e.g. one read from a cache.
 
-    The function also handles HTTP errors that may occur during API calls to the model for predictions.
+    It provides the same `json` and `save` methods as the predictions returned by the Roboflow
+    model, so it can be used wherever those are expected.
 
     Parameters:
-    model: A pre-trained model used for object detection. This model should have a `predict` method
-            that takes an image file path and optional confidence and overlap parameters, and a `save` method
-            to save the annotated image. It should also provide a `json` method to get the prediction results in JSON format.
+    prediction_json (dict): The prediction result in the JSON format returned by the model.
+    image (str or numpy.ndarray): The image the prediction was made on, as a file path or an RGB array.
+    """
+
+    def __init__(self, prediction_json, image):
+        self.prediction_json = prediction_json
+        self.image = image
+
+    def json(self):
+        return self.prediction_json
+
+    def save(self, output_path):
+        """
+        Draws the predictions onto the image and saves it to `output_path`.
+        """
+        if isinstance(self.image, str):
+            image = cv2.imread(self.image)
+        else:
+            image = cv2.cvtColor(self.image, cv2.COLOR_RGB2BGR)
+        cv2.imwrite(output_path, draw_predictions(image, self.prediction_json))
+
+
+def tracked_prediction_json(position, box_size=(10, 10)):
+    """
+    Builds a prediction result for a ball position obtained by tracking instead of detection.
+
+    Parameters:
+    position (tuple or None): The tracked (x, y) position of the ball, or `None` if it is not tracked.
+    box_size (tuple, optional): The (width, height) of the box drawn around the ball. Defaults to (10, 10).
 
     Returns:
-    list of tuples: A list of positions (x, y) of the detected object (tennis ball) in each image. If the object
-                    is not found in an image, `None` is appended to the list for that image.
+    dict: A prediction result in the JSON format returned by the model, with a `tracked` flag.
+    """
+    if position is None:
+        return {"predictions": []}
+    return {"predictions": [{"class": "tennis-ball", "x": position[0], "y": position[1],
+                             "width": box_size[0], "height": box_size[1], "tracked": True}]}
 
-    Notes:
-    - The function assumes the existence of 'extracted_images' directory with images to process.
-    - It creates an 'annotated_images' directory if it doesn't exist.
-    - Sharpening is done using a predefined kernel suitable for general purposes.
-    - HTTP errors during model API calls are caught and printed to the console.
+
+def predict_frames(model, dispatcher, images, confidence=40, overlap=30):
     """
-    image_folder = 'extracted_images'
-    annotated_images = "annotated_images"
-    ball_positions = []
-    if not os.path.exists(annotated_images):
-        os.makedirs(annotated_images)
+    Runs the model on a sequence of images through a dispatcher, in batches if the model supports them.
 
+    Parameters:
+    model: The detection model. If it has a `batch_size` above 1, its `predict_batch` method is called
+           with lists of that many images instead of calling `predict` on each one.
+    dispatcher (InferenceDispatcher): Runs the model calls concurrently, in order.
+    images (iterable): The images, as file paths or RGB arrays.
+    confidence (float, optional): The minimum confidence of a box, in percent. Defaults to 40.
+    overlap (float, optional): The maximum overlap between two boxes, in percent. Defaults to 30.
+
+    Yields:
+    dict: The prediction result of each image, in order, or `None` if its call failed.
+    """
+    batch_size = getattr(model, 'batch_size', 1)
+    if batch_size > 1:
+        def predict_batch(batch):
+            return [prediction.json() for prediction in model.predict_batch(batch, confidence=confidence,
+                                                                           overlap=overlap)]
+        return dispatcher.imap_batches(predict_batch, images, batch_size)
+
+    def predict(image):
+        return model.predict(image, confidence=confidence, overlap=overlap).json()
+    return dispatcher.imap(predict, images)
+
+
+def _track_predictions(img_files, model, predict, dispatcher, stride, max_uncertainty):
+    """
+    Yields the prediction result of each frame, running the detector on keyframes only.
+
+    Keyframes (every `stride`-th frame) are detected concurrently, and in batches if the model supports
+    them, through the dispatcher. The other
+    frames are filled by a `KeyframeTracker`, which may also request a detection when it loses the
+    ball, with a prediction result holding the tracked ball.
+    """
+    keyframe_results = predict_frames(model, dispatcher, img_files[::stride])
+    tracker = KeyframeTracker(stride, max_uncertainty)
+    box_size = (10, 10)
+    for index, img_file in enumerate(img_files):
+        detection = {}
+
+        def detect():
+            if index % stride == 0:
+                detection['json'] = next(keyframe_results)
+            else:
+                detection['json'] = dispatcher.call(predict, img_file)
+            if detection['json'] is None:
+                return None
+            return find_ball_position(detection['json'])
+
+        position, detected = tracker.step(index, cv2.imread(img_file), detect)
+        if detected:
+            for prediction in (detection['json'] or {}).get("predictions", []):
+                if is_ball(prediction):
+                    box_size = (prediction["width"], prediction["height"])
+                    break
+            yield detection['json']
+        else:
+            yield tracked_prediction_json(position, box_size)
+    print(f"\nDetector ran on {tracker.detections}/{len(img_files)} frames")
+
+
+def detect_images(model, max_in_flight=1, rate_limit=None, max_retries=3, detection_stride=1,
+                  max_uncertainty=None, image_folder='extracted_images', known_predictions=None, on_prediction=None,
+                  live_mask=None):
+    """
+    Runs the detection model on the images of a folder, without drawing anything.
+
+    Parameters:
+    model: A pre-trained model used for object detection. Its `predict` method takes an image file path and
+           optional confidence and overlap parameters, and returns a prediction with a `json` method.
+           Models with a `batch_size` above 1 are run in batches (see `predict_frames`).
+    max_in_flight (int, optional): The maximum number of concurrent API calls. Defaults to 1.
+    rate_limit (float, optional): The maximum number of API calls started per second. Defaults to None (no limit).
+    max_retries (int, optional): The number of retries, with exponential backoff, for a failed API call. Defaults to 3.
+    detection_stride (int, optional): Runs the model on every `detection_stride`-th frame only, the frames in
+                                      between being filled by a `KeyframeTracker`. Defaults to 1 (every frame).
+    max_uncertainty (float, optional): With a stride, the tracking uncertainty in pixels above which the model
+                                       runs before the next keyframe. Defaults to None.
+    image_folder (str, optional): The folder containing the images. Defaults to 'extracted_images'.
+    known_predictions (dict, optional): The prediction results already known, by image index, e.g. from an
+                                        interrupted run. These images are not sent to the model again. With a
+                                        stride, detection continues from the first image without a result.
+                                        Defaults to None.
+    on_prediction (callable, optional): Called with the index and the prediction result of each image as
+                                        soon as it is known, except for failed calls. Defaults to None.
+    live_mask (array-like of bool, optional): False for the images of dead time, e.g. labelled by
+                                              `motion_gate.gate_frames`, which are not sent to the model and get
+                                              an empty result flagged 'dead_time'. With a stride, each run of
+                                              live images is tracked on its own. Defaults to None (all images
+                                              are detected).
+
+    Returns:
+    tuple: The sorted paths of the images and the prediction result of each image, `None` for an image
+           whose API call failed after the retries. Returns `None` if the folder has no images.
+    """
     img_files = sorted(glob.glob(os.path.join(image_folder, '*')))
 
     # Return if no images are found
@@ -47,45 +182,92 @@ def annotate_images(model):
         print("No images found in the folder")
         return
 
-    total_images = len(img_files)
-    for index, img_file in enumerate(img_files):
-        # Handle HTTP errors during API calls
-        try:
-            processed_image_path = os.path.join(annotated_images, os.path.basename(img_file))
-            # Annotate the image and save it for each frame
-            prediction = model.predict(img_file, confidence=40, overlap=30)
-            prediction.save(processed_image_path)
-            prediction_json = prediction.json()
-            tennis_ball_found = False
-            for prediction in prediction_json.get("predictions", []):
-                if prediction["class"] == "tennis-ball":
-                    x = prediction["x"]
-                    y = prediction["y"]
-                    ball_positions.append((x, y))
-                    tennis_ball_found = True
-                    break
+    def predict(img_file):
+        return model.predict(img_file, confidence=40, overlap=30).json()
+
+    known_predictions = known_predictions or {}
+    prediction_jsons = [known_predictions.get(index) for index in range(len(img_files))]
+    runs = [(0, len(img_files))]
+    if live_mask is not None:
+        runs = live_runs(live_mask)
+        for index, live in enumerate(live_mask):
+            if not live:
+                prediction_jsons[index] = dead_time_prediction()
+    dispatcher = InferenceDispatcher(max_in_flight, rate_limit, max_retries)
+    if detection_stride > 1:
+        # The tracker needs consecutive frames, so it restarts from the first frame without a result
+        start = next((index for index, p in enumerate(prediction_jsons) if p is None), len(img_files))
+        runs = [(max(first, start), last) for first, last in runs if last > start]
+        indices = [index for first, last in runs for index in range(first, last)]
+        results = itertools.chain.from_iterable(
+            _track_predictions(img_files[first:last], model, predict, dispatcher, detection_stride, max_uncertainty)
+            for first, last in runs)
+    else:
+        indices = [index for index, p in enumerate(prediction_jsons) if p is None]
+        results = predict_frames(model, dispatcher, [img_files[index] for index in indices])
+    if known_predictions:
+        print(f"Resuming detection: {len(known_predictions)}/{len(img_files)} results already known")
+    total_images = len(indices)
+    for count, (prediction_json, index) in enumerate(zip(results, indices)):
+        prediction_jsons[index] = prediction_json
+        if prediction_json is not None and on_prediction is not None:
+            on_prediction(index, prediction_json)
+        metrics.count('frames_detected')
+        print(f"\rDetecting: {count + 1}/{total_images} ({(count + 1) / total_images * 100:.2f}%)", end='')
+        sys.stdout.flush()
+    print("\nDetection complete.")
+    return img_files, prediction_jsons
 
-            if not tennis_ball_found:
-                ball_positions.append(None)
 
-            image = cv2.imread(processed_image_path)
+def annotate_images(model, max_in_flight=1, rate_limit=None, max_retries=3, detection_stride=1, max_uncertainty=None,
+                    image_folder='extracted_images', annotated_folder='annotated_images'):
+    """
+    Annotates images in a specified folder using a given model for object detection, applies a sharpening filter,
+    and extracts the positions of detected objects.
 
-            # Sharpen the annotated image
-            sharpening_kernel = np.array([[-1, -1, -1],
-                                          [-1, 9, -1],
-                                          [-1, -1, -1]])
-            sharpened_image = cv2.filter2D(image, -1, sharpening_kernel)
-            cv2.imwrite(processed_image_path, sharpened_image)
-            print(f"\rAnnotating images: {index + 1}/{total_images} ({(index + 1) / total_images * 100:.2f}%)", end='')
-            sys.stdout.flush()
-        except requests.exceptions.HTTPError as e:
-            print("\nError with API call", e)
-            continue
-    print("\nAnnotation complete.")
-    return ball_positions
+    This function processes each image in the 'extracted_images' folder, using the model to detect objects
+    in the images (see `detect_images`). It particularly focuses on detecting and recording the positions of
+    a specific object class, such as a tennis ball. The detections are then drawn and the image sharpened in
+    a single pass by `render_frames`, and the annotated images are saved in the 'annotated_images' folder.
 
+    Parameters:
+    model: A pre-trained model used for object detection. This model should have a `predict` method
+            that takes an image file path and optional confidence and overlap parameters, and return a
+            prediction with a `json` method to get the prediction results in JSON format.
+    max_in_flight (int, optional): The maximum number of concurrent API calls. Defaults to 1.
+    rate_limit (float, optional): The maximum number of API calls started per second. Defaults to None (no limit).
+    max_retries (int, optional): The number of retries, with exponential backoff, for a failed API call. Defaults to 3.
+    detection_stride (int, optional): Runs the model on every `detection_stride`-th frame only, the frames in
+                                      between being filled by a `KeyframeTracker`. Defaults to 1 (every frame).
+    max_uncertainty (float, optional): With a stride, the tracking uncertainty in pixels above which the model
+                                       runs before the next keyframe. Defaults to None.
+    image_folder (str, optional): The folder containing the images. Defaults to 'extracted_images'.
+    annotated_folder (str, optional): The folder the annotated images are saved in. Defaults to 'annotated_images'.
 
-def annotate_frames_with_speed(speeds):
+    Returns:
+    list of tuples: A list of positions (x, y) of the detected object (tennis ball) in each image. If the object
+                    is not found in an image, `None` is appended to the list for that image.
+
+    Notes:
+    - The function assumes the existence of the image folder with images to process.
+    - It creates the annotated folder if it doesn't exist.
+    - Sharpening is done using a predefined kernel suitable for general purposes.
+    - API calls are made through an `InferenceDispatcher`, which returns the results in frame order.
+      HTTP errors that persist after the retries are printed to the console, and the frame is kept
+      unannotated with a `None` position so that later positions stay aligned with their frames.
+    - To draw the speeds as well, `detect_images` and `render_frames` can be called directly, which
+      writes each annotated image once.
+    """
+    detections = detect_images(model, max_in_flight, rate_limit, max_retries, detection_stride, max_uncertainty,
+                               image_folder)
+    if detections is None:
+        return
+    img_files, prediction_jsons = detections
+    render_frames(img_files, prediction_jsons, output_folder=annotated_folder)
+    return [find_ball_position(p) if p is not None else None for p in prediction_jsons]
+
+
+def annotate_frames_with_speed(speeds, image_folder='annotated_images'):
     """
     Annotates a sequence of images with corresponding speed values.
 
@@ -95,6 +277,7 @@ def annotate_frames_with_speed(speeds):
 
     Parameters:
     speeds (list of float): A list of speed values, where each speed corresponds to a frame.
+    image_folder (str, optional): The folder containing the images. Defaults to 'annotated_images'.
 
     The function expects the images to be named in a sorted manner so that their
     alphabetical/numerical order corresponds to the chronological order of the frames.
@@ -103,13 +286,8 @@ def annotate_frames_with_speed(speeds):
     Note:
     - The function assumes that the number of speed values matches the number of images.
     - Images are saved with the same filenames in the same folder, overwriting the original ones.
+    - `render_frames` draws the speeds along with the detections, without this second pass.
     """
-    image_folder = "annotated_images"
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 1
-    font_color = (0, 0, 255)  # Red color
-    line_type = 2
-
     img_files = sorted(glob.glob(os.path.join(image_folder, '*')))
 
     # Return if no images are found
@@ -122,9 +300,8 @@ def annotate_frames_with_speed(speeds):
         processed_image_path = os.path.join(image_folder, os.path.basename(img_file))
         frame = cv2.imread(img_file)
         if index < len(speeds):
-            speed_text = f"Speed: {speeds[index]:.2f} px/s"
             # Annotating the Speed of the ball to the frame
-            cv2.putText(frame, speed_text, (10, 30), font, font_scale, font_color, line_type)
+            draw_speed(frame, speeds[index])
         cv2.imwrite(processed_image_path, frame)
         print(f"\rAnnotating images with speed: {index + 1}/{total_images} ({(index + 1) / total_images * 100:.2f}%)", end='')
         sys.stdout.flush()
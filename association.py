@@ -0,0 +1,256 @@
+import numpy as np
+
+# The number of frames whose transition costs are computed at once, each taking `(K + 1) ** 2` floats
+TRANSITION_BLOCK = 1024
+# The number of frames whose backpointers are composed together when backtracking
+BACKTRACK_BLOCK = 16
+
+
+def is_ball(prediction, track=0):
+    """
+    Tells whether a detection is the tennis ball of the given track. The tennis balls left out by
+    `associate_predictions`, or associated with another track, are not.
+    """
+    return (prediction["class"] == "tennis-ball" and prediction.get("associated", True)
+            and prediction.get("track", track) == track)
+
+
+def candidate_arrays(prediction_jsons, class_name='tennis-ball', max_candidates=None):
+    """
+    Gathers the ball candidates of every frame into padded arrays.
+
+    Parameters:
+    prediction_jsons (list of dicts): The prediction result of each frame, `None` for a failed API call.
+    class_name (str, optional): The class of the candidates. Defaults to 'tennis-ball'.
+    max_candidates (int, optional): The largest number of candidates kept in a frame, the most confident
+                                    ones. Defaults to None (all of them).
+
+    Returns:
+    tuple: The (F, K) index of each candidate in its frame's "predictions" list, the (F, K, 2) positions,
+           the (F, K) confidences and the (F, K) mask of the slots holding a candidate, K being the largest
+           number of candidates in a frame. Empty slots have an index of -1 and NaN positions.
+    """
+    entries = [(frame, index, prediction["x"], prediction["y"], prediction.get("confidence", 1.0))
+               for frame, prediction_json in enumerate(prediction_jsons)
+               for index, prediction in enumerate((prediction_json or {}).get("predictions", []))
+               if prediction["class"] == class_name]
+    frame_count = len(prediction_jsons)
+    if not entries:
+        return (np.full((frame_count, 0), -1), np.full((frame_count, 0, 2), np.nan), np.zeros((frame_count, 0)),
+                np.zeros((frame_count, 0), dtype=bool))
+    frames, indices, xs, ys, confidences = (np.array(column) for column in zip(*entries))
+    # The slot of each candidate is its rank by confidence among the candidates of its frame
+    order = np.lexsort((-confidences, frames))
+    frames, indices, xs, ys, confidences = (column[order] for column in (frames, indices, xs, ys, confidences))
+    first_entry = np.searchsorted(frames, frames, side='left')
+    slots = np.arange(len(frames)) - first_entry
+    if max_candidates is not None:
+        kept = slots < max_candidates
+        frames, indices, xs, ys, confidences, slots = (column[kept] for column in
+                                                       (frames, indices, xs, ys, confidences, slots))
+    slot_count = slots.max() + 1
+    candidate_indices = np.full((frame_count, slot_count), -1)
+    positions = np.full((frame_count, slot_count, 2), np.nan)
+    candidate_confidences = np.zeros((frame_count, slot_count))
+    candidate_indices[frames, slots] = indices
+    positions[frames, slots] = np.column_stack([xs, ys])
+    candidate_confidences[frames, slots] = confidences
+    return candidate_indices, positions, candidate_confidences, candidate_indices >= 0
+
+
+def state_costs(confidences, valid, miss_cost=1.0, confidence_weight=1.0):
+    """
+    Computes the cost of each state of each frame, K candidates and a miss state.
+
+    Parameters:
+    confidences (numpy.ndarray): The (F, K) confidences of the candidates, from 0 to 1.
+    valid (numpy.ndarray): The (F, K) mask of the candidates that can be chosen.
+    miss_cost (float, optional): The cost of a frame where the ball is not chosen. Defaults to 1.
+    confidence_weight (float, optional): The cost of choosing a candidate of confidence 0, decreasing
+                                         linearly to 0 at confidence 1. Defaults to 1.
+
+    Returns:
+    numpy.ndarray: The (F, K + 1) costs, the last state being the miss and the empty slots costing infinity.
+    """
+    frame_count, slot_count = valid.shape
+    costs = np.empty((frame_count, slot_count + 1))
+    costs[:, :slot_count] = np.where(valid, confidence_weight * (1 - confidences), np.inf)
+    costs[:, slot_count] = miss_cost
+    return costs
+
+
+def transition_costs(previous_positions, positions, max_step=60.0, switch_cost=1.0):
+    """
+    Computes the cost of going from each state of a frame to each state of the next one.
+
+    Parameters:
+    previous_positions, positions (numpy.ndarray): The (N, K, 2) positions of the candidates of N frames
+                                                   and of the frames following them.
+    max_step (float, optional): The distance in pixels between two frames that costs as much as a miss.
+                                Defaults to 60.
+    switch_cost (float, optional): The cost of losing or finding the ball between two frames. Defaults to 1.
+
+    Returns:
+    numpy.ndarray: The (N, K + 1, K + 1) costs. Moving between two candidates costs the square of their
+                   distance over `max_step`, and going to or from the miss state costs `switch_cost`.
+    """
+    count, slot_count = positions.shape[:2]
+    steps = (positions[:, None, :, :] - previous_positions[:, :, None, :]) / max_step
+    costs = np.empty((count, slot_count + 1, slot_count + 1))
+    costs[:, :slot_count, :slot_count] = np.nan_to_num(np.einsum('nijk,nijk->nij', steps, steps), nan=np.inf)
+    costs[:, :slot_count, slot_count] = switch_cost
+    costs[:, slot_count, :slot_count] = switch_cost
+    costs[:, slot_count, slot_count] = 0
+    return costs
+
+
+def backtrack(pointers, final_state):
+    """
+    Follows the pointers of the Viterbi algorithm back from the final state, a block of frames at a time.
+
+    Within each block of `BACKTRACK_BLOCK` frames, the maps from the state of a frame to the state of the
+    frame before it are composed by pointer doubling, so that each frame gets a map from the state that
+    follows its block. The blocks are then resolved from the last one, with one Python step per block
+    instead of one per frame.
+
+    Parameters:
+    pointers (numpy.ndarray): The (F - 1, S) best state of each frame for each state of the next one.
+    final_state (int): The state of the last frame.
+
+    Returns:
+    numpy.ndarray: The (F,) state of each frame.
+    """
+    count, state_count = pointers.shape
+    block_count = -(-count // BACKTRACK_BLOCK)
+    # The frames past the end map each state to itself, so that the last block leads from the final state
+    maps = np.empty((block_count * BACKTRACK_BLOCK, state_count), dtype=pointers.dtype)
+    maps[:count] = pointers
+    maps[count:] = np.arange(state_count)
+    maps = maps.reshape(block_count, BACKTRACK_BLOCK, state_count)
+    span = 1
+    while span < BACKTRACK_BLOCK:
+        # The map of each frame now leads from `2 * span` frames further on, or from the end of its block
+        maps[:, :-span] = np.take_along_axis(maps[:, :-span], maps[:, span:], axis=2)
+        span *= 2
+    states = np.empty((block_count, BACKTRACK_BLOCK), dtype=np.int64)
+    state = final_state
+    for block in range(block_count - 1, -1, -1):
+        states[block] = maps[block, :, state]
+        state = states[block, 0]
+    return np.append(states.ravel()[:count], final_state)
+
+
+def best_sequence(positions, confidences, valid, max_step=60.0, miss_cost=1.0, switch_cost=1.0,
+                  confidence_weight=1.0):
+    """
+    Finds the state sequence of least cost with the Viterbi algorithm.
+
+    The forward pass keeps the cost of the best sequence ending in each state and a pointer to its previous
+    state. Each frame depends on the costs of the one before it, so the frames are a Python loop, each taking
+    one vectorized step over the (K + 1, K + 1) transitions: O(F * K ** 2) work in F small steps. The
+    sequence is then recovered by following the pointers back from the best final state (see `backtrack`),
+    so that it is always one of the optimal sequences, even when several of them tie.
+
+    Parameters:
+    positions, confidences, valid (numpy.ndarray): The candidates, see `candidate_arrays`.
+    max_step, switch_cost: See `transition_costs`.
+    miss_cost, confidence_weight: See `state_costs`.
+
+    Returns:
+    numpy.ndarray: The (F,) state of each frame, K being the miss state.
+    """
+    frame_count, slot_count = valid.shape
+    costs = state_costs(confidences, valid, miss_cost, confidence_weight)
+    pointers = np.empty((max(frame_count - 1, 0), slot_count + 1), dtype=np.int32)
+    states = np.arange(slot_count + 1)
+    total = costs[0]
+    for start in range(1, frame_count, TRANSITION_BLOCK):
+        # The transitions are computed for a block of frames at once, bounding their memory
+        end = min(start + TRANSITION_BLOCK, frame_count)
+        transitions = transition_costs(positions[start - 1:end - 1], positions[start:end], max_step, switch_cost)
+        for frame in range(start, end):
+            step = transitions[frame - start] + total[:, None]
+            pointers[frame - 1] = np.argmin(step, axis=0)
+            total = step[pointers[frame - 1], states] + costs[frame]
+    return backtrack(pointers, np.argmin(total))
+
+
+def associate_tracks(positions, confidences, valid, max_tracks=1, min_detections=3, **options):
+    """
+    Finds the trajectories of one or several balls among the candidates of every frame.
+
+    The best trajectory is found first, as the state sequence of least cost (see `best_sequence`).
+    Its candidates are then removed and the next trajectory is searched among the remaining ones.
+
+    Parameters:
+    positions, confidences, valid (numpy.ndarray): The candidates, see `candidate_arrays`.
+    max_tracks (int, optional): The largest number of balls tracked. Defaults to 1.
+    min_detections (int, optional): The fewest candidates a trajectory must use to be kept, further
+                                    trajectories not being searched. Defaults to 3.
+    **options: Passed on to `best_sequence`, e.g. `max_step`.
+
+    Returns:
+    list of numpy.ndarray: For each trajectory, the (F,) slot of the chosen candidate in each frame, or -1
+                           where the ball is not chosen.
+    """
+    valid = valid.copy()
+    slot_count = valid.shape[1]
+    frames = np.arange(len(valid))
+    tracks = []
+    for _ in range(max_tracks):
+        if not valid.any():
+            break
+        states = best_sequence(positions, confidences, valid, **options)
+        chosen = states < slot_count
+        if chosen.sum() < min_detections:
+            break
+        tracks.append(np.where(chosen, states, -1))
+        valid[frames[chosen], states[chosen]] = False
+    return tracks
+
+
+def associate_predictions(prediction_jsons, max_balls=1, class_name='tennis-ball', max_candidates=16, **options):
+    """
+    Chooses the ball among the candidates of each frame by associating them into trajectories, instead of
+    keeping the first one.
+
+    Parameters:
+    prediction_jsons (list of dicts): The prediction result of each frame, `None` for a failed API call.
+    max_balls (int, optional): The largest number of balls tracked at once. Defaults to 1.
+    class_name (str, optional): The class of the ball. Defaults to 'tennis-ball'.
+    max_candidates (int, optional): The largest number of candidates considered in a frame, the most
+                                    confident ones, bounding the cost of each frame. Defaults to 16.
+    **options: Passed on to `associate_tracks` and `best_sequence`, e.g. `max_step` or `miss_cost`.
+
+    Returns:
+    list of dicts: The prediction results, with the candidates of the ball first and flagged with their
+                   'track' number (0 for the main ball), and the other candidates flagged as not
+                   'associated', which `find_ball_position` skips. `None` results are kept.
+    """
+    candidate_indices, positions, confidences, valid = candidate_arrays(prediction_jsons, class_name,
+                                                                        max_candidates)
+    tracks = associate_tracks(positions, confidences, valid, max_balls, **options)
+    # The track of each chosen candidate, by frame and index in the frame's "predictions" list
+    chosen = [{} for _ in prediction_jsons]
+    for track, slots in enumerate(tracks):
+        for frame in np.flatnonzero(slots >= 0):
+            chosen[frame][int(candidate_indices[frame, slots[frame]])] = track
+
+    associated_jsons = []
+    for prediction_json, tracks_of_frame in zip(prediction_jsons, chosen):
+        if prediction_json is None:
+            associated_jsons.append(prediction_json)
+            continue
+        balls = []
+        rest = []
+        for index, prediction in enumerate(prediction_json.get("predictions", [])):
+            if index in tracks_of_frame:
+                balls.append(dict(prediction, track=tracks_of_frame[index]))
+            elif prediction["class"] == class_name:
+                rest.append(dict(prediction, associated=False))
+            else:
+                rest.append(prediction)
+        # The balls come first, in track order, so that the main ball is found first
+        balls.sort(key=lambda prediction: prediction["track"])
+        associated_jsons.append(dict(prediction_json, predictions=balls + rest))
+    return associated_jsons
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from detectors import create_detector
+from main import process_file
+from stage_limits import StageLimiter
+
+SUPPORTED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.mp4', '.mov')
+
+
+def find_jobs(source):
+    """
+    Lists the files of a batch.
+
+    Parameters:
+    source (str): A directory, whose images and videos are processed, or a manifest: a text file listing
+                  one file path per line. Empty lines and lines starting with '#' are ignored, and
+                  relative paths are relative to the manifest's directory.
+
+    Returns:
+    list of str: The paths of the files to process.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(SUPPORTED_EXTENSIONS))
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+
+
+def job_name(file_path):
+    """
+    Returns a name identifying the job of a file, made of the file name and a hash of its absolute path,
+    so that files with the same name in different directories get different workspaces and outputs.
+    """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    digest = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:8]
+    return f"{stem}-{digest}"
+
+
+def run_batch(source, roboflow_api_key, workers=4, output_dir='outputs', workdir='batch_workspaces',
+              stage_limits=None, **options):
+    """
+    Processes a batch of images and videos concurrently, each one in its own workspace.
+
+    Parameters:
+    source (str): A directory or a manifest of files, see `find_jobs`.
+    roboflow_api_key (str): The API key for accessing the Roboflow service.
+    workers (int, optional): The number of files processed at the same time. Defaults to 4.
+    output_dir (str, optional): The directory of the annotated files, named '<job name>_annotated<ext>'.
+                                Defaults to 'outputs'.
+    workdir (str, optional): The directory in which each job gets a scratch workspace, removed once the job
+                             succeeds. Defaults to 'batch_workspaces'.
+    stage_limits (dict, optional): The maximum number of jobs running each stage at once, e.g.
+                                   {'decode': 2, 'inference': 8, 'render': 2}. Defaults to None (no limits
+                                   besides `workers`).
+    **options: Passed on to `process_file`, e.g. `streaming` or `detection_stride`.
+
+    Returns:
+    list of dicts: For each file, in order, its path, the path of its output, whether it 'succeeded' or
+                   'failed', the error message of a failure and the processing time in seconds.
+
+    Note:
+    - The detector is created once and shared by all the jobs.
+    - A failed job does not stop the batch. Its workspace is left in place, and as workspaces are named
+      after their file, running the batch again resumes the job from its checkpoint.
+    """
+    jobs = find_jobs(source)
+    limiter = StageLimiter(stage_limits)
+    detector = create_detector(options.pop('backend', 'roboflow'), roboflow_api_key, options.pop('onnx_model', None),
+                               options.pop('batch_size', 8), options.pop('threads', None), options.pop('encoder', None))
+
+    def run(file_path):
+        name = job_name(file_path)
+        extension = os.path.splitext(file_path)[1]
+        output_path = os.path.join(output_dir, f"{name}_annotated{extension}")
+        start = time.perf_counter()
+        result = {'path': file_path, 'output': output_path, 'status': 'succeeded', 'error': None}
+        try:
+            process_file(file_path, roboflow_api_key, workspace=os.path.join(workdir, name), output_path=output_path,
+                         limiter=limiter, detector=detector, **options)
+        except Exception as e:
+            print(f"\nError processing {file_path}: {e!r}")
+            result.update(status='failed', error=repr(e))
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    print(f"Processing {len(jobs)} files with {workers} workers...")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(run, jobs))
+    try:
+        # Removing the work directory if every workspace was cleaned up
+        os.rmdir(workdir)
+    except OSError:
+        pass
+    failed = [result['path'] for result in results if result['status'] == 'failed']
+    print(f"\nBatch complete: {len(results) - len(failed)} succeeded, {len(failed)} failed")
+    for path in failed:
+        print("  failed:", path)
+    return results
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+
+from annotate_predictions import LocalPrediction, detect_images, find_ball_position
+from create_video import create_video
+from extract_frames import extract_frames
+from render_annotations import render_frames
+from roi_detection import RoiModel
+from speed_calculations import calculate_windowed_speed, positions_to_array, windowed_speed_array
+
+"""
+Benchmarks for the performance-sensitive parts of the ball tracking pipeline.
+
+Usage:
+    python3 benchmark.py speed [--frames N] [--batch B] [--reference-frames N]
+    python3 benchmark.py roi [--frames N] [--width W] [--height H] [--latency S] [--bandwidth BYTES_PER_S]
+    python3 benchmark.py pipeline [--resolutions WxH,...] [--frames N,...] [--latency S] [--miss-rate P]
+
+Each benchmark prints its results as JSON. With `--output FILE` they are also saved, and with
+`--baseline FILE` they are compared with saved results: the script exits with status 1 if a time,
+memory or disk measurement grew by more than `--tolerance`.
+
+Everything runs offline, on synthetic clips and a fake detector.
+"""
+
+
+def synthetic_trajectory(num_frames, miss_rate=0.2, seed=0):
+    """
+    Generates a bouncing ball trajectory with missed detections.
+
+    Parameters:
+    num_frames (int): The number of frames.
+    miss_rate (float, optional): The fraction of frames without a detection. Misses come in runs of
+                                 1 to 15 frames. Defaults to 0.2.
+    seed (int, optional): The seed of the random generator. Defaults to 0.
+
+    Returns:
+    list of tuples: The positions (x, y) of the ball, `None` where it was not detected.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_frames)
+    x = 960 + 800 * np.sin(t / 45.0) + rng.normal(0, 2, num_frames)
+    y = 540 - 400 * np.abs(np.sin(t / 20.0)) + rng.normal(0, 2, num_frames)
+    missing = np.zeros(num_frames, dtype=bool)
+    run_starts = np.nonzero(rng.random(num_frames) < miss_rate / 8)[0]
+    for start, length in zip(run_starts, rng.integers(1, 16, run_starts.size)):
+        missing[start:start + length] = True
+    return [None if m else (float(px), float(py)) for m, px, py in zip(missing, x, y)]
+
+
+def synthetic_ball_position(index, width, height):
+    """
+    Returns the position of the ball in frame `index` of a synthetic clip, as a rally across the court.
+    """
+    x = width * (0.5 + 0.4 * math.sin(index / 25.0))
+    y = height * (0.55 - 0.3 * abs(math.sin(index / 12.0)))
+    return x, y
+
+
+def synthetic_frame(index, width=1280, height=720):
+    """
+    Draws a frame of a synthetic clip: a tennis court with a ball moving across it.
+
+    Parameters:
+    index (int): The index of the frame.
+    width (int, optional): The width of the frame. Defaults to 1280.
+    height (int, optional): The height of the frame. Defaults to 720.
+
+    Returns:
+    numpy.ndarray: The BGR frame.
+    """
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:] = (60, 130, 70)
+    line = max(1, width // 400)
+    cv2.rectangle(frame, (width // 10, height // 8), (width * 9 // 10, height * 7 // 8), (255, 255, 255), line)
+    cv2.line(frame, (width // 2, height // 8), (width // 2, height * 7 // 8), (255, 255, 255), line)
+    cv2.line(frame, (width // 10, height // 2), (width * 9 // 10, height // 2), (200, 200, 200), line * 2)
+    x, y = synthetic_ball_position(index, width, height)
+    cv2.circle(frame, (int(x), int(y)), max(3, width // 200), (40, 230, 230), -1)
+    return frame
+
+
+class FakeDetector:
+    """
+    An offline stand-in for the Roboflow model, finding the synthetic ball by its color.
+
+    Parameters:
+    latency (float, optional): The round-trip time added to every call, in seconds. Defaults to 0.
+    bandwidth (float, optional): The upload bandwidth in bytes/second. Each image is JPEG-encoded as
+                                 the client would upload it, and the transfer time is added to the
+                                 latency. Defaults to None (instant upload).
+    miss_rate (float, optional): The probability of not reporting the ball. Defaults to 0.
+    seed (int, optional): The seed of the random generator for the misses. Defaults to 0.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, miss_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.miss_rate = miss_rate
+        self.calls = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def predict(self, image, confidence=40, overlap=30):
+        if isinstance(image, str):
+            frame = cv2.imread(image)
+        else:
+            frame = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        payload = cv2.imencode('.jpg', frame)[1]
+        with self._lock:
+            self.calls += 1
+            self.bytes_sent += payload.size
+            missed = self._random.random() < self.miss_rate
+        delay = self.latency + (payload.size / self.bandwidth if self.bandwidth else 0.0)
+        if delay:
+            time.sleep(delay)
+
+        predictions = []
+        mask = cv2.inRange(cv2.cvtColor(frame, cv2.COLOR_BGR2HSV), (20, 120, 120), (40, 255, 255))
+        ys, xs = np.nonzero(mask)
+        if xs.size and not missed:
+            predictions.append({"class": "tennis-ball", "confidence": 0.9,
+                                "x": float(xs.mean()), "y": float(ys.mean()),
+                                "width": float(xs.max() - xs.min() + 1), "height": float(ys.max() - ys.min() + 1)})
+        return LocalPrediction({"predictions": predictions}, image)
+
+
+def write_synthetic_clip(path, num_frames=300, width=1280, height=720, fps=30):
+    """
+    Writes a synthetic clip of a ball moving across a court, made of `synthetic_frame`s.
+
+    Parameters:
+    path (str): The path of the .mp4 file to write.
+    num_frames (int, optional): The number of frames. Defaults to 300.
+    width (int, optional): The width of the frames. Defaults to 1280.
+    height (int, optional): The height of the frames. Defaults to 720.
+    fps (float, optional): The frame rate. Defaults to 30.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for index in range(num_frames):
+        writer.write(synthetic_frame(index, width, height))
+    writer.release()
+
+
+def _current_rss():
+    # The resident memory of this process in bytes, from /proc on Linux or the peak reported by getrusage
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PeakMemory:
+    """
+    Samples the resident memory of the process in a background thread, as a context manager.
+
+    Attributes:
+    peak (int): The highest resident memory seen, in bytes.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+
+
+def directory_size(path):
+    """
+    Returns the total size in bytes of the files under `path`.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def benchmark_pipeline(resolutions=((640, 360), (1280, 720)), lengths=(150,), latency=0.0, miss_rate=0.1,
+                       max_in_flight=4, preprocess_workers=1, window_size=10):
+    """
+    Measures each stage of the file-based video pipeline on synthetic clips.
+
+    The stages are those of `process_file`: extracting the filtered frames, detecting the ball with a
+    `FakeDetector`, calculating the speeds, rendering the annotated frames and encoding the video.
+    Each clip is processed in its own temporary directory, removed afterwards.
+
+    Parameters:
+    resolutions (iterable of tuples, optional): The (width, height) of the clips. Defaults to 640x360 and 1280x720.
+    lengths (iterable of int, optional): The number of frames of the clips. Defaults to (150,).
+    latency (float, optional): The simulated round-trip time of a detector call, in seconds. Defaults to 0.
+    miss_rate (float, optional): The probability that the detector misses the ball. Defaults to 0.1.
+    max_in_flight (int, optional): The number of concurrent detector calls. Defaults to 4.
+    preprocess_workers (int, optional): The number of processes filtering the frames. Defaults to 1.
+    window_size (int, optional): The smoothing window of the speeds. Defaults to 10.
+
+    Returns:
+    dict: For each clip, named '<width>x<height>x<frames>', the wall time, frames/second, peak resident
+          memory and scratch disk usage after each stage, and the total wall time.
+    """
+    results = {}
+    for width, height in resolutions:
+        for num_frames in lengths:
+            workspace = tempfile.mkdtemp(prefix='benchmark_')
+            try:
+                video_path = os.path.join(workspace, 'clip.mp4')
+                write_synthetic_clip(video_path, num_frames, width, height)
+                extracted_images = os.path.join(workspace, 'extracted_images')
+                annotated_images = os.path.join(workspace, 'annotated_images')
+                state = {}
+
+                def extract():
+                    state['fps'] = extract_frames(video_path, preprocess_workers, output_folder=extracted_images)
+
+                def detect():
+                    detector = FakeDetector(latency, miss_rate=miss_rate)
+                    state['files'], state['jsons'] = detect_images(detector, max_in_flight,
+                                                                   image_folder=extracted_images)
+
+                def speed():
+                    state['positions'] = [find_ball_position(p) if p is not None else None for p in state['jsons']]
+                    state['speeds'] = calculate_windowed_speed(state['positions'], state['fps'], window_size)
+
+                def render():
+                    render_frames(state['files'], state['jsons'], state['speeds'], state['positions'],
+                                  output_folder=annotated_images)
+
+                def encode():
+                    create_video('.mp4', state['fps'], annotated_images, os.path.join(workspace, 'output.mp4'))
+
+                stages = {}
+                for name, stage in (('extract', extract), ('detect', detect), ('speed', speed),
+                                    ('render', render), ('encode', encode)):
+                    # The progress messages of the stages go to stderr, to keep stdout for the results
+                    with PeakMemory() as memory, contextlib.redirect_stdout(sys.stderr):
+                        start = time.perf_counter()
+                        stage()
+                        wall_time = time.perf_counter() - start
+                    stages[name] = {
+                        'wall_time_s': wall_time,
+                        'frames_per_s': num_frames / wall_time if wall_time else None,
+                        'peak_rss_mb': memory.peak / 2 ** 20,
+                        'scratch_bytes': directory_size(workspace),
+                    }
+            finally:
+                shutil.rmtree(workspace, ignore_errors=True)
+            results[f'{width}x{height}x{num_frames}'] = {
+                'stages': stages,
+                'total_wall_time_s': sum(stage['wall_time_s'] for stage in stages.values()),
+            }
+    return results
+
+
+# Measurements compared with a baseline, all of which are better when lower, with the smallest absolute
+# increase reported, so that the timing noise of very short stages is not taken for a regression
+REGRESSION_METRICS = {'wall_time_s': 0.01, 'total_wall_time_s': 0.01, 'peak_rss_mb': 1.0,
+                      'scratch_bytes': 4096, 'bytes_sent': 1024}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, path=''):
+    """
+    Finds the measurements that regressed compared with a baseline.
+
+    Parameters:
+    results (dict): The results of a benchmark.
+    baseline (dict): Earlier results of the same benchmark.
+    tolerance (float, optional): The relative increase above which a measurement is a regression.
+                                 Defaults to 0.2 (20%).
+
+    Returns:
+    list of dicts: The path, baseline value, new value and relative change of each regression. Only the
+                   measurements in `REGRESSION_METRICS` present in both results are compared, and increases
+                   below their minimum absolute change are ignored.
+    """
+    regressions = []
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        name = f'{path}.{key}' if path else key
+        if isinstance(value, dict) and isinstance(baseline[key], dict):
+            regressions += compare_to_baseline(value, baseline[key], tolerance, name)
+        elif key in REGRESSION_METRICS and isinstance(value, (int, float)) and baseline[key]:
+            change = value / baseline[key] - 1
+            if change > tolerance and value - baseline[key] > REGRESSION_METRICS[key]:
+                regressions.append({'metric': name, 'baseline': baseline[key], 'value': value, 'change': change})
+    return regressions
+
+
+def _reference_windowed_speed(ball_positions, fps, window_size):
+    """
+    The loop-based implementation `calculate_windowed_speed` had before being vectorized, kept as the
+    baseline of the speed benchmark.
+    """
+    for i in range(1, len(ball_positions)):
+        if ball_positions[i] is None and ball_positions[i - 1] is not None:
+            for j in range(i + 1, len(ball_positions)):
+                if ball_positions[j] is not None:
+                    for k in range(i, j):
+                        delta_x = (ball_positions[j][0] - ball_positions[i - 1][0]) / (j - i + 2)
+                        delta_y = (ball_positions[j][1] - ball_positions[i - 1][1]) / (j - i + 2)
+                        ball_positions[k] = (ball_positions[i - 1][0] + delta_x * (k - i + 1),
+                                             ball_positions[i - 1][1] + delta_y * (k - i + 1))
+                    break
+    smoothed_positions = []
+    for i in range(len(ball_positions)):
+        start = max(0, i - window_size // 2)
+        end = min(len(ball_positions), i + window_size // 2 + 1)
+        window_positions = [p for p in ball_positions[start:end] if p is not None]
+        if window_positions:
+            smoothed_positions.append((np.mean([p[0] for p in window_positions]),
+                                       np.mean([p[1] for p in window_positions])))
+        else:
+            smoothed_positions.append(None)
+    speeds = [0] * len(ball_positions)
+    for i in range(len(smoothed_positions) - 1):
+        if smoothed_positions[i] and smoothed_positions[i + 1]:
+            p, q = smoothed_positions[i], smoothed_positions[i + 1]
+            speeds[i] = math.sqrt((q[0] - p[0]) ** 2 + (q[1] - p[1]) ** 2) / (1 / fps)
+    return speeds
+
+
+def benchmark_speed(num_frames=1_000_000, batch=8, reference_frames=100_000, fps=30, window_size=10):
+    """
+    Compares the vectorized speed engine with the loop-based implementation.
+
+    Parameters:
+    num_frames (int, optional): The length of each trajectory given to the vectorized engine. Defaults to 1,000,000.
+    batch (int, optional): The number of trajectories processed in one call. Defaults to 8.
+    reference_frames (int, optional): The length of the trajectory given to the loop-based implementation,
+                                      which is too slow for the full length. Defaults to 100,000.
+    fps (float, optional): The frame rate. Defaults to 30.
+    window_size (int, optional): The smoothing window. Defaults to 10.
+
+    Returns:
+    dict: The throughput of both implementations in frames/second, the speedup, and the largest
+          difference between their speeds.
+    """
+    reference_positions = synthetic_trajectory(reference_frames)
+    start = time.perf_counter()
+    reference_speeds = _reference_windowed_speed(list(reference_positions), fps, window_size)
+    reference_time = time.perf_counter() - start
+
+    speeds, _ = windowed_speed_array(positions_to_array(reference_positions), fps, window_size)
+    max_difference = float(np.max(np.abs(speeds - np.array(reference_speeds))))
+
+    trajectories = np.stack([positions_to_array(synthetic_trajectory(num_frames, seed=seed)) for seed in range(batch)])
+    start = time.perf_counter()
+    windowed_speed_array(trajectories, fps, window_size)
+    vectorized_time = time.perf_counter() - start
+
+    reference_rate = reference_frames / reference_time
+    vectorized_rate = batch * num_frames / vectorized_time
+    return {
+        'reference_frames_per_s': reference_rate,
+        'vectorized_frames_per_s': vectorized_rate,
+        'speedup': vectorized_rate / reference_rate,
+        'max_speed_difference': max_difference,
+    }
+
+
+def benchmark_roi(num_frames=150, width=1920, height=1080, latency=0.03, bandwidth=2e6, crop_size=320):
+    """
+    Compares full-frame detection with region-of-interest detection on a synthetic clip.
+
+    Parameters:
+    num_frames (int, optional): The number of frames. Defaults to 150.
+    width (int, optional): The width of the frames. Defaults to 1920.
+    height (int, optional): The height of the frames. Defaults to 1080.
+    latency (float, optional): The simulated round-trip time of a call, in seconds. Defaults to 0.03.
+    bandwidth (float, optional): The simulated upload bandwidth, in bytes/second. Defaults to 2 MB/s.
+    crop_size (int, optional): The crop size of the `RoiModel`. Defaults to 320.
+
+    Returns:
+    dict: For each mode, the bytes sent, the wall time, the number of calls, the fraction of frames
+          where the ball was found and the mean position error in pixels.
+    """
+    frames = [cv2.cvtColor(synthetic_frame(index, width, height), cv2.COLOR_BGR2RGB) for index in range(num_frames)]
+    results = {}
+    for mode in ('full_frame', 'roi'):
+        detector = FakeDetector(latency, bandwidth)
+        model = RoiModel(detector, crop_size) if mode == 'roi' else detector
+        errors = []
+        start = time.perf_counter()
+        for index, frame in enumerate(frames):
+            predictions = model.predict(frame).json()["predictions"]
+            if predictions:
+                x, y = synthetic_ball_position(index, width, height)
+                errors.append(math.hypot(predictions[0]["x"] - x, predictions[0]["y"] - y))
+        results[mode] = {
+            'bytes_sent': detector.bytes_sent,
+            'wall_time_s': time.perf_counter() - start,
+            'calls': detector.calls,
+            'recall': len(errors) / num_frames,
+            'mean_error_px': float(np.mean(errors)) if errors else None,
+        }
+    results['bytes_ratio'] = results['roi']['bytes_sent'] / results['full_frame']['bytes_sent']
+    results['time_ratio'] = results['roi']['wall_time_s'] / results['full_frame']['wall_time_s']
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ball Tracking Benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    speed_parser = subparsers.add_parser("speed", help="Vectorized speed engine against the loop implementation")
+    speed_parser.add_argument("--frames", help="Frames per trajectory", type=int, default=1_000_000)
+    speed_parser.add_argument("--batch", help="Trajectories per call", type=int, default=8)
+    speed_parser.add_argument("--reference-frames", help="Frames given to the loop implementation", type=int,
+                              default=100_000)
+    roi_parser = subparsers.add_parser("roi", help="Region-of-interest crops against full frames")
+    roi_parser.add_argument("--frames", help="Number of frames", type=int, default=150)
+    roi_parser.add_argument("--width", help="Frame width", type=int, default=1920)
+    roi_parser.add_argument("--height", help="Frame height", type=int, default=1080)
+    roi_parser.add_argument("--latency", help="Simulated API round-trip time (s)", type=float, default=0.03)
+    roi_parser.add_argument("--bandwidth", help="Simulated upload bandwidth (bytes/s)", type=float, default=2e6)
+    roi_parser.add_argument("--crop-size", help="Crop size (px)", type=int, default=320)
+    pipeline_parser = subparsers.add_parser("pipeline", help="Time, memory and disk usage of each pipeline stage")
+    pipeline_parser.add_argument("--resolutions", help="Comma-separated clip sizes WxH", default="640x360,1280x720")
+    pipeline_parser.add_argument("--frames", help="Comma-separated clip lengths", default="150")
+    pipeline_parser.add_argument("--latency", help="Simulated detector round-trip time (s)", type=float, default=0.0)
+    pipeline_parser.add_argument("--miss-rate", help="Probability of a missed detection", type=float, default=0.1)
+    pipeline_parser.add_argument("--max-in-flight", help="Concurrent detector calls", type=int, default=4)
+    pipeline_parser.add_argument("--preprocess-workers", help="Processes filtering frames", type=int, default=1)
+    for subparser in (speed_parser, roi_parser, pipeline_parser):
+        subparser.add_argument("--output", help="File to save the results to", default=None)
+        subparser.add_argument("--baseline", help="Results to compare with", default=None)
+        subparser.add_argument("--tolerance", help="Relative increase reported as a regression", type=float,
+                               default=0.2)
+    args = parser.parse_args()
+
+    if args.benchmark == "speed":
+        results = benchmark_speed(args.frames, args.batch, args.reference_frames)
+    elif args.benchmark == "roi":
+        results = benchmark_roi(args.frames, args.width, args.height, args.latency, args.bandwidth, args.crop_size)
+    elif args.benchmark == "pipeline":
+        resolutions = [tuple(int(v) for v in size.split('x')) for size in args.resolutions.split(',')]
+        lengths = [int(v) for v in args.frames.split(',')]
+        results = benchmark_pipeline(resolutions, lengths, args.latency, args.miss_rate, args.max_in_flight,
+                                     args.preprocess_workers)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression['metric']} {regression['baseline']:.4g} -> {regression['value']:.4g} "
+                  f"(+{regression['change'] * 100:.0f}%)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
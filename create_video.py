@@ -2,29 +2,34 @@ import imageio
 import os
 import sys
 
+from metrics import metrics
 
-def create_video(original_format, fps=30):
+
+def create_video(original_format, fps=30, image_folder='annotated_images', output_path=None):
     """
     Creates a video from a sequence of annotated images stored in a specified folder.
 
     Parameters:
     original_format (str): The file extension for the output video file.
     fps (int, optional): Frames per second for the output video. Defaults to 30.
+    image_folder (str, optional): The folder containing the annotated images. Defaults to 'annotated_images'.
+    output_path (str, optional): The path of the video file to create. Defaults to
+                                 'outputs/output_video' with the original format.
 
-    The function compiles images from the 'annotated_images' folder into a video file.
+    The function compiles images from the image folder into a video file.
     It expects the images to be in a format suitable for video creation (like .jpg, .png,
-    or .jpeg) and sorts them if they are named sequentially. The created video is saved
-    in the 'outputs' directory with the specified original format. The function provides
+    or .jpeg) and sorts them if they are named sequentially. By default, the created video is
+    saved in the 'outputs' directory with the specified original format. The function provides
     real-time progress updates in the console during video creation.
 
     Note:
-    - The function creates an 'outputs' directory if it doesn't already exist.
-    - If there are no images in the 'annotated_images' folder, the function will terminate
+    - The function creates the directory of the output video if it doesn't already exist.
+    - If there are no images in the image folder, the function will terminate
       without creating a video.
     - The function relies on the `imageio` library for reading images and creating the video.
     """
-    output_video = 'output_video' + original_format
-    image_folder = 'annotated_images'
+    if output_path is None:
+        output_path = os.path.join('outputs', 'output_video' + original_format)
     # Getting all image files in the folder
     images = [img for img in os.listdir(image_folder) if img.endswith(".jpg") or img.endswith(".png") or img.endswith(".jpeg")]
     # Sorting the images if they are named sequentially
@@ -36,12 +41,13 @@ def create_video(original_format, fps=30):
     if total_images == 0:
         return
 
-    # Creating the outputs folder if it doesn't exist
-    if not os.path.exists('outputs'):
-        os.makedirs('outputs')
+    # Creating the output folder if it doesn't exist
+    output_folder = os.path.dirname(output_path)
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
 
     # Creating the video
-    with imageio.get_writer(f'outputs/{output_video}', fps=fps) as writer:
+    with imageio.get_writer(output_path, fps=fps) as writer:
         for index, image in enumerate(images):
             img_path = os.path.join(image_folder, image)
 
@@ -50,7 +56,9 @@ def create_video(original_format, fps=30):
                   end='')
             sys.stdout.flush()
 
-            image_data = imageio.imread(img_path)
-            writer.append_data(image_data)
+            with metrics.span('jpeg_read'):
+                image_data = imageio.imread(img_path)
+            with metrics.span('encode_frame'):
+                writer.append_data(image_data)
 
-    print("\nVideo creation complete. Video saved as", output_video)
+    print("\nVideo creation complete. Video saved as", output_path)
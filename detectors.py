@@ -0,0 +1,269 @@
+import ast
+import base64
+import hashlib
+import os
+import cv2
+import numpy as np
+
+from annotate_predictions import LocalPrediction
+from metrics import metrics
+from payload_encoding import scale_prediction
+
+
+class Detector:
+    """
+    The interface of the detection backends.
+
+    A detector finds objects in images given as a file path or an RGB NumPy array. Its `predict`
+    method returns a prediction with a `json` method giving the result in the JSON format of the
+    Roboflow API: a "predictions" list of boxes with their "class", "confidence", center "x", "y",
+    "width" and "height" in pixels.
+
+    Attributes:
+    id (str): The name of the model, used with `version` to key cached predictions.
+    version (str): The version of the model.
+    batch_size (int): The number of images the detector processes at once in `predict_batch`.
+    """
+
+    id = 'detector'
+    version = ''
+    batch_size = 1
+
+    def predict(self, image, confidence=40, overlap=30):
+        """
+        Detects the objects in an image.
+
+        Parameters:
+        image (str or numpy.ndarray): The image, as a file path or an RGB array.
+        confidence (float, optional): The minimum confidence of a box, in percent. Defaults to 40.
+        overlap (float, optional): The maximum overlap between two boxes of the same class, in percent,
+                                   above which the less confident one is removed. Defaults to 30.
+
+        Returns:
+        The prediction, with `json` and `save` methods.
+        """
+        raise NotImplementedError
+
+    def predict_batch(self, images, confidence=40, overlap=30):
+        """
+        Detects the objects in several images. Backends that can run batches override this method.
+
+        Returns:
+        list: The prediction of each image, in order.
+        """
+        return [self.predict(image, confidence, overlap) for image in images]
+
+
+class RoboflowDetector(Detector):
+    """
+    Detects objects with a model hosted by Roboflow, making one API call per image. The images are posted
+    to the inference endpoint through one `requests.Session`, so the calls of all the dispatcher's workers
+    reuse a pool of persistent connections.
+
+    Parameters:
+    api_key (str): The API key for accessing the Roboflow service.
+    project (str, optional): The Roboflow project. Defaults to 'tennis-tracker-duufq'.
+    version (int, optional): The version of the project's model. Defaults to 15.
+    encoder (PayloadEncoder, optional): If set, images are encoded in memory by this encoder, e.g. downscaled
+                                        and compressed, and the boxes are mapped back to the original image.
+                                        Defaults to None (image files are uploaded as they are, and arrays as
+                                        JPEG images).
+    timeout (float, optional): The time in seconds after which a stalled upload fails, so that it is
+                               retried by the `InferenceDispatcher`. Defaults to 30.
+    """
+
+    endpoint = 'https://detect.roboflow.com'
+
+    def __init__(self, api_key, project='tennis-tracker-duufq', version=15, encoder=None, timeout=30.0):
+        from roboflow import Roboflow
+        import requests
+
+        # Checking the API key and the model before the first call
+        Roboflow(api_key=api_key).workspace().project(project).version(version)
+        self.api_key = api_key
+        self.id = project
+        self.model_version = str(version)
+        self.encoder = encoder
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    @property
+    def version(self):
+        # Predictions made on encoded images are cached apart from the others
+        return self.model_version if self.encoder is None else f"{self.model_version}-{self.encoder.key}"
+
+    def _payload(self, image):
+        # The image as encoded by the encoder, or as it is, with the scale applied to it
+        if self.encoder is not None:
+            return self.encoder.encode(image)
+        if isinstance(image, str):
+            with open(image, 'rb') as f:
+                return f.read(), 1.0
+        ok, buffer = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 95])
+        if not ok:
+            raise ValueError("Cannot encode the image as jpeg")
+        return buffer.tobytes(), 1.0
+
+    def predict(self, image, confidence=40, overlap=30):
+        payload, scale = self._payload(image)
+        metrics.count('upload_bytes', len(payload))
+        response = self.session.post(f"{self.endpoint}/{self.id}/{self.model_version}",
+                                     params={'api_key': self.api_key, 'confidence': confidence, 'overlap': overlap,
+                                             'format': 'json'},
+                                     data=base64.b64encode(payload),
+                                     headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return LocalPrediction(scale_prediction(response.json(), scale), image)
+
+
+def letterbox(image, size):
+    """
+    Resizes an image to fit a square of `size` pixels, keeping its aspect ratio, and pads the rest.
+
+    Parameters:
+    image (numpy.ndarray): The image.
+    size (int): The side of the square.
+
+    Returns:
+    tuple: The padded image, the scale applied and the (x, y) offset of the resized image.
+    """
+    height, width = image.shape[:2]
+    scale = min(size / width, size / height)
+    resized_width, resized_height = round(width * scale), round(height * scale)
+    offset_x, offset_y = (size - resized_width) // 2, (size - resized_height) // 2
+    padded = np.full((size, size, 3), 114, dtype=np.uint8)
+    padded[offset_y:offset_y + resized_height, offset_x:offset_x + resized_width] = cv2.resize(
+        image, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+    return padded, scale, (offset_x, offset_y)
+
+
+class OnnxDetector(Detector):
+    """
+    Detects objects locally on the CPU with a YOLOv8 model exported to ONNX, e.g. with
+    `yolo export model=best.pt format=onnx dynamic=True`.
+
+    Images are letterboxed to the input size of the model and run in batches. The boxes above the
+    confidence threshold are filtered by non-maximum suppression per class and mapped back to the
+    coordinates of the original image.
+
+    Parameters:
+    model_path (str): The path to the .onnx file.
+    class_names (list of str, optional): The name of each class index. Defaults to the names stored in
+                                         the model's metadata by the YOLOv8 export.
+    input_size (int, optional): The side of the square input of the model. Defaults to the one declared
+                                by the model, or 640 if it is dynamic.
+    batch_size (int, optional): The number of images per inference run. Defaults to 8.
+    threads (int, optional): The number of threads used inside each operator. Defaults to None (one per core).
+
+    Note:
+    - Requires the `onnxruntime` package, which is imported when the detector is created.
+    - A model exported with a fixed batch size runs the images in batches of that size, the last one padded.
+    """
+
+    def __init__(self, model_path, class_names=None, input_size=None, batch_size=8, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        # Batches are parallelised inside the operators, not across them
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_dim, _, height_dim = model_input.shape[:3]
+        self.fixed_batch = batch_dim if isinstance(batch_dim, int) else None
+        self.input_size = input_size or (height_dim if isinstance(height_dim, int) else 640)
+        self.batch_size = max(1, batch_size)
+
+        if class_names is None:
+            names = self.session.get_modelmeta().custom_metadata_map.get('names')
+            class_names = ast.literal_eval(names) if names else {}
+        if not isinstance(class_names, dict):
+            class_names = dict(enumerate(class_names))
+        self.class_names = class_names
+
+        self.id = os.path.splitext(os.path.basename(model_path))[0]
+        with open(model_path, 'rb') as f:
+            self.version = hashlib.sha256(f.read()).hexdigest()[:12]
+
+    def predict(self, image, confidence=40, overlap=30):
+        return self.predict_batch([image], confidence, overlap)[0]
+
+    def predict_batch(self, images, confidence=40, overlap=30):
+        frames = [cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2RGB) if isinstance(image, str) else image
+                  for image in images]
+        boxes = [letterbox(frame, self.input_size) for frame in frames]
+        # NCHW float input in [0, 1]
+        batch = np.stack([padded for padded, _, _ in boxes]).transpose(0, 3, 1, 2).astype(np.float32) / 255
+        if self.fixed_batch is None or self.fixed_batch == len(batch):
+            outputs = self.session.run(None, {self.input_name: batch})[0]
+        else:
+            # A model exported with a fixed batch size runs batches of exactly that size, the last one padded
+            outputs = []
+            for start in range(0, len(batch), self.fixed_batch):
+                chunk = batch[start:start + self.fixed_batch]
+                padded = np.zeros((self.fixed_batch,) + chunk.shape[1:], dtype=chunk.dtype)
+                padded[:len(chunk)] = chunk
+                outputs.append(self.session.run(None, {self.input_name: padded})[0][:len(chunk)])
+            outputs = np.concatenate(outputs)
+
+        predictions = []
+        for image, output, (_, scale, offset) in zip(images, outputs, boxes):
+            prediction_json = {"predictions": self._decode(output, scale, offset, confidence / 100, overlap / 100)}
+            predictions.append(LocalPrediction(prediction_json, image))
+        return predictions
+
+    def _decode(self, output, scale, offset, confidence, overlap):
+        # A YOLOv8 output has one column per anchor: the box center and size, then one score per class
+        output = output.T
+        scores = output[:, 4:]
+        class_ids = scores.argmax(axis=1)
+        class_scores = scores[np.arange(len(scores)), class_ids]
+        keep = class_scores >= confidence
+        xywh, class_ids, class_scores = output[keep, :4], class_ids[keep], class_scores[keep]
+        if not len(xywh):
+            return []
+
+        xywh = xywh.copy()
+        xywh[:, 0] = (xywh[:, 0] - offset[0]) / scale
+        xywh[:, 1] = (xywh[:, 1] - offset[1]) / scale
+        xywh[:, 2:] /= scale
+        # Top-left boxes for the suppression, offset per class by more than the extent of all the boxes, so that
+        # classes do not suppress each other whatever the size of the image
+        corner_boxes = np.column_stack([xywh[:, 0] - xywh[:, 2] / 2, xywh[:, 1] - xywh[:, 3] / 2, xywh[:, 2:]])
+        extent = np.abs(corner_boxes[:, :2]).max() + corner_boxes[:, 2:].max() + 1
+        corner_boxes[:, :2] += class_ids[:, None] * extent
+        kept = cv2.dnn.NMSBoxes(corner_boxes.tolist(), class_scores.tolist(), confidence, overlap)
+        return [{"class": self.class_names.get(int(class_ids[i]), str(int(class_ids[i]))),
+                 "confidence": float(class_scores[i]),
+                 "x": float(xywh[i, 0]), "y": float(xywh[i, 1]),
+                 "width": float(xywh[i, 2]), "height": float(xywh[i, 3])}
+                for i in np.array(kept).reshape(-1)]
+
+
+def create_detector(backend='roboflow', api_key=None, onnx_model=None, batch_size=8, threads=None, encoder=None):
+    """
+    Creates the detector of a backend.
+
+    Parameters:
+    backend (str, optional): 'roboflow' for the hosted model or 'onnx' for local CPU inference. Defaults to 'roboflow'.
+    api_key (str, optional): The Roboflow API key, for the 'roboflow' backend.
+    onnx_model (str, optional): The path to the .onnx model, for the 'onnx' backend.
+    batch_size (int, optional): The number of frames per inference run of the 'onnx' backend. Defaults to 8.
+    threads (int, optional): The number of inference threads of the 'onnx' backend. Defaults to None (one per core).
+    encoder (PayloadEncoder, optional): The encoding of the images uploaded by the 'roboflow' backend. Defaults to
+                                        None (see `RoboflowDetector`).
+
+    Returns:
+    Detector: The detector.
+    """
+    if backend == 'roboflow':
+        return RoboflowDetector(api_key, encoder=encoder)
+    if backend == 'onnx':
+        if not onnx_model:
+            raise ValueError("The onnx backend needs the path to a model")
+        return OnnxDetector(onnx_model, batch_size=batch_size, threads=threads)
+    raise ValueError(f"Unknown detector backend: {backend}")
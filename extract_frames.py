@@ -1,55 +1,62 @@
 import cv2
 import os
 import sys
+import ffmpeg
 
+from ffmpeg_reader import FFmpegFrameReader
+from metrics import metrics
+from parallel_preprocess import filter_frames
 
-def extract_frames(video_path):
+
+def extract_frames(video_path, workers=1, filter_scale=1.0, max_width=None, fps=None, crop=None,
+                   output_folder='extracted_images', start_frame=0, max_frames=None):
     """
     Extracts frames from a given video file and applies a bilateral filter to each frame.
 
     Parameters:
     video_path (str): The path to the video file from which frames will be extracted.
+    workers (int, optional): The number of processes applying the bilateral filter. Defaults to 1.
+    filter_scale (float, optional): The scale at which frames are filtered and saved. Defaults to 1.
+    max_width (int, optional): Frames wider than this are downscaled to this width when decoded. Defaults to None.
+    fps (float, optional): The frame rate to subsample the video to when decoding. Defaults to None.
+    crop (tuple, optional): The (x, y, width, height) region of the frames to keep. Defaults to None.
+    output_folder (str, optional): The folder the frames are saved in. Defaults to 'extracted_images'.
+    start_frame (int, optional): The index of the first frame to extract. Defaults to 0.
+    max_frames (int, optional): The maximum number of frames to extract. Defaults to None (until the end).
 
-    This function opens a video file, calculates its frames per second (FPS), and then
+    This function decodes the video with a single ffmpeg process (see `FFmpegFrameReader`), and then
     iteratively extracts each frame, applying a bilateral filter to reduce noise while
-    preserving edges. Extracted frames are saved in the 'extracted_images' folder,
+    preserving edges. Extracted frames are saved in the output folder,
     named sequentially. The function provides real-time progress updates in the console.
-    It returns the FPS of the original video, which can be useful for further processing
+    It returns the FPS of the extracted frames, which can be useful for further processing
     like video reconstruction.
 
     Note:
-    - The function creates an 'extracted_images' directory if it doesn't already exist.
-    - It assumes that OpenCV is installed and properly configured.
+    - The function creates the output folder if it doesn't already exist.
+    - It assumes that OpenCV and FFmpeg are installed and properly configured.
     - If the video file cannot be opened, the function will print an error message.
+    - With several workers, frames are filtered in parallel by a `ParallelFrameFilter` and saved in order.
     """
-    output_folder = 'extracted_images'
-    # Creating the extracted_images folder if it doesn't exist
+    # Creating the output folder if it doesn't exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
     # Opening the video file
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-
-    if not cap.isOpened():
+    try:
+        reader = FFmpegFrameReader(video_path, max_width, fps, crop, start_frame=start_frame, max_frames=max_frames)
+    except ffmpeg.Error:
         print("Error opening video file")
         return
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    total_frames = max(1, reader.frame_count)
 
     frame_count = 0
-    while True:
-        success, frame = cap.read()
-
-        # Breaking the loop if read was not successful
-        if not success:
-            break
-
-        # Applying bilateral filter to each frame
-        filtered_image = cv2.bilateralFilter(frame, 9, 25, 25)
-
+    # Applying bilateral filter to each frame
+    for filtered_image in filter_frames(reader, workers, filter_scale):
         frame_filename = os.path.join(output_folder, f"frame_{frame_count:04d}.jpg")
-        cv2.imwrite(frame_filename, filtered_image)
+        with metrics.span('jpeg_write'):
+            cv2.imwrite(frame_filename, filtered_image)
+        metrics.count('frames_extracted')
 
         # Updating progress
         frame_count += 1
@@ -59,7 +66,5 @@ def extract_frames(video_path):
         # Flushing the output to ensure it updates in real time
         sys.stdout.flush()
 
-    # Releasing the video capture object
-    cap.release()
     print(f"\nExtracted {frame_count} frames")
-    return fps
+    return reader.fps
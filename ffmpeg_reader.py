@@ -0,0 +1,161 @@
+from fractions import Fraction
+import numpy as np
+
+from metrics import metrics
+import ffmpeg
+
+
+def _parse_rate(rate):
+    """
+    Parses a frame rate given by ffprobe as a fraction, e.g. '30000/1001'. Returns None if unknown.
+    """
+    try:
+        value = Fraction(rate)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return float(value) if value > 0 else None
+
+
+def probe_video(video_path):
+    """
+    Reads the dimensions, frame rate and length of a video with ffprobe.
+
+    Parameters:
+    video_path (str): The path to the video file.
+
+    Returns:
+    dict: The displayed 'width' and 'height' of the frames (accounting for rotation metadata),
+          the 'fps', the number of frames, 'frame_count', estimated from the duration if
+          the container does not record it, and the 'start_time' of the video in seconds.
+    """
+    probe = ffmpeg.probe(video_path)
+    video_stream = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+    width = int(video_stream['width'])
+    height = int(video_stream['height'])
+
+    # Phone videos are often stored sideways with a rotation that ffmpeg applies when decoding
+    rotation = int(video_stream.get('tags', {}).get('rotate', 0))
+    for side_data in video_stream.get('side_data_list', []):
+        rotation = int(side_data.get('rotation', rotation))
+    if rotation % 180:
+        width, height = height, width
+
+    fps = _parse_rate(video_stream.get('avg_frame_rate')) or _parse_rate(video_stream.get('r_frame_rate')) or 30.0
+    if 'nb_frames' in video_stream:
+        frame_count = int(video_stream['nb_frames'])
+    else:
+        duration = float(video_stream.get('duration', probe['format'].get('duration', 0)))
+        frame_count = int(round(duration * fps))
+    start_time = float(video_stream.get('start_time', probe['format'].get('start_time', 0)) or 0)
+    return {'width': width, 'height': height, 'fps': fps, 'frame_count': frame_count, 'start_time': start_time}
+
+
+class FFmpegFrameReader:
+    """
+    Decodes a video with a single ffmpeg process, streaming raw BGR frames into NumPy arrays.
+
+    Cropping, frame rate subsampling and downscaling are done in ffmpeg's filter graph, so the
+    frames arrive at their final size without any intermediate encode or file.
+
+    Parameters:
+    video_path (str): The path to the video file.
+    max_width (int, optional): Frames wider than this are downscaled to this width, keeping the aspect
+                               ratio. Defaults to None (original size).
+    fps (float, optional): The frame rate to subsample the video to. Defaults to None (original rate).
+    crop (tuple, optional): The (x, y, width, height) region of the original frames to keep. Defaults to
+                            None (whole frame).
+    buffers (int, optional): The number of preallocated frame buffers the frames are read into. Defaults to 2.
+    start_frame (int, optional): The index of the first frame produced, counted at the produced frame rate.
+                                 ffmpeg seeks to it before decoding. Defaults to 0.
+    max_frames (int, optional): The maximum number of frames produced. Defaults to None (until the end).
+
+    Attributes:
+    fps (float): The frame rate of the frames produced.
+    width, height (int): The size of the frames produced.
+    frame_count (int): The expected number of frames produced.
+
+    Note:
+    - Frames are read directly into a ring of `buffers` arrays, which are reused: a yielded frame is
+      overwritten `buffers` frames later. Callers keeping frames longer must copy them.
+    - The ffmpeg executable must be installed and accessible in the system's environment.
+    """
+
+    def __init__(self, video_path, max_width=None, fps=None, crop=None, buffers=2, start_frame=0, max_frames=None):
+        info = probe_video(video_path)
+        self.video_path = video_path
+        self.buffers = max(1, buffers)
+        width, height = info['width'], info['height']
+
+        self.fps = info['fps']
+        self.frame_count = info['frame_count']
+        subsampled = fps is not None and fps < self.fps
+        if subsampled:
+            self.frame_count = int(self.frame_count * fps / self.fps)
+            self.fps = fps
+        input_options = {}
+        # The original timestamps are kept when seeking in a subsampled video, see below
+        keep_timestamps = subsampled and start_frame > 0
+        if start_frame > 0:
+            # Seeking half a frame early, so that rounding cannot skip the first frame. ffmpeg decodes from
+            # the previous keyframe and drops the frames before the seek time, so the seek is frame-exact.
+            # When subsampling, a whole frame early, the frames before `start_frame` being selected out.
+            input_options['ss'] = (start_frame - (1 if subsampled else 0.5)) / self.fps
+            self.frame_count = max(0, self.frame_count - start_frame)
+        output_options = {}
+        if max_frames is not None:
+            output_options['vframes'] = max_frames
+            self.frame_count = min(self.frame_count, max_frames)
+
+        stream = ffmpeg.input(video_path, **input_options)
+        if keep_timestamps:
+            # The fps filter picks the frames on a grid of timestamps, which a seek would shift. With the
+            # timestamps of the video, counted from its start as in a single pass, it picks the same frames.
+            stream = stream.setpts(f"PTS-{info.get('start_time', 0.0)}/TB")
+        if crop is not None:
+            x, y, width, height = crop
+            stream = stream.crop(x, y, width, height)
+        if subsampled:
+            stream = stream.filter('fps', fps=fps)
+        if keep_timestamps:
+            stream = stream.filter('select', f"gte(t,{(start_frame - 0.5) / fps})")
+        if max_width is not None and width > max_width:
+            # Keeping an even height, as most encoders require
+            height = max(2, int(round(height * max_width / width / 2)) * 2)
+            width = max_width
+            stream = stream.filter('scale', width, height)
+        self.width = width
+        self.height = height
+        self._stream = stream.output('pipe:', format='rawvideo', pix_fmt='bgr24',
+                                     **output_options).global_args('-loglevel', 'error')
+        if keep_timestamps:
+            self._stream = self._stream.global_args('-copyts')
+
+    def __iter__(self):
+        """
+        Yields:
+        numpy.ndarray: The decoded frames as (height, width, 3) BGR arrays.
+        """
+        frame_bytes = self.width * self.height * 3
+        ring = [np.empty((self.height, self.width, 3), dtype=np.uint8) for _ in range(self.buffers)]
+        process = self._stream.run_async(pipe_stdout=True)
+        try:
+            index = 0
+            while True:
+                frame = ring[index % self.buffers]
+                view = memoryview(frame).cast('B')
+                received = 0
+                with metrics.span('decode'):
+                    while received < frame_bytes:
+                        count = process.stdout.readinto(view[received:])
+                        if not count:
+                            break
+                        received += count
+                if received < frame_bytes:
+                    break
+                yield frame
+                index += 1
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
@@ -0,0 +1,165 @@
+import collections
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests.exceptions
+
+from metrics import metrics
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket limiting how many calls can start per second.
+
+    Parameters:
+    rate (float): The number of tokens added to the bucket per second.
+    capacity (float, optional): The maximum number of tokens the bucket holds, i.e. the largest burst
+                                of calls allowed at once. Defaults to `max(1, rate)`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token from the bucket, sleeping until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _is_retryable(error):
+    """
+    Tells whether a failed API call is worth retrying.
+
+    Client errors such as an invalid API key will fail again, so only server errors, rate-limit
+    responses (429) and connection problems are retried.
+    """
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return True
+
+
+class InferenceDispatcher:
+    """
+    Runs model calls concurrently on a thread pool while returning the results in input order.
+
+    Parameters:
+    max_in_flight (int, optional): The maximum number of calls running at the same time. Defaults to 4.
+    rate_limit (float, optional): The maximum number of calls started per second, enforced with a token
+                                  bucket. Defaults to None (no limit).
+    max_retries (int, optional): The number of times a failed call is retried. Defaults to 3.
+    backoff (float, optional): The delay before the first retry in seconds. It doubles at every retry,
+                               with random jitter. Defaults to 0.5.
+    max_backoff (float, optional): The maximum delay between two retries in seconds. Defaults to 8.
+
+    Calls are retried on `requests.exceptions.HTTPError` (server errors and 429 responses),
+    `ConnectionError` and `Timeout`. A call that still fails after all retries produces `None`
+    in place of its result, so that the results stay aligned with the inputs.
+    """
+
+    retry_exceptions = (requests.exceptions.HTTPError,
+                        requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout)
+
+    def __init__(self, max_in_flight=4, rate_limit=None, max_retries=3, backoff=0.5, max_backoff=8.0):
+        self.max_in_flight = max(1, max_in_flight)
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def call(self, func, item):
+        """
+        Calls `func(item)`, applying the rate limit and retrying failed calls with exponential backoff.
+
+        Parameters:
+        func (callable): The function making the API call.
+        item: The argument passed to `func`.
+
+        Returns:
+        The result of `func(item)`, or `None` if every attempt failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                with metrics.span('predict'):
+                    return func(item)
+            except self.retry_exceptions as e:
+                if attempt == self.max_retries or not _is_retryable(e):
+                    print("\nError with API call", e)
+                    metrics.count('failed_calls')
+                    return None
+                metrics.count('retried_calls')
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def imap(self, func, items):
+        """
+        Applies `func` to every item concurrently and yields the results in input order.
+
+        Parameters:
+        func (callable): The function making the API call.
+        items (iterable): The arguments, consumed lazily so that at most `max_in_flight` of them
+                          are pending at any time.
+
+        Yields:
+        The result of `func(item)` for each item, or `None` for the items whose call failed.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = collections.deque()
+            for item in items:
+                if len(pending) >= self.max_in_flight:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(self.call, func, item))
+            while pending:
+                yield pending.popleft().result()
+
+    def imap_batches(self, func, items, batch_size):
+        """
+        Groups the items into batches, applies `func` to every batch concurrently and yields the
+        results one item at a time, in input order.
+
+        Parameters:
+        func (callable): The function running a batch. It takes a list of items and returns a list
+                         with one result per item.
+        items (iterable): The arguments, consumed lazily.
+        batch_size (int): The number of items per batch. The last batch may be smaller.
+
+        Yields:
+        The result of each item, or `None` for every item of a batch whose call failed.
+        """
+        # The sizes of the submitted batches, to expand a failed batch into one `None` per item
+        sizes = collections.deque()
+
+        def batches():
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    sizes.append(len(batch))
+                    yield batch
+                    batch = []
+            if batch:
+                sizes.append(len(batch))
+                yield batch
+
+        for results in self.imap(func, batches()):
+            size = sizes.popleft()
+            yield from results if results is not None else [None] * size
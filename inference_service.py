@@ -0,0 +1,335 @@
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from annotate_predictions import find_ball_position
+from batch_runner import job_name
+from detectors import create_detector
+from main import process_file
+from metrics import metrics
+from prediction_cache import CachedModel, PredictionCache
+from service_client import FINAL_EVENTS, JOB_OPTIONS
+
+
+class _ReportingModel:
+    # Passes every prediction of a job on to `emit`, as the ball position found in the image
+    def __init__(self, model, emit):
+        self.model = model
+        self.emit = emit
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _report(self, image, prediction):
+        self.emit({'event': 'detection', 'image': os.path.basename(image) if isinstance(image, str) else None,
+                   'ball': find_ball_position(prediction.json())})
+        return prediction
+
+    def predict(self, image, confidence=40, overlap=30):
+        return self._report(image, self.model.predict(image, confidence=confidence, overlap=overlap))
+
+    def predict_batch(self, images, confidence=40, overlap=30):
+        predictions = self.model.predict_batch(images, confidence, overlap)
+        return [self._report(image, prediction) for image, prediction in zip(images, predictions)]
+
+
+class Job:
+    """
+    A file submitted to an `InferenceService`, with the events of its processing.
+
+    Attributes:
+    id (str): The identifier of the job.
+    path (str): The absolute path of the file.
+    options (dict): The options of the job, see `JOB_OPTIONS`.
+    status (str): 'queued', 'running', 'done' or 'failed'.
+    events (list of dicts): The events of the job so far, each with its 'event' type and its 'seq' number.
+                            Once the job ends, its 'detection' events are dropped and their number is
+                            given by the final event, so that finished jobs take little memory.
+    """
+
+    def __init__(self, job_id, path, options, output_path):
+        self.id = job_id
+        self.path = path
+        self.options = options
+        self.output_path = output_path
+        self.status = 'queued'
+        self.events = []
+        self._condition = threading.Condition()
+
+    def emit(self, event):
+        with self._condition:
+            event = dict(event, job=self.id, time=time.time(), seq=len(self.events) + 1)
+            if event['event'] in FINAL_EVENTS:
+                self.status = event['event']
+                detections = [previous for previous in self.events if previous['event'] == 'detection']
+                self.events = [previous for previous in self.events if previous['event'] != 'detection']
+                event['detections'] = len(detections)
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def follow(self, timeout=None):
+        """
+        Yields the events of the job, those already emitted and then the new ones as they come, until the job ends.
+        A reader following a job that has ended gets the events left, without the per-frame 'detection' events.
+
+        Parameters:
+        timeout (float, optional): The longest wait for a new event in seconds, after which the stream stops.
+                                   Defaults to None (no limit).
+        """
+        last = 0
+        while True:
+            with self._condition:
+                if not self._condition.wait_for(lambda: self.events and self.events[-1]['seq'] > last, timeout):
+                    return
+                if self.status in FINAL_EVENTS:
+                    events = [event for event in self.events if event['seq'] > last]
+                else:
+                    # Until the job ends, no event is dropped and the number of an event follows its index
+                    events = self.events[last:]
+            last = events[-1]['seq']
+            for event in events:
+                yield event
+                if event['event'] in FINAL_EVENTS:
+                    return
+
+    def summary(self):
+        return {'id': self.id, 'path': self.path, 'status': self.status, 'output': self.output_path,
+                'options': self.options}
+
+
+class InferenceService:
+    """
+    A resident worker processing the files submitted to it with a detector created once.
+
+    Creating the Roboflow client looks up the workspace, project and version of the model, and a new
+    process imports OpenCV and ffmpeg, which dominates the processing of a short clip or a single image.
+    The service pays these costs once: the detector, its HTTP connection pool and the OpenCV kernels stay
+    warm, and the jobs queued are processed by `workers` threads with `process_file`.
+
+    Parameters:
+    roboflow_api_key (str): The API key for accessing the Roboflow service.
+    workers (int, optional): The number of jobs processed at the same time. Defaults to 1.
+    output_dir (str, optional): The directory of the annotated files, named '<job name>_annotated<ext>'.
+                                Defaults to 'outputs'.
+    workdir (str, optional): The directory in which each job gets a scratch workspace. Defaults to
+                             'service_workspaces'.
+    keep_jobs (int, optional): The number of finished jobs remembered, the oldest being forgotten.
+                               Defaults to 1000.
+    **options: The default options of the jobs, passed on to `process_file`, and the options of the detector
+               ('backend', 'onnx_model', 'batch_size', 'threads' and 'encoder') and of its prediction cache
+               ('cache_dir' and 'cache_size_mb'), which is opened once and shared by the jobs.
+
+    Note:
+    - `roi_size` is not supported, as the detection events would be in the coordinates of the crops.
+    """
+
+    def __init__(self, roboflow_api_key, workers=1, output_dir='outputs', workdir='service_workspaces',
+                 keep_jobs=1000, **options):
+        if options.pop('roi_size', None):
+            raise ValueError("The inference service does not support roi_size")
+        self.roboflow_api_key = roboflow_api_key
+        self.output_dir = output_dir
+        self.workdir = workdir
+        self.keep_jobs = keep_jobs
+        self.detector = create_detector(options.pop('backend', 'roboflow'), roboflow_api_key,
+                                        options.pop('onnx_model', None), options.pop('batch_size', 8),
+                                        options.pop('threads', None), options.pop('encoder', None))
+        cache_dir = options.pop('cache_dir', None)
+        cache_size_mb = options.pop('cache_size_mb', 512)
+        if cache_dir:
+            self.detector = CachedModel(self.detector, PredictionCache(cache_dir, cache_size_mb * 1024 * 1024))
+        self.options = options
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._warm_up()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def _warm_up(self):
+        # Running the preprocessing once, so that OpenCV sets up its kernels and thread pool before the first job
+        frame = np.zeros((64, 64, 3), dtype=np.uint8)
+        cv2.cvtColor(cv2.bilateralFilter(frame, 9, 25, 25), cv2.COLOR_BGR2RGB)
+        cv2.imencode('.jpg', frame)
+
+    def submit(self, path, options=None, output_path=None):
+        """
+        Queues a file for processing.
+
+        Parameters:
+        path (str): The path of the image or video, readable by the service.
+        options (dict, optional): Options of `process_file` for this job, among `JOB_OPTIONS`. Defaults to None.
+        output_path (str, optional): The path of the annotated file. Defaults to one in the output directory.
+
+        Returns:
+        Job: The queued job.
+        """
+        options = dict(options or {})
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"Options not allowed for a job: {', '.join(sorted(unknown))}")
+        if not os.path.isfile(path):
+            raise ValueError(f"No such file: {path}")
+        path = os.path.abspath(path)
+        if options.get('crop') is not None:
+            options['crop'] = tuple(options['crop'])
+        with self._lock:
+            job_id = str(next(self._ids))
+            name = f"{job_name(path)}-{job_id}"
+            output_path = output_path or os.path.join(self.output_dir,
+                                                      f"{name}_annotated{os.path.splitext(path)[1]}")
+            job = Job(job_id, path, options, output_path)
+            self.jobs[job_id] = job
+            self._forget_old_jobs()
+        job.emit({'event': 'queued', 'position': self._queue.qsize()})
+        self._queue.put((job, name))
+        metrics.count('service_jobs')
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINAL_EVENTS]
+        for job_id in finished[:max(0, len(finished) - self.keep_jobs)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, name = item
+            job.status = 'running'
+            job.emit({'event': 'started'})
+            start = time.perf_counter()
+            try:
+                options = dict(self.options, **job.options)
+                output_path = process_file(job.path, self.roboflow_api_key,
+                                           workspace=os.path.join(self.workdir, name), output_path=job.output_path,
+                                           detector=_ReportingModel(self.detector, job.emit), **options)
+                event = {'event': 'done', 'output': output_path, 'seconds': time.perf_counter() - start}
+                if output_path is not None and not job.path.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    event['trajectory'] = os.path.splitext(output_path)[0] + '.trajectory'
+                job.emit(event)
+            except Exception as e:
+                print(f"\nError processing {job.path}: {e!r}")
+                job.emit({'event': 'failed', 'error': repr(e), 'seconds': time.perf_counter() - start})
+
+    def close(self):
+        """
+        Stops the workers once the queued jobs are processed.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def status(self):
+        with self._lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {'status': 'ok', 'queued': self._queue.qsize(), 'jobs': counts}
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    # The HTTP API of the service. `server.service` is the `InferenceService`.
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self, job_id):
+        job = self.server.service.jobs.get(job_id)
+        if job is None:
+            self._send_json(404, {'error': f"Unknown job: {job_id}"})
+        return job
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['health']:
+            self._send_json(200, self.server.service.status())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self._job(parts[1])
+            if job is not None:
+                self._send_json(200, dict(job.summary(), events=job.events))
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self._job(parts[1])
+            if job is not None:
+                self._stream_events(job)
+        else:
+            self._send_json(404, {'error': f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            self._send_json(404, {'error': f"Unknown path: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job = self.server.service.submit(body['path'], body.get('options'), body.get('output'))
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, job.summary())
+
+    def _stream_events(self, job):
+        # One JSON event per line, written as they come until the job ends, the end of the response
+        # marking the end of the stream
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for event in job.follow():
+                self.wfile.write((json.dumps(event) + '\n').encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_request(self, code='-', size='-'):
+        # Only failed requests are logged, not every job submission and event stream
+        if str(getattr(code, 'value', code))[:1] in ('4', '5'):
+            super().log_request(code, size)
+
+
+def serve(roboflow_api_key, host='127.0.0.1', port=8765, **options):
+    """
+    Runs an `InferenceService` behind a local HTTP API until interrupted.
+
+    Endpoints:
+    - POST /jobs with a JSON body {"path": ..., "options": {...}, "output": ...}: queues a file (see
+      `InferenceService.submit`) and returns the job.
+    - GET /jobs/<id>: the status of a job and its events so far.
+    - GET /jobs/<id>/events: streams the events of a job as JSON lines until it ends: 'queued', 'started',
+      a 'detection' with the ball position for every image sent to the detector, and 'done' with the
+      output and trajectory paths, or 'failed' with the error.
+    - GET /health: the number of queued jobs and of jobs in each status.
+
+    Parameters:
+    roboflow_api_key (str): The API key for accessing the Roboflow service.
+    host (str, optional): The address to listen on. Defaults to '127.0.0.1' (local clients only).
+    port (int, optional): The port to listen on. Defaults to 8765.
+    **options: Passed on to `InferenceService`.
+    """
+    service = InferenceService(roboflow_api_key, **options)
+    server = ThreadingHTTPServer((host, port), _ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"Inference service listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping the inference service...")
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,128 @@
+import json
+import os
+import time
+
+
+class JobManifest:
+    """
+    An append-only record of the progress of a job, so that an interrupted job can resume where it stopped.
+
+    The manifest is a JSON Lines file with a header identifying the job, one record per completed
+    stage, and one record per frame whose detection result is known. Stage records are synced to disk
+    as soon as they are written. Detection results are synced in batches, so recording them costs one
+    fsync per `sync_every` frames or `sync_interval` seconds, and a crash loses at most that much work.
+
+    Parameters:
+    path (str): The path of the manifest file.
+    header (dict): Identifies the job, e.g. its source file and options. An existing manifest with a
+                   different header belongs to another job and is started over.
+    sync_every (int, optional): The number of detection results written between two syncs. Defaults to 50.
+    sync_interval (float, optional): The maximum time between two syncs of detection results, in seconds.
+                                     Defaults to 1.
+
+    Attributes:
+    stages (dict): The information recorded with each completed stage, by stage name.
+    predictions (dict): The detection result of each frame, by frame index.
+    """
+
+    def __init__(self, path, header, sync_every=50, sync_interval=1.0):
+        self.path = path
+        # Compared with the header read back from the file, so tuples become lists as in JSON
+        self.header = json.loads(json.dumps(header))
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.stages = {}
+        self.predictions = {}
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._file = None
+
+        if not self._load():
+            self.reset()
+            return
+        self._file = open(self.path, 'a')
+
+    def _load(self):
+        # Reads the existing records, returning False if there is no manifest of this job
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        valid_length = 0
+        records = []
+        for line in data.splitlines(keepends=True):
+            # A record cut short by a crash, and anything after it, is dropped
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            valid_length += len(line)
+        if not records or records[0] != {'type': 'header', **self.header}:
+            return False
+        if valid_length < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_length)
+        for record in records[1:]:
+            if record['type'] == 'stage':
+                self.stages[record['name']] = record.get('info', {})
+            elif record['type'] == 'prediction':
+                self.predictions[record['index']] = record['json']
+        return True
+
+    def reset(self):
+        """
+        Forgets all progress and starts a new manifest for the job.
+        """
+        self.stages = {}
+        self.predictions = {}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+        self._file = open(self.path, 'w')
+        self._append({'type': 'header', **self.header})
+        self.sync()
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + '\n')
+
+    def sync(self):
+        """
+        Writes the buffered records to disk.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def complete_stage(self, name, **info):
+        """
+        Records that a stage is complete, with information needed to skip it when resuming.
+        """
+        self.stages[name] = info
+        self._append({'type': 'stage', 'name': name, 'info': info})
+        self.sync()
+
+    def record_prediction(self, index, prediction_json):
+        """
+        Records the detection result of a frame.
+        """
+        self.predictions[index] = prediction_json
+        self._append({'type': 'prediction', 'index': index, 'json': prediction_json})
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
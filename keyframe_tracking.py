@@ -0,0 +1,234 @@
+import cv2
+import numpy as np
+
+from speed_calculations import calculate_windowed_speed
+
+
+class ConstantVelocityKalman:
+    """
+    A Kalman filter tracking a 2D point moving at constant velocity, with one step per frame.
+
+    Parameters:
+    process_noise (float, optional): The variance of the unmodelled acceleration, in pixels²/frame⁴.
+                                     Defaults to 4.
+    measurement_noise (float, optional): The variance of a measured position, in pixels². Defaults to 4.
+    """
+
+    # State transition and measurement matrices for the state (x, y, vx, vy)
+    F = np.array([[1, 0, 1, 0],
+                  [0, 1, 0, 1],
+                  [0, 0, 1, 0],
+                  [0, 0, 0, 1]], dtype=float)
+    H = np.array([[1, 0, 0, 0],
+                  [0, 1, 0, 0]], dtype=float)
+
+    def __init__(self, process_noise=4.0, measurement_noise=4.0):
+        # Discrete white-noise acceleration model
+        g = np.array([[0.5, 0], [0, 0.5], [1, 0], [0, 1]])
+        self.Q = process_noise * g @ g.T
+        self.R = measurement_noise * np.eye(2)
+        self.x = None
+        self.P = None
+
+    @property
+    def initialized(self):
+        return self.x is not None
+
+    def reset(self):
+        self.x = None
+        self.P = None
+
+    def predict(self):
+        """
+        Advances the filter by one frame.
+
+        Returns:
+        tuple: The predicted (x, y) position.
+        """
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        return self.position
+
+    def update(self, position):
+        """
+        Corrects the filter with a measured position, initialising it on the first measurement.
+
+        Parameters:
+        position (tuple): The measured (x, y) position.
+        """
+        z = np.asarray(position, dtype=float)
+        if self.x is None:
+            self.x = np.array([z[0], z[1], 0.0, 0.0])
+            # The velocity is unknown until the second measurement
+            self.P = np.diag([self.R[0, 0], self.R[1, 1], 1e4, 1e4])
+            return
+        innovation = z - self.H @ self.x
+        s = self.H @ self.P @ self.H.T + self.R
+        k = self.P @ self.H.T @ np.linalg.inv(s)
+        self.x = self.x + k @ innovation
+        self.P = (np.eye(4) - k @ self.H) @ self.P
+
+    @property
+    def position(self):
+        return float(self.x[0]), float(self.x[1])
+
+    @property
+    def uncertainty(self):
+        """
+        The standard deviation of the estimated position, in pixels.
+        """
+        return float(np.sqrt(max(self.P[0, 0], self.P[1, 1])))
+
+
+class KeyframeTracker:
+    """
+    Follows the ball between detector calls, so that only some frames need to be sent to the detector.
+
+    The detector runs on every `stride`-th frame (a keyframe). In between, the position is predicted
+    by a constant-velocity Kalman filter and, when frames are given, corrected with Lucas-Kanade
+    optical flow seeded from the last position. A detection is also requested before the next
+    keyframe when the tracking becomes unreliable: when the optical flow loses the ball, or, if
+    `max_uncertainty` is set, when the Kalman position uncertainty exceeds it. When a keyframe has
+    no ball, the frames up to the next keyframe are reported without a ball too.
+
+    Parameters:
+    stride (int, optional): The number of frames between two keyframes. Defaults to 5.
+    max_uncertainty (float, optional): The position uncertainty, in pixels, above which a detection is
+                                       requested early. Defaults to None (fixed stride).
+    max_flow_error (float, optional): The largest optical-flow matching error accepted as a valid track.
+                                      Defaults to 20.
+    """
+
+    def __init__(self, stride=5, max_uncertainty=None, max_flow_error=20.0):
+        self.stride = max(1, stride)
+        self.max_uncertainty = max_uncertainty
+        self.max_flow_error = max_flow_error
+        self.kalman = ConstantVelocityKalman()
+        self.detections = 0
+        self._previous_gray = None
+        self._lost = True
+
+    def needs_detection(self, index):
+        """
+        Tells whether the detector must run on frame `index`.
+        """
+        if index % self.stride == 0 or self._lost:
+            return True
+        return (self.max_uncertainty is not None and self.kalman.initialized
+                and self.kalman.uncertainty > self.max_uncertainty)
+
+    def step(self, index, frame, detect):
+        """
+        Computes the ball position in the next frame.
+
+        Parameters:
+        index (int): The index of the frame. Frames must be given in order.
+        frame (numpy.ndarray or None): The BGR frame, used for optical flow. If None, the position is
+                                       only predicted by the Kalman filter.
+        detect (callable): Called without arguments when the detector must run on this frame. It
+                           returns the detected (x, y) position, or `None` if no ball was found.
+
+        Returns:
+        tuple: The (x, y) position of the ball, or `None`, and whether it was detected (True) or
+               tracked (False).
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame is not None else None
+        previous_gray, self._previous_gray = self._previous_gray, gray
+
+        if self.needs_detection(index):
+            self.detections += 1
+            position = detect()
+            if position is None:
+                # The ball is out of view, so tracking restarts from the next keyframe's detection
+                self.kalman.reset()
+                self._lost = False
+                return None, True
+            if self.kalman.initialized:
+                self.kalman.predict()
+            self.kalman.update(position)
+            self._lost = False
+            return position, True
+
+        if not self.kalman.initialized:
+            return None, False
+        last_position = self.kalman.position
+        position = self.kalman.predict()
+        if gray is not None and previous_gray is not None:
+            flow_position = self._optical_flow(previous_gray, gray, last_position)
+            if flow_position is None:
+                self._lost = True
+            else:
+                self.kalman.update(flow_position)
+                position = self.kalman.position
+        return position, False
+
+    def _optical_flow(self, previous_gray, gray, position):
+        point = np.array([[position]], dtype=np.float32)
+        new_point, status, error = cv2.calcOpticalFlowPyrLK(previous_gray, gray, point, None,
+                                                            winSize=(21, 21), maxLevel=3)
+        if new_point is None or not status[0][0] or error[0][0] > self.max_flow_error:
+            return None
+        x, y = new_point[0][0]
+        height, width = gray.shape
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+        return float(x), float(y)
+
+
+def stride_accuracy_report(ball_positions, fps, strides=(2, 3, 5, 10), window_size=10, max_uncertainty=None,
+                           image_files=None):
+    """
+    Estimates the accuracy lost by running the detector only on keyframes, for several strides.
+
+    The positions detected on every frame are taken as the reference. For each stride, the tracker
+    is replayed with the reference detections on its keyframes only, and the tracked positions and
+    the resulting speeds are compared with the reference ones.
+
+    Parameters:
+    ball_positions (list of tuples): The positions detected on every frame, as returned by `annotate_images`.
+    fps (float): The frame rate of the video.
+    strides (iterable of int, optional): The strides to evaluate. Defaults to (2, 3, 5, 10).
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 10.
+    max_uncertainty (float, optional): Passed on to the `KeyframeTracker`. Defaults to None.
+    image_files (list of str, optional): The frames, to evaluate the tracker with optical flow.
+                                         Defaults to None (Kalman prediction only).
+
+    Returns:
+    list of dicts: For each stride, the fraction of frames sent to the detector, the mean, 95th
+                   percentile and maximum position errors in pixels, and the mean absolute speed
+                   error in pixels/second.
+    """
+    reference_speeds = np.array(calculate_windowed_speed(list(ball_positions), fps, window_size))
+    # The trackers of all the strides are replayed together, so that each frame is decoded once
+    trackers = [KeyframeTracker(stride, max_uncertainty) for stride in strides]
+    tracked_positions = [[] for _ in trackers]
+    for index, reference in enumerate(ball_positions):
+        frame = cv2.imread(image_files[index]) if image_files else None
+        for tracker, positions in zip(trackers, tracked_positions):
+            position, _ = tracker.step(index, frame, lambda: reference)
+            positions.append(position)
+
+    report = []
+    for stride, tracker, positions in zip(strides, trackers, tracked_positions):
+        errors = np.array([np.hypot(p[0] - r[0], p[1] - r[1])
+                           for p, r in zip(positions, ball_positions) if p is not None and r is not None])
+        speeds = np.array(calculate_windowed_speed(positions, fps, window_size))
+        report.append({
+            'stride': stride,
+            'detector_calls': tracker.detections / max(1, len(ball_positions)),
+            'mean_error_px': float(errors.mean()) if errors.size else 0.0,
+            'p95_error_px': float(np.percentile(errors, 95)) if errors.size else 0.0,
+            'max_error_px': float(errors.max()) if errors.size else 0.0,
+            'mean_speed_error': float(np.abs(speeds - reference_speeds).mean()) if speeds.size else 0.0,
+        })
+    return report
+
+
+def print_stride_report(report):
+    """
+    Prints the result of `stride_accuracy_report` as a table.
+    """
+    print(f"{'stride':>6} {'calls':>7} {'mean px':>8} {'p95 px':>8} {'max px':>8} {'speed err':>10}")
+    for row in report:
+        print(f"{row['stride']:>6} {row['detector_calls'] * 100:>6.1f}% {row['mean_error_px']:>8.2f} "
+              f"{row['p95_error_px']:>8.2f} {row['max_error_px']:>8.2f} {row['mean_speed_error']:>10.2f}")
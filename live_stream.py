@@ -0,0 +1,340 @@
+import asyncio
+import collections
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import imageio
+import numpy as np
+
+from annotate_predictions import find_ball_position
+from inference_dispatcher import InferenceDispatcher
+from metrics import metrics
+from render_annotations import render_frame
+from speed_calculations import OnlineSpeedEstimator
+
+
+class LiveSource:
+    """
+    A live source of frames read with OpenCV.
+
+    Parameters:
+    source (str or int): A stream URL (e.g. 'rtsp://...' or 'http://...'), the number of a capture device,
+                         or the path of a video file, which is played back at its real-time pace as a
+                         stand-in for a live stream.
+    max_width (int, optional): Frames wider than this are downscaled to this width. Defaults to None.
+
+    Attributes:
+    fps (float): The frame rate of the source, 30 if it is unknown.
+    is_file (bool): Whether the source is a video file.
+    """
+
+    def __init__(self, source, max_width=None):
+        is_device = isinstance(source, int) or str(source).isdigit()
+        self.is_file = not is_device and '://' not in str(source)
+        self.max_width = max_width
+        self.capture = cv2.VideoCapture(int(source) if is_device else source)
+        if not self.capture.isOpened():
+            raise IOError(f"Cannot open the live source {source}")
+        if not self.is_file:
+            # Keeping as few frames as possible in the capture's own buffer, which would add latency
+            self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and 0 < fps < 1000 else 30.0
+        self._start_time = None
+
+    def read(self):
+        """
+        Waits for the next frame and returns it as a BGR array, or `None` at the end of the source.
+        """
+        if self.is_file:
+            # Playing the file back at its real-time pace
+            if self._start_time is None:
+                self._start_time = time.monotonic()
+                self._frames = 0
+            delay = self._start_time + self._frames / self.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._frames += 1
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        if self.max_width is not None and frame.shape[1] > self.max_width:
+            height = int(round(frame.shape[0] * self.max_width / frame.shape[1]))
+            frame = cv2.resize(frame, (self.max_width, height), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def release(self):
+        self.capture.release()
+
+
+class LatestFrameSlot:
+    """
+    Holds the most recent frame waiting to be processed, replacing it when a newer one arrives.
+
+    When the processing falls behind the source, frames are dropped here instead of queuing up, so the
+    latency stays bounded by the processing time of one frame.
+
+    Attributes:
+    dropped (int): The number of frames replaced before being taken.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self._item = None
+        self._closed = False
+        self._event = asyncio.Event()
+
+    def put(self, item):
+        if self._item is not None:
+            self.dropped += 1
+        self._item = item
+        self._event.set()
+
+    def close(self):
+        self._closed = True
+        self._event.set()
+
+    async def get(self):
+        """
+        Waits for a frame and takes it. Returns `None` once the slot is closed and empty.
+        """
+        while self._item is None:
+            if self._closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        item, self._item = self._item, None
+        return item
+
+
+class LatencyTracker:
+    """
+    Records the end-to-end latency of each frame, from its capture to the emission of its result.
+
+    Parameters:
+    window (int, optional): The number of most recent frames the percentiles are computed over, bounding
+                            the memory of an endless stream. Defaults to 10000.
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.max_latency = 0.0
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.max_latency = max(self.max_latency, seconds)
+        metrics.observe('live_latency', seconds)
+
+    def percentiles(self):
+        """
+        Returns the 50th, 90th, 95th and 99th percentiles of the latencies of the recent frames, and the
+        maximum over the whole stream, in milliseconds.
+        """
+        if not self.latencies:
+            return {}
+        values = np.percentile(np.array(self.latencies) * 1000, [50, 90, 95, 99])
+        return {'p50_ms': float(values[0]), 'p90_ms': float(values[1]), 'p95_ms': float(values[2]),
+                'p99_ms': float(values[3]), 'max_ms': self.max_latency * 1000}
+
+
+def ball_event(index, capture_time, start_time, prediction_json, speed, dropped):
+    """
+    Builds the JSON event of a processed frame.
+
+    Returns:
+    dict: The 'frame' index, its 'time' in seconds since the start, the 'ball' position and confidence
+          (`None` if not found), the latest known 'speed' with the 'speed_frame' it belongs to, and the number
+          of frames 'dropped' since the previous event. The 'latency_ms' is added when the event is emitted.
+    """
+    ball = None
+    for prediction in (prediction_json or {}).get("predictions", []):
+        if prediction["class"] == "tennis-ball":
+            ball = {'x': prediction["x"], 'y': prediction["y"], 'confidence': prediction.get("confidence")}
+            break
+    return {'frame': index, 'time': capture_time - start_time, 'ball': ball,
+            'speed': speed[1] if speed else None, 'speed_frame': speed[0] if speed else None, 'dropped': dropped}
+
+
+async def run_live(source, model, target_latency=0.5, max_in_flight=1, rate_limit=None, window_size=5,
+                   max_gap=10, max_width=None, trail_length=0, style=None, on_frame=None, on_event=None,
+                   max_seconds=None):
+    """
+    Processes a live source continuously, emitting each annotated frame and its JSON event as soon as
+    the frame has been detected.
+
+    A capture task reads the frames as they come and puts the latest one in a `LatestFrameSlot`, and
+    `max_in_flight` detection tasks take the freshest frame each time they are free. Frames arriving
+    while all the tasks are busy are dropped, and a frame already older than `target_latency` when a task
+    takes it is skipped, so the latency does not grow when the detector is slower than the source. The
+    results are emitted in frame order. Speeds come from an `OnlineSpeedEstimator`, to which the dropped
+    frames are missing positions, so each event carries the latest speed known at that time.
+
+    Parameters:
+    source (str, int or LiveSource): The stream URL, capture device number or video file (see `LiveSource`).
+    model: The detection model. Its `predict` method must accept an RGB NumPy array.
+    target_latency (float, optional): The age in seconds above which a frame is skipped rather than
+                                      detected. Defaults to 0.5.
+    max_in_flight (int, optional): The number of frames detected at the same time. Defaults to 1.
+    rate_limit (float, optional): The maximum number of API calls started per second. Defaults to None.
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 5.
+    max_gap (int, optional): The longest run of frames without a position, e.g. dropped, that is
+                             interpolated. Defaults to 10.
+    max_width (int, optional): Frames wider than this are downscaled to this width, unless `source` is
+                               already a `LiveSource`. Defaults to None.
+    trail_length (int, optional): The number of past ball positions drawn as a trail. Defaults to 0.
+    style (OverlayStyle, optional): The appearance of the annotations. Defaults to the default style.
+    on_frame (callable, optional): Called with each annotated BGR frame and its event, e.g. to display it.
+                                   Defaults to None.
+    on_event (callable, optional): Called with each JSON event. Defaults to None.
+    max_seconds (float, optional): Stops after this time. Defaults to None (until the source ends).
+
+    Returns:
+    dict: The numbers of frames 'captured', 'processed', 'dropped' and 'skipped', the processing rate
+          in 'fps', and the percentiles of the end-to-end 'latency' (see `LatencyTracker`).
+    """
+    loop = asyncio.get_running_loop()
+    if not isinstance(source, LiveSource):
+        source = LiveSource(source, max_width)
+    slot = LatestFrameSlot()
+    latencies = LatencyTracker()
+    # Retrying a failed call would only return a stale result
+    dispatcher = InferenceDispatcher(max_in_flight, rate_limit, max_retries=0)
+    capture_executor = ThreadPoolExecutor(max_workers=1)
+    detect_executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight))
+    estimator = OnlineSpeedEstimator(source.fps, window_size, max_gap)
+    trail = collections.deque(maxlen=max(1, trail_length))
+    start_time = time.monotonic()
+    counts = {'captured': 0, 'processed': 0, 'skipped': 0}
+    # The frames taken by the detection tasks, in order, and the results that are ready
+    taken = collections.deque()
+    ready = {}
+    state = {'next_frame': 0, 'speed': None, 'dropped': 0}
+
+    async def capture_frames():
+        try:
+            while max_seconds is None or time.monotonic() - start_time < max_seconds:
+                frame = await loop.run_in_executor(capture_executor, source.read)
+                if frame is None:
+                    break
+                slot.put((counts['captured'], time.monotonic(), frame))
+                counts['captured'] += 1
+        finally:
+            slot.close()
+
+    def detect(frame):
+        filtered = cv2.bilateralFilter(frame, 9, 25, 25)
+        rgb_frame = cv2.cvtColor(filtered, cv2.COLOR_BGR2RGB)
+        prediction_json = dispatcher.call(lambda image: model.predict(image, confidence=40, overlap=30).json(),
+                                          rgb_frame)
+        return filtered, prediction_json
+
+    def emit(index, capture_time, frame, prediction_json):
+        # The frames between the previous emitted one and this one were dropped or skipped
+        for _ in range(state['next_frame'], index):
+            state['speed'] = _latest_speed(estimator.push(None), state['speed'])
+        position = find_ball_position(prediction_json) if prediction_json is not None else None
+        state['speed'] = _latest_speed(estimator.push(position), state['speed'])
+        state['dropped'] += index - state['next_frame']
+        state['next_frame'] = index + 1
+        event = ball_event(index, capture_time, start_time, prediction_json, state['speed'], state['dropped'])
+        state['dropped'] = 0
+        trail.append(position)
+        annotated = render_frame(frame, prediction_json, event['speed'], trail if trail_length > 0 else None, style)
+        if on_frame is not None:
+            on_frame(annotated, event)
+        latency = time.monotonic() - capture_time
+        latencies.record(latency)
+        event['latency_ms'] = latency * 1000
+        counts['processed'] += 1
+        metrics.count('live_frames')
+        if on_event is not None:
+            on_event(event)
+
+    async def detect_frames():
+        while True:
+            item = await slot.get()
+            if item is None:
+                return
+            index, capture_time, frame = item
+            if time.monotonic() - capture_time > target_latency:
+                counts['skipped'] += 1
+                continue
+            taken.append(index)
+            filtered, prediction_json = await loop.run_in_executor(detect_executor, detect, frame)
+            ready[index] = (capture_time, filtered, prediction_json)
+            # Emitting the results in frame order, as soon as the earlier frames are done
+            while taken and taken[0] in ready:
+                done = taken.popleft()
+                emit(done, *ready.pop(done))
+
+    try:
+        tasks = [asyncio.create_task(capture_frames())]
+        tasks += [asyncio.create_task(detect_frames()) for _ in range(max(1, max_in_flight))]
+        await asyncio.gather(*tasks)
+    finally:
+        source.release()
+        capture_executor.shutdown(wait=False)
+        detect_executor.shutdown(wait=False)
+    elapsed = time.monotonic() - start_time
+    return {'captured': counts['captured'], 'processed': counts['processed'], 'dropped': slot.dropped,
+            'skipped': counts['skipped'], 'fps': counts['processed'] / elapsed if elapsed else 0.0,
+            'latency': latencies.percentiles()}
+
+
+def _latest_speed(speeds, previous):
+    # The most recent (frame, speed) pair among the speeds just emitted by the estimator
+    return speeds[-1] if speeds else previous
+
+
+def process_live_stream(source, model, output_path=None, events_path=None, max_width=None, **options):
+    """
+    Runs `run_live` on a live source, writing the annotated frames to a video and the events as JSON lines.
+
+    Parameters:
+    source (str or int): The stream URL, capture device number or video file (see `LiveSource`).
+    model: The detection model. Its `predict` method must accept an RGB NumPy array.
+    output_path (str, optional): The video the annotated frames are written to. Defaults to None (not written).
+    events_path (str, optional): The file the JSON events are written to, one per line, or '-' for the
+                                 standard output. Defaults to None (not written).
+    max_width (int, optional): Frames wider than this are downscaled to this width. Defaults to None.
+    **options: Passed on to `run_live`, e.g. `target_latency` or `max_in_flight`.
+
+    Returns:
+    dict: The report of `run_live`.
+    """
+    source = LiveSource(source, max_width)
+    writer = None
+    events = None
+    if output_path is not None:
+        writer = imageio.get_writer(output_path, fps=source.fps)
+    if events_path == '-':
+        events = sys.stdout
+    elif events_path is not None:
+        events = open(events_path, 'w')
+
+    def on_frame(frame, event):
+        if writer is not None:
+            writer.append_data(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def on_event(event):
+        if events is not None:
+            events.write(json.dumps(event) + '\n')
+            events.flush()
+
+    try:
+        report = asyncio.run(run_live(source, model, on_frame=on_frame, on_event=on_event, **options))
+    finally:
+        if writer is not None:
+            writer.close()
+        if events is not None and events is not sys.stdout:
+            events.close()
+    latency = report['latency']
+    print(f"\nLive processing: {report['processed']}/{report['captured']} frames processed "
+          f"({report['dropped']} dropped, {report['skipped']} skipped), {report['fps']:.1f} fps", file=sys.stderr)
+    if latency:
+        print(f"Latency: p50 {latency['p50_ms']:.0f} ms, p90 {latency['p90_ms']:.0f} ms, "
+              f"p95 {latency['p95_ms']:.0f} ms, p99 {latency['p99_ms']:.0f} ms, max {latency['max_ms']:.0f} ms",
+              file=sys.stderr)
+    return report
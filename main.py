@@ -1,40 +1,49 @@
 import os
 import shutil
 import cv2
-import numpy as np
-from roboflow import Roboflow
-from compress_video import compress_video
 from extract_frames import extract_frames
-from annotate_predictions import annotate_images, annotate_frames_with_speed
+from annotate_predictions import detect_images, find_ball_position
+from association import associate_predictions
 from create_video import create_video
+from detectors import create_detector
+from inference_dispatcher import InferenceDispatcher
+from job_manifest import JobManifest
+from metrics import metrics
+from motion_gate import gate_frames
+from prediction_cache import PredictionCache, CachedModel
+from render_annotations import render_frame, render_frames
+from keyframe_tracking import stride_accuracy_report, print_stride_report
+from roi_detection import RoiModel
+from stage_limits import NO_LIMITS
 from speed_calculations import calculate_windowed_speed
+from stream_pipeline import process_video_stream
+from trajectory_store import build_trajectory, save_trajectory
 
 
-def cleanup(file_path, original_format):
+def cleanup(file_path, original_format, workspace='.'):
     """
     Cleans up temporary files and folders created during the processing of an image or video file.
 
     Parameters:
     file_path (str): The path of the original file that was processed.
     original_format (str): The original file format (extension) of the processed file.
+    workspace (str, optional): The directory the temporary files were created in. It is removed too
+                               once empty, unless it is the current directory. Defaults to '.'.
 
     This function removes temporary directories and files such as 'extracted_images',
-    'annotated_images', and any temporary image or compressed video files. It handles both
+    'annotated_images', and any temporary image files. It handles both
     image and video formats and ensures that all temporary files created during processing
     are removed to free up space.
     """
-    folders_to_remove = ['extracted_images', 'annotated_images']
+    folders_to_remove = [os.path.join(workspace, 'extracted_images'), os.path.join(workspace, 'annotated_images')]
     files_to_remove = []
     # For temporary files generated while processing an image
     if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
-        files_to_remove.append('temp_image.jpg')
+        files_to_remove.append(os.path.join(workspace, 'temp_image.jpg'))
 
-    # For temporary files generated while processing a video
+    # For the progress of a video, which is complete
     if file_path.lower().endswith(('.mp4', '.mov')):
-        files_to_remove.append('ffmpeg2pass-0.log')
-        files_to_remove.append('ffmpeg2pass-0.log.mbtree')
-        compressed_video_path = os.path.splitext(file_path)[0] + '_compressed' + original_format
-        files_to_remove.append(compressed_video_path)
+        files_to_remove.append(os.path.join(workspace, 'job_manifest.jsonl'))
 
     # Remove the files and folders
     for folder in folders_to_remove:
@@ -46,75 +55,240 @@ def cleanup(file_path, original_format):
                 os.remove(file)
         except OSError as e:
             print(f"Error removing file {file}: {e}")
+    if os.path.abspath(workspace) != os.getcwd():
+        try:
+            os.rmdir(workspace)
+        except OSError:
+            pass
     print('Removed temporary files and folders -', folders_to_remove, files_to_remove)
     print("Cleanup complete.")
 
 
-def process_file(file_path, roboflow_api_key):
+def process_file(file_path, roboflow_api_key, streaming=False, max_in_flight=1, rate_limit=None, cache_dir=None,
+                 cache_size_mb=512, detection_stride=1, max_uncertainty=None, stride_report=False, roi_size=None,
+                 preprocess_workers=1, filter_scale=1.0, max_width=None, fps=None, crop=None,
+                 trail_length=0, backend='roboflow', onnx_model=None, batch_size=8, threads=None, workspace='.',
+                 output_path=None, limiter=None, detector=None, resume=True, encoder=None, motion_gate=False,
+                 min_motion=0.005, scene_cuts=False, associate=False, max_balls=1):
     """
-    Processes an image or video file for object detection using the Roboflow API.
+    Processes an image or video file for object detection using the Roboflow API or a local model.
 
     Parameters:
     file_path (str): The path of the file to be processed.
     roboflow_api_key (str): The API key for accessing the Roboflow service.
+    streaming (bool, optional): If True, videos are processed in a single in-memory pass (see
+                                `process_video_stream`) instead of through the intermediate image
+                                folders. Defaults to False.
+    max_in_flight (int, optional): The maximum number of concurrent API calls for videos. Defaults to 1.
+    rate_limit (float, optional): The maximum number of API calls started per second. Defaults to None.
+    cache_dir (str, optional): A directory in which predictions are cached, so that re-processing frames
+                               already seen makes no API call. Defaults to None (no cache).
+    cache_size_mb (int, optional): The maximum size of the prediction cache in megabytes. Defaults to 512.
+    detection_stride (int, optional): Runs the model on every `detection_stride`-th video frame only, the
+                                      frames in between being tracked. Defaults to 1 (every frame).
+    max_uncertainty (float, optional): With a stride, the tracking uncertainty in pixels above which the
+                                       model runs before the next keyframe. Defaults to None.
+    stride_report (bool, optional): If True, prints how much position and speed accuracy would be lost
+                                    with larger detection strides, using the detections of this run as
+                                    the reference, which needs a `detection_stride` of 1. Defaults to False.
+    roi_size (int, optional): If set, only a crop of about this size around the expected ball position is
+                              sent to the model, falling back to the full frame when the ball is not
+                              found in it. Defaults to None (full frames).
+    preprocess_workers (int, optional): The number of processes applying the bilateral filter to the video
+                                        frames. Defaults to 1.
+    filter_scale (float, optional): The scale at which video frames are filtered and then processed, e.g. 0.5
+                                    to work at half resolution. Defaults to 1.
+    max_width (int, optional): Video frames wider than this are downscaled to this width when decoded.
+                               Defaults to None (original size).
+    fps (float, optional): The frame rate to subsample videos to when decoding. Defaults to None (original rate).
+    crop (tuple, optional): The (x, y, width, height) region of the video frames to process. Defaults to None.
+    trail_length (int, optional): The number of past ball positions drawn as a trail on video frames.
+                                  Defaults to 0 (no trail).
+    backend (str, optional): The detector, 'roboflow' for the hosted model or 'onnx' for a local model run
+                             on the CPU (see `create_detector`). Defaults to 'roboflow'.
+    onnx_model (str, optional): The path to the YOLOv8 .onnx model of the 'onnx' backend. Defaults to None.
+    batch_size (int, optional): The number of frames per inference run of the 'onnx' backend. Batching is
+                                not used together with `roi_size`, whose crops depend on the previous
+                                frame. Defaults to 8.
+    threads (int, optional): The number of inference threads of the 'onnx' backend. Defaults to None (one
+                             per core).
+    workspace (str, optional): The directory in which the temporary files and folders are created, so that
+                               several files can be processed at the same time in different workspaces.
+                               Defaults to '.'.
+    output_path (str, optional): The path of the annotated image or video. Defaults to
+                                 'outputs/image_annotated' or 'outputs/output_video' with the original format.
+    limiter (StageLimiter, optional): Limits the number of jobs running each stage at once, when several
+                                      files are processed concurrently (see `batch_runner`). Defaults to None.
+    detector (Detector, optional): The detector to use instead of creating one from `backend`, e.g. one
+                                   shared by the jobs of a batch. Defaults to None.
+    resume (bool, optional): If True, a video whose processing was interrupted in the same workspace, with
+                             the same options, resumes where it stopped: completed stages are skipped and
+                             only the frames without a detection result are sent to the model. Defaults to True.
+    encoder (PayloadEncoder, optional): The in-memory encoding of the images uploaded by the 'roboflow' backend,
+                                        e.g. downscaled JPEGs (see `payload_encoding`). Defaults to None (the
+                                        images are uploaded as they are).
+    motion_gate (bool, optional): If True, the extracted frames of a video are labelled as live play or dead
+                                  time by frame differencing before detection (see `motion_gate.gate_frames`).
+                                  Dead frames are not sent to the model, and speeds and trajectories are not
+                                  interpolated across them. Not used by the streaming mode. Defaults to False.
+    min_motion (float, optional): With the motion gate, the share of moving pixels from which a frame is live.
+                                  Defaults to 0.005.
+    scene_cuts (bool, optional): With the motion gate, also detects scene cuts, which end the live segments.
+                                 Defaults to False.
+    associate (bool, optional): If True, the ball of each frame of a video is chosen among all its tennis ball
+                                detections as the best trajectory over the whole video, instead of the first
+                                one (see `association.associate_predictions`). Not used by the streaming mode.
+                                Defaults to False.
+    max_balls (int, optional): With association, the largest number of balls tracked at once; the speeds and
+                               trajectory are those of the main one. Defaults to 1.
 
     The function first determines whether the file is an image or a video. For images, it applies
-    a bilateral filter and then uses the Roboflow model for object detection, saving the annotated
-    image. For videos, it compresses the video, extracts frames, annotates each frame, and then
-    creates a new annotated video. The function also handles cleanup of temporary files after
-    processing. Unsupported file formats will result in a printed message indicating the limitation.
+    a bilateral filter and then uses the detection model, saving the annotated
+    image. For videos, it decodes the frames with a single ffmpeg process, extracts them, detects the
+    ball in each frame, draws the detections and speeds onto each frame in a single pass, and then
+    creates a new annotated video. The trajectory of the ball is saved next to the video, in a
+    '.trajectory' directory that `trajectory_store.Trajectory` reads. The progress of a video is recorded in a `JobManifest` in the
+    workspace, which is kept if the processing fails. The function also handles cleanup of temporary
+    files after processing. Unsupported file formats will result in a printed message indicating the limitation.
+
+    Returns:
+    str or None: The path of the annotated image or video, or `None` for an unsupported file format.
     """
+    if stride_report and detection_stride != 1:
+        # The reference must be detected on every frame, not itself tracked between keyframes
+        raise ValueError("The stride report needs the detections of every frame, with a detection_stride of 1")
     original_format = None
-    rf = Roboflow(api_key=roboflow_api_key)
-    project = rf.workspace().project('tennis-tracker-duufq')
-    model = project.version(15).model
+    limiter = limiter or NO_LIMITS
+    extracted_images = os.path.join(workspace, 'extracted_images')
+    annotated_images = os.path.join(workspace, 'annotated_images')
+    model = detector or create_detector(backend, roboflow_api_key, onnx_model, batch_size, threads, encoder)
+    upload_encoding = getattr(getattr(model, 'encoder', None), 'key', None)
+    cache = None
+    if cache_dir:
+        cache = PredictionCache(cache_dir, cache_size_mb * 1024 * 1024)
+        model = CachedModel(model, cache)
+    if roi_size:
+        model = RoiModel(model, crop_size=roi_size)
     # Check if the file is an image or a video
     if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
         # It's an image, so annotating it directly
         print("Processing image...")
         original_format = '.' + file_path.split('.')[-1]
-        temp_image_path = "temp_image.jpg"
+        output_path = output_path or os.path.join('outputs', f'image_annotated{original_format}')
+        temp_image_path = os.path.join(workspace, "temp_image.jpg")
+        os.makedirs(workspace, exist_ok=True)
         image = cv2.imread(file_path)
 
         # Apply a bilateral filter to reduce noise while preserving edges
-        filtered_image = cv2.bilateralFilter(image, 9, 25, 25)
+        with metrics.span('filter'):
+            filtered_image = cv2.bilateralFilter(image, 9, 25, 25)
         cv2.imwrite(temp_image_path, filtered_image)
-        if not os.path.exists('outputs'):
-            os.makedirs('outputs')
-        model.predict(temp_image_path, confidence=40, overlap=30).save(f'outputs/image_annotated{original_format}')
-        image = cv2.imread(f'outputs/image_annotated{original_format}')
-        sharpening_kernel = np.array([[-1, -1, -1],
-                                      [-1, 9, -1],
-                                      [-1, -1, -1]])
-
-        # Sharpen the annotated image
-        sharpened_image = cv2.filter2D(image, -1, sharpening_kernel)
-        cv2.imwrite(f'outputs/image_annotated{original_format}', sharpened_image)
-        print("Image processed and saved as image_annotated.jpg")
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with limiter.stage('inference'), metrics.span('predict'):
+            prediction_json = model.predict(temp_image_path, confidence=40, overlap=30).json()
+
+        # Draw the detections and sharpen the annotated image
+        with metrics.span('draw'):
+            cv2.imwrite(output_path, render_frame(filtered_image, prediction_json))
+        print("Image processed and saved as", output_path)
     elif file_path.lower().endswith(('.mp4', '.mov')):
         # It's a video
         print("Processing video...")
         original_format = '.' + file_path.split('.')[-1]
+        output_path = output_path or os.path.join('outputs', 'output_video' + original_format)
+        trajectory_path = os.path.splitext(output_path)[0] + '.trajectory'
+
+        if streaming:
+            # Decoding, annotating and encoding the video without intermediate files
+            dispatcher = InferenceDispatcher(max_in_flight, rate_limit)
+            with limiter.stage('inference'), metrics.span('stream'):
+                process_video_stream(file_path, model, original_format, dispatcher=dispatcher,
+                                     detection_stride=detection_stride, max_uncertainty=max_uncertainty,
+                                     preprocess_workers=preprocess_workers, filter_scale=filter_scale,
+                                     max_width=max_width, fps=fps, crop=crop, trail_length=trail_length,
+                                     output_path=output_path, trajectory_path=trajectory_path)
+        else:
+            # Recording the progress, so that an interrupted run can resume from it
+            source = os.stat(file_path)
+            header = {'source': os.path.abspath(file_path), 'size': source.st_size, 'mtime': source.st_mtime,
+                      'filter_scale': filter_scale, 'max_width': max_width, 'fps': fps, 'crop': crop,
+                      'detection_stride': detection_stride, 'max_uncertainty': max_uncertainty,
+                      'roi_size': roi_size, 'backend': backend, 'onnx_model': onnx_model,
+                      'upload_encoding': upload_encoding}
+            with JobManifest(os.path.join(workspace, 'job_manifest.jsonl'), header) as manifest:
+                if not resume:
+                    manifest.reset()
 
-        # Compressing the video
-        compressed_video_path = compress_video(file_path, 2 * 1000, original_format)
+                extracted = manifest.stages.get('extract')
+                if (extracted and os.path.isdir(extracted_images)
+                        and len(os.listdir(extracted_images)) == extracted['frames']):
+                    print(f"Resuming: {extracted['frames']} frames already extracted")
+                    fps = extracted['fps']
+                else:
+                    # Frames left by an interrupted run of another job, or of the same job started over, are stale
+                    for folder in (extracted_images, annotated_images):
+                        shutil.rmtree(folder, ignore_errors=True)
+                    # Extracting frames from the video, scaled, subsampled and cropped while decoding
+                    with limiter.stage('decode'), metrics.span('extract'):
+                        fps = extract_frames(file_path, preprocess_workers, filter_scale, max_width, fps, crop,
+                                             output_folder=extracted_images)
+                    if fps is None:
+                        # Not recorded as complete, so that the next run does not resume from a failed decode
+                        raise RuntimeError(f"Could not extract the frames of {file_path}")
+                    manifest.complete_stage('extract', fps=fps, frames=len(os.listdir(extracted_images)))
 
-        # Extracting frames from the video
-        fps = extract_frames(compressed_video_path)
+                live_mask = None
+                if motion_gate:
+                    # Skipping the dead time between points, where there is no ball to detect
+                    with metrics.span('gate'):
+                        live_mask = gate_frames(extracted_images, fps, scene_cuts=scene_cuts, min_motion=min_motion)
 
-        # Annotating the extracted frames
-        ball_positions = annotate_images(model)
+                # Detecting the ball in the extracted frames
+                with limiter.stage('inference'), metrics.span('detect'):
+                    frame_files, prediction_jsons = detect_images(model, max_in_flight, rate_limit,
+                                                                  detection_stride=detection_stride,
+                                                                  max_uncertainty=max_uncertainty,
+                                                                  image_folder=extracted_images,
+                                                                  known_predictions=manifest.predictions,
+                                                                  on_prediction=manifest.record_prediction,
+                                                                  live_mask=live_mask)
+            if associate:
+                # Choosing the ball among all the candidates, as the trajectories that fit best over the video
+                with metrics.span('associate'):
+                    prediction_jsons = associate_predictions(prediction_jsons, max_balls=max_balls)
+            ball_positions = [find_ball_position(p) if p is not None else None for p in prediction_jsons]
 
-        # Calculating ball speed
-        ball_speeds = calculate_windowed_speed(ball_positions, fps, 10)
+            if stride_report:
+                # Comparing the detections with what a larger stride would have tracked
+                print_stride_report(stride_accuracy_report(ball_positions, fps, max_uncertainty=max_uncertainty,
+                                                           image_files=frame_files))
 
-        # Annotating ball speed to each frame
-        annotate_frames_with_speed(ball_speeds)
+            # Calculating ball speed
+            with metrics.span('speed'):
+                ball_speeds = calculate_windowed_speed(ball_positions, fps, 10, live_mask)
 
-        # Creating a video from the annotated frames
-        create_video(original_format, fps)
+            # Saving the trajectory for later analysis without running the detector again
+            save_trajectory(trajectory_path, build_trajectory(prediction_jsons, ball_speeds, fps, live_mask=live_mask),
+                            source=os.path.abspath(file_path), fps=fps, window_size=10)
+
+            with limiter.stage('render'):
+                # Drawing the detections, speeds and trail onto each frame in a single pass
+                with metrics.span('render'):
+                    render_frames(frame_files, prediction_jsons, ball_speeds, ball_positions, trail_length,
+                                  output_folder=annotated_images)
+
+                # Creating a video from the annotated frames
+                with metrics.span('encode'):
+                    create_video(original_format, fps, annotated_images, output_path)
     else:
         print("Unsupported file format")
+        output_path = None
+
+    if cache is not None:
+        print("Prediction cache:", cache.stats())
+    if roi_size:
+        print("Region of interest:", model.stats())
 
     # Cleanup temporary files and folders
-    cleanup(file_path, original_format)
+    cleanup(file_path, original_format, workspace)
+    return output_path
@@ -0,0 +1,317 @@
+import bisect
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   float('inf'))
+
+# Returned by `Metrics.span` while the metrics are disabled. A `nullcontext` can be entered any number of times.
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Histogram:
+    """
+    Counts latencies in fixed buckets, so that its memory does not grow with the number of observations.
+
+    Parameters:
+    buckets (tuple of float, optional): The upper bound of each bucket, in increasing order, the last one
+                                        being infinite. Defaults to `DEFAULT_BUCKETS`.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket holding it, capped by the largest value seen.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Returns the count, total, mean, maximum and estimated 50th, 95th and 99th percentiles, in seconds.
+        """
+        return {'count': self.count, 'total_s': self.total, 'mean_s': self.total / self.count if self.count else 0.0,
+                'max_s': self.max, 'p50_s': self.quantile(0.5), 'p95_s': self.quantile(0.95),
+                'p99_s': self.quantile(0.99)}
+
+
+class _Span:
+    # Times a `with` block and records it when it exits
+    __slots__ = ('metrics', 'name', 'start', 'profiling')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.profiling = False
+
+    def __enter__(self):
+        if self.name == self.metrics.profile_stage:
+            self.profiling = self.metrics._start_profile()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self.metrics._record_span(self.name, self.start, end)
+        if self.profiling:
+            self.metrics._stop_profile()
+
+
+class SamplingProfiler:
+    """
+    Samples the call stacks of all the threads at a fixed interval, e.g. to see where the threads of the
+    dispatcher spend their time, which `cProfile` (profiling only the thread enabling it) cannot show.
+
+    Parameters:
+    interval (float, optional): The time between two samples in seconds. Defaults to 0.005.
+
+    The samples are written in the collapsed stack format ('outer;inner count' lines), read by flame
+    graph tools such as flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop_event = None
+        self._thread = None
+
+    def enable(self):
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Metrics:
+    """
+    Collects timing spans, latency histograms and counters of the pipeline.
+
+    Every stage of `process_file` and every detector call is wrapped in a span, e.g.
+    `with metrics.span('detect'):`, and the number of frames going through each stage is counted.
+    While the metrics are disabled, which is the default, `span` returns a shared no-op context manager
+    and `count` returns immediately, so the instrumentation costs one attribute check per call.
+
+    The spans of `process_file` are 'extract', 'detect', 'speed', 'render' and 'encode' around each stage
+    ('stream' for `process_video_stream`), and 'decode', 'filter', 'jpeg_read', 'jpeg_write', 'predict',
+    'draw' and 'encode_frame' around the work done for each frame. Time spent waiting for a slot of a
+    `StageLimiter` is recorded as 'wait_<stage>'. The counters are 'frames_extracted', 'frames_detected',
+    'frames_rendered', 'retried_calls' and 'failed_calls'.
+
+    Note:
+    - Frames filtered by several `preprocess_workers` are filtered in other processes, so their 'filter'
+      spans are not recorded.
+    - The Prometheus export requires the `prometheus_client` package, imported when it is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_stage = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.trace_path = None
+        self.profile_path = None
+        self._trace_file = None
+        self._trace_separator = ''
+        self._profiler = None
+        self._profiling = False
+        self._prometheus = None
+        self._origin = time.perf_counter()
+
+    def enable(self, trace_path=None, prometheus_port=None, profile_stage=None, profile_mode='cprofile',
+               profile_path=None):
+        """
+        Starts collecting metrics.
+
+        Parameters:
+        trace_path (str, optional): A JSON file holding, in the Chrome trace event format, every span, so
+                                    that it can be opened in chrome://tracing or Perfetto, and a summary of
+                                    the histograms and counters. The spans are written as they end and the
+                                    summary by `close`. Defaults to None.
+        prometheus_port (int, optional): If set, the histograms and counters are also exported to Prometheus
+                                         on this port. Defaults to None.
+        profile_stage (str, optional): The name of a span to profile, e.g. 'detect'. Defaults to None.
+        profile_mode (str, optional): 'cprofile' to profile the calls of the thread running the span with
+                                      `cProfile`, or 'sampling' to sample the stacks of all the threads with a
+                                      `SamplingProfiler`. Defaults to 'cprofile'.
+        profile_path (str, optional): The file the profile is written to by `close`. Defaults to
+                                      '<profile_stage>.prof' with 'cprofile' and '<profile_stage>.stacks' with
+                                      'sampling'.
+        """
+        self._reset()
+        self.trace_path = trace_path
+        if trace_path:
+            # The spans are streamed to the file rather than kept, so that long and live runs do not grow
+            self._trace_file = open(trace_path, 'w')
+            self._trace_file.write('{"traceEvents": [\n')
+        if prometheus_port:
+            self._start_prometheus(prometheus_port)
+        self.profile_stage = profile_stage
+        if profile_stage:
+            if profile_mode == 'sampling':
+                self._profiler = SamplingProfiler()
+            elif profile_mode == 'cprofile':
+                self._profiler = cProfile.Profile()
+            else:
+                raise ValueError(f"Unknown profile mode: {profile_mode}")
+            extension = '.prof' if profile_mode == 'cprofile' else '.stacks'
+            self.profile_path = profile_path or profile_stage + extension
+        self.enabled = True
+
+    def _start_prometheus(self, port):
+        import prometheus_client
+
+        prometheus_client.start_http_server(port)
+        self._prometheus = {
+            'histogram': prometheus_client.Histogram('ball_tracking_span_seconds', 'Duration of the pipeline spans',
+                                                     ['span'], buckets=DEFAULT_BUCKETS),
+            'counter': prometheus_client.Counter('ball_tracking_events', 'Frames and events of the pipeline',
+                                                 ['name']),
+        }
+
+    def span(self, name):
+        """
+        Returns a context manager timing its `with` block as the span `name`.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def count(self, name, value=1):
+        """
+        Adds `value` to the counter `name`.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+        if self._prometheus is not None:
+            self._prometheus['counter'].labels(name).inc(value)
+
+    def observe(self, name, seconds):
+        """
+        Records a duration measured by the caller in the histogram `name`.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.histograms[name].observe(seconds)
+        if self._prometheus is not None:
+            self._prometheus['histogram'].labels(name).observe(seconds)
+
+    def _record_span(self, name, start, end):
+        self.observe(name, end - start)
+        if self._trace_file is not None:
+            event = json.dumps({'name': name, 'ph': 'X', 'ts': (start - self._origin) * 1e6,
+                                'dur': (end - start) * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident()})
+            with self._lock:
+                # The file is closed meanwhile if the span ends after `close`
+                if self._trace_file is not None:
+                    self._trace_file.write(self._trace_separator + event)
+                    self._trace_separator = ',\n'
+
+    def _start_profile(self):
+        # Only the outermost span of the profiled stage profiles, spans of the same stage running
+        # meanwhile, e.g. in the other jobs of a batch, being covered by it in the sampling mode only
+        with self._lock:
+            if self._profiling:
+                return False
+            self._profiling = True
+        self._profiler.enable()
+        return True
+
+    def _stop_profile(self):
+        self._profiler.disable()
+        self._profiling = False
+
+    def summary(self):
+        """
+        Returns the summary of each histogram, by span name, and the value of each counter.
+        """
+        with self._lock:
+            return {'spans': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+                    'counters': dict(sorted(self.counters.items()))}
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary['spans'] and not summary['counters']:
+            return
+        print(f"\n{'span':<14}{'count':>8}{'total (s)':>12}{'mean (ms)':>12}{'p95 (ms)':>12}{'max (ms)':>12}")
+        for name, span in summary['spans'].items():
+            print(f"{name:<14}{span['count']:>8}{span['total_s']:>12.3f}{span['mean_s'] * 1000:>12.2f}"
+                  f"{span['p95_s'] * 1000:>12.2f}{span['max_s'] * 1000:>12.2f}")
+        for name, value in summary['counters'].items():
+            print(f"{name}: {value}")
+
+    def close(self):
+        """
+        Writes the trace and the profile, if requested, and stops collecting metrics.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self._trace_file is not None:
+            summary = json.dumps(self.summary())
+            with self._lock:
+                trace_file, self._trace_file = self._trace_file, None
+            trace_file.write(f'\n], "displayTimeUnit": "ms", "summary": {summary}}}\n')
+            trace_file.close()
+            print("Metrics trace saved as", self.trace_path)
+        if self._profiler is not None:
+            if self._profiling:
+                self._stop_profile()
+            self._profiler.dump_stats(self.profile_path)
+            print(f"Profile of '{self.profile_stage}' saved as", self.profile_path)
+        self.profile_stage = None
+
+
+# The metrics of the process, disabled until `metrics.enable()` is called
+metrics = Metrics()
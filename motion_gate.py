@@ -0,0 +1,126 @@
+import glob
+import os
+import cv2
+import numpy as np
+
+from metrics import metrics
+from speed_calculations import live_runs
+
+# The OpenCV flag decoding a JPEG directly at a reduced size, in grayscale, by reduction factor
+REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def frame_activity(frames, pixel_threshold=15, scene_cuts=False, cut_threshold=0.5):
+    """
+    Measures the motion between consecutive frames by frame differencing.
+
+    Parameters:
+    frames (iterable of numpy.ndarray): The frames as small grayscale arrays, e.g. read by `read_reduced`.
+    pixel_threshold (int, optional): The change of gray level above which a pixel counts as moving. Defaults to 15.
+    scene_cuts (bool, optional): If True, scene cuts are detected too, as large changes of the gray level
+                                 histogram. Defaults to False.
+    cut_threshold (float, optional): The Bhattacharyya distance between the histograms of two frames above
+                                     which the second one starts a new scene. Defaults to 0.5.
+
+    Returns:
+    tuple: The activity of each frame, as the share of its pixels that changed since the previous frame
+           (the first frame gets the activity of the second one), and a boolean array flagging the frames
+           starting a new scene.
+    """
+    activity = []
+    cuts = []
+    previous = None
+    previous_histogram = None
+    for frame in frames:
+        histogram = None
+        if scene_cuts:
+            histogram = cv2.calcHist([frame], [0], None, [32], [0, 256])
+            cv2.normalize(histogram, histogram)
+        if previous is None or previous.shape != frame.shape:
+            activity.append(np.nan)
+            cuts.append(previous is not None)
+        else:
+            activity.append(np.count_nonzero(cv2.absdiff(frame, previous) > pixel_threshold) / frame.size)
+            cuts.append(scene_cuts and cv2.compareHist(previous_histogram, histogram,
+                                                       cv2.HISTCMP_BHATTACHARYYA) > cut_threshold)
+        previous = frame
+        previous_histogram = histogram
+    activity = np.array(activity, dtype=float)
+    if len(activity) > 1:
+        activity[0] = activity[1]
+    return np.nan_to_num(activity), np.array(cuts, dtype=bool)
+
+
+def label_live_frames(activity, cuts, fps, min_motion=0.005, min_dead_seconds=1.0, padding_seconds=0.5):
+    """
+    Labels the frames of a video as live play or dead time from their activity.
+
+    A frame is live when its activity reaches `min_motion`. Runs of still frames shorter than
+    `min_dead_seconds` are kept live, e.g. a ball in the air above still players, and `padding_seconds`
+    of frames are added on each side of every live run, so that a point is not cut short. The frame
+    starting a new scene is always dead, so that no trajectory spans two scenes.
+
+    Parameters:
+    activity (numpy.ndarray): The activity of each frame, see `frame_activity`.
+    cuts (numpy.ndarray): The frames starting a new scene, see `frame_activity`.
+    fps (float): The frame rate of the video.
+    min_motion (float, optional): The share of moving pixels from which a frame is live. Defaults to 0.005.
+    min_dead_seconds (float, optional): The shortest dead time. Defaults to 1.
+    padding_seconds (float, optional): The time kept live before and after each live run. Defaults to 0.5.
+
+    Returns:
+    numpy.ndarray: A boolean array, True for the live frames.
+    """
+    live = (np.asarray(activity) >= min_motion) & ~cuts
+    min_dead = int(round(min_dead_seconds * fps))
+    padding = int(round(padding_seconds * fps))
+    # Filling the short dead runs between two live runs
+    runs = live_runs(live)
+    for (_, end), (next_start, _) in zip(runs, runs[1:]):
+        if next_start - end < min_dead:
+            live[end:next_start] = True
+    for start, end in live_runs(live):
+        live[max(0, start - padding):end + padding] = True
+    live[cuts] = False
+    return live
+
+
+def read_reduced(image_file, reduction=4):
+    """
+    Reads an image as a grayscale array reduced `reduction` times (1, 2, 4 or 8), which JPEG decodes
+    at a fraction of the cost of the full image.
+    """
+    return cv2.imread(image_file, REDUCED_GRAYSCALE[reduction])
+
+
+def gate_frames(image_folder, fps, reduction=4, scene_cuts=False, **options):
+    """
+    Labels the extracted frames of a video as live play or dead time, before any detection.
+
+    Parameters:
+    image_folder (str): The folder of the frames, in the order `detect_images` reads them.
+    fps (float): The frame rate of the frames.
+    reduction (int, optional): The reduction of the frames compared, 1, 2, 4 or 8. Defaults to 4.
+    scene_cuts (bool, optional): If True, scene cuts split the live runs (see `frame_activity`). Defaults to False.
+    **options: Passed on to `label_live_frames`, e.g. `min_motion`.
+
+    Returns:
+    numpy.ndarray: A boolean array, True for the live frames.
+    """
+    img_files = sorted(glob.glob(os.path.join(image_folder, '*')))
+    activity, cuts = frame_activity((read_reduced(img_file, reduction) for img_file in img_files),
+                                    scene_cuts=scene_cuts)
+    live_mask = label_live_frames(activity, cuts, fps, **options)
+    dead = len(live_mask) - int(live_mask.sum())
+    metrics.count('frames_gated', dead)
+    print(f"Motion gate: {len(live_mask) - dead}/{len(live_mask)} frames live, {dead} dead frames skipped "
+          f"in {len(live_runs(live_mask))} live segments" + (f", {int(cuts.sum())} scene cuts" if scene_cuts else ''))
+    return live_mask
+
+
+def dead_time_prediction():
+    """
+    Returns the prediction result given to a dead frame, which is not sent to the detector.
+    """
+    return {"predictions": [], "dead_time": True}
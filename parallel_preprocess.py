@@ -0,0 +1,185 @@
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+
+def _filter_frame(frame, filter_scale):
+    """
+    Applies the bilateral filter used on every frame, optionally at a reduced resolution.
+    """
+    if filter_scale != 1.0:
+        frame = cv2.resize(frame, None, fx=filter_scale, fy=filter_scale, interpolation=cv2.INTER_AREA)
+    return cv2.bilateralFilter(frame, 9, 25, 25)
+
+
+def _output_shape(frame_shape, filter_scale):
+    if filter_scale == 1.0:
+        return tuple(frame_shape)
+    height, width = frame_shape[:2]
+    return (round(height * filter_scale), round(width * filter_scale)) + tuple(frame_shape[2:])
+
+
+def _worker(input_name, output_name, frame_shape, output_shape, slots, filter_scale, tasks, done):
+    """
+    Filters the frames of the input ring buffer into the output ring buffer until told to stop.
+
+    Only slot numbers travel through the queues; the pixels stay in shared memory.
+    """
+    # Each worker uses one core, the parallelism coming from the processes
+    cv2.setNumThreads(1)
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    inputs = np.ndarray((slots,) + frame_shape, dtype=np.uint8, buffer=input_memory.buf)
+    outputs = np.ndarray((slots,) + output_shape, dtype=np.uint8, buffer=output_memory.buf)
+    try:
+        while True:
+            slot = tasks.get()
+            if slot is None:
+                break
+            outputs[slot] = _filter_frame(inputs[slot], filter_scale)
+            done.put(slot)
+    finally:
+        del inputs, outputs
+        input_memory.close()
+        output_memory.close()
+
+
+class ParallelFrameFilter:
+    """
+    Applies the bilateral filter to a sequence of frames on a pool of processes.
+
+    Frames are exchanged with the workers through two ring buffers in shared memory, one for the
+    decoded frames and one for the filtered frames, so no pixel data is pickled. The filtered frames
+    are returned in the order the frames were given.
+
+    Parameters:
+    frame_shape (tuple): The shape (height, width, channels) of the frames.
+    workers (int, optional): The number of worker processes. Defaults to the number of CPU cores.
+    slots (int, optional): The number of frames in each ring buffer, i.e. the number of frames being
+                           filtered or waiting at once. Defaults to twice the number of workers.
+    filter_scale (float, optional): The scale at which frames are filtered. Below 1, frames are
+                                    downscaled before filtering, and the filtered frames keep the reduced
+                                    resolution. Defaults to 1.
+
+    The filter must be closed after use, e.g. by using it as a context manager, to stop the workers
+    and release the shared memory.
+    """
+
+    def __init__(self, frame_shape, workers=None, slots=None, filter_scale=1.0):
+        self.frame_shape = tuple(frame_shape)
+        self.output_shape = _output_shape(frame_shape, filter_scale)
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = slots or 2 * self.workers
+        context = multiprocessing.get_context('spawn')
+        self._input_memory = shared_memory.SharedMemory(create=True,
+                                                        size=self.slots * int(np.prod(self.frame_shape)))
+        self._output_memory = shared_memory.SharedMemory(create=True,
+                                                         size=self.slots * int(np.prod(self.output_shape)))
+        self._inputs = np.ndarray((self.slots,) + self.frame_shape, dtype=np.uint8, buffer=self._input_memory.buf)
+        self._outputs = np.ndarray((self.slots,) + self.output_shape, dtype=np.uint8,
+                                   buffer=self._output_memory.buf)
+        self._tasks = context.Queue()
+        self._done = context.Queue()
+        self._processes = [context.Process(target=_worker,
+                                           args=(self._input_memory.name, self._output_memory.name, self.frame_shape,
+                                                 self.output_shape, self.slots, filter_scale, self._tasks, self._done),
+                                           daemon=True)
+                           for _ in range(self.workers)]
+        for process in self._processes:
+            process.start()
+
+    def imap(self, frames):
+        """
+        Filters the frames in parallel.
+
+        Parameters:
+        frames (iterable of numpy.ndarray): The BGR frames, all with the shape given to the constructor.
+
+        Yields:
+        numpy.ndarray: The filtered frames, in order. Each one is copied out of the ring buffer, so it
+                       can be kept by the caller.
+        """
+        free_slots = collections.deque(range(self.slots))
+        in_order = collections.deque()
+        finished = set()
+
+        def wait_for_slot():
+            finished.add(self._next_done())
+            while in_order and in_order[0] in finished:
+                slot = in_order.popleft()
+                finished.discard(slot)
+                free_slots.append(slot)
+                yield self._outputs[slot].copy()
+
+        for frame in frames:
+            while not free_slots:
+                yield from wait_for_slot()
+            slot = free_slots.popleft()
+            self._inputs[slot] = frame
+            in_order.append(slot)
+            self._tasks.put(slot)
+        while in_order:
+            yield from wait_for_slot()
+
+    def _next_done(self):
+        # Waits for a worker to finish a frame, failing instead of hanging if a worker died
+        while True:
+            try:
+                return self._done.get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    raise RuntimeError("A frame preprocessing worker exited unexpectedly")
+
+    def close(self):
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        del self._inputs, self._outputs
+        self._input_memory.close()
+        self._input_memory.unlink()
+        self._output_memory.close()
+        self._output_memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def filter_frames(frames, workers=1, filter_scale=1.0):
+    """
+    Applies the bilateral filter to a sequence of frames, in parallel when several workers are requested.
+
+    Parameters:
+    frames (iterable of numpy.ndarray): The BGR frames, all with the same shape.
+    workers (int, optional): The number of worker processes. With 1, frames are filtered in the calling
+                             thread. Defaults to 1.
+    filter_scale (float, optional): The scale at which frames are filtered, the filtered frames keeping
+                                    the reduced resolution. Defaults to 1.
+
+    Yields:
+    numpy.ndarray: The filtered frames, in order.
+    """
+    frames = iter(frames)
+    if workers <= 1:
+        for frame in frames:
+            with metrics.span('filter'):
+                filtered = _filter_frame(frame, filter_scale)
+            yield filtered
+        return
+    first_frame = next(frames, None)
+    if first_frame is None:
+        return
+    with ParallelFrameFilter(first_frame.shape, workers, filter_scale=filter_scale) as frame_filter:
+        yield from frame_filter.imap(itertools.chain([first_frame], frames))
@@ -0,0 +1,181 @@
+import cv2
+import numpy as np
+
+from annotate_predictions import find_ball_position
+
+# The OpenCV encoding parameter of the quality of each format
+QUALITY_FLAGS = {'jpeg': cv2.IMWRITE_JPEG_QUALITY, 'webp': cv2.IMWRITE_WEBP_QUALITY}
+
+# The long edges and qualities tried by `tune_encoder`
+DEFAULT_EDGES = (1280, 960, 800, 640, 480)
+DEFAULT_QUALITIES = (85, 70, 50)
+
+
+class PayloadEncoder:
+    """
+    Encodes the images sent to a remote detector in memory, downscaled and compressed to reduce the upload.
+
+    Parameters:
+    max_edge (int, optional): Images whose long edge is longer than this are downscaled to it. Defaults to
+                              None (original size).
+    quality (int, optional): The encoding quality, from 1 to 100. Defaults to 90.
+    image_format (str, optional): 'jpeg' or 'webp'. Defaults to 'jpeg'.
+
+    The detections made on the encoded image are in its coordinates, and `scale_prediction` maps them
+    back to the original image.
+    """
+
+    def __init__(self, max_edge=None, quality=90, image_format='jpeg'):
+        if image_format not in QUALITY_FLAGS:
+            raise ValueError(f"Unknown image format: {image_format}")
+        self.max_edge = max_edge
+        self.quality = quality
+        self.image_format = image_format
+
+    def __repr__(self):
+        return f"PayloadEncoder(max_edge={self.max_edge}, quality={self.quality}, image_format='{self.image_format}')"
+
+    @property
+    def key(self):
+        """
+        A short description of the settings, e.g. '640px-q70-jpeg', distinguishing the predictions they give.
+        """
+        return f"{self.max_edge or 'full'}{'px' if self.max_edge else ''}-q{self.quality}-{self.image_format}"
+
+    def encode(self, image):
+        """
+        Encodes an image.
+
+        Parameters:
+        image (str or numpy.ndarray): The image, as a file path or an RGB array.
+
+        Returns:
+        tuple: The encoded bytes and the scale applied to the image (1 if it was not downscaled).
+        """
+        if isinstance(image, str):
+            image = cv2.imread(image)
+        else:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        height, width = image.shape[:2]
+        scale = 1.0
+        if self.max_edge is not None and max(width, height) > self.max_edge:
+            scale = self.max_edge / max(width, height)
+            image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.' + self.image_format, image, [QUALITY_FLAGS[self.image_format], self.quality])
+        if not ok:
+            raise ValueError(f"Cannot encode the image as {self.image_format}")
+        return buffer.tobytes(), scale
+
+
+def scale_prediction(prediction_json, scale):
+    """
+    Maps a prediction made on an image downscaled by `scale` back to the coordinates of the original image.
+
+    Returns:
+    dict: A copy of the prediction with the boxes, and the image size if given, divided by `scale`.
+    """
+    if scale == 1:
+        return prediction_json
+    prediction_json = dict(prediction_json)
+    prediction_json["predictions"] = [
+        dict(prediction, **{name: prediction[name] / scale for name in ("x", "y", "width", "height")
+                            if name in prediction})
+        for prediction in prediction_json.get("predictions", [])]
+    if isinstance(prediction_json.get("image"), dict):
+        prediction_json["image"] = {name: round(float(value) / scale)
+                                    for name, value in prediction_json["image"].items()}
+    return prediction_json
+
+
+def sample_frames(file_path, count=20):
+    """
+    Reads frames evenly spread over a video, e.g. to calibrate the encoding on them.
+
+    Parameters:
+    file_path (str): The path of the video, or of an image, which is returned alone.
+    count (int, optional): The number of frames. Defaults to 20.
+
+    Returns:
+    list of numpy.ndarray: The frames, as RGB arrays.
+    """
+    if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
+        return [cv2.cvtColor(cv2.imread(file_path), cv2.COLOR_BGR2RGB)]
+    capture = cv2.VideoCapture(file_path)
+    try:
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        indices = np.linspace(0, max(frame_count - 1, 0), num=max(1, min(count, frame_count or 1))).astype(int)
+        frames = []
+        for index in np.unique(indices):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            ok, frame = capture.read()
+            if ok:
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        return frames
+    finally:
+        capture.release()
+
+
+def _ball_recall(reference, candidate, tolerance):
+    # The share of the balls found in the reference predictions that are also found, at about the same place
+    found = total = 0
+    for reference_json, candidate_json in zip(reference, candidate):
+        expected = find_ball_position(reference_json)
+        if expected is None:
+            continue
+        total += 1
+        position = find_ball_position(candidate_json)
+        if position is not None and np.hypot(position[0] - expected[0], position[1] - expected[1]) <= tolerance:
+            found += 1
+    return found / total if total else 1.0
+
+
+def tune_encoder(detector, images, edges=DEFAULT_EDGES, qualities=DEFAULT_QUALITIES, formats=('jpeg',),
+                 min_recall=0.95, tolerance=10, confidence=40, overlap=30):
+    """
+    Picks the encoding with the smallest payload that keeps finding the ball on a calibration sample.
+
+    The sample is first detected as the detector sends it without encoder. Then every combination of
+    `edges`, `qualities` and `formats` is tried, from the smallest average payload to the largest, until
+    one finds at least `min_recall` of the balls found in the reference, within `tolerance` pixels.
+
+    Parameters:
+    detector (RoboflowDetector): The detector, whose `encoder` is set to the chosen encoding.
+    images (list): The calibration images, as file paths or RGB arrays (see `sample_frames`).
+    edges (tuple of int, optional): The long edges to try. Defaults to `DEFAULT_EDGES`.
+    qualities (tuple of int, optional): The qualities to try. Defaults to `DEFAULT_QUALITIES`.
+    formats (tuple of str, optional): The formats to try. Defaults to ('jpeg',).
+    min_recall (float, optional): The share of the reference balls that must be found. Defaults to 0.95.
+    tolerance (float, optional): The distance in pixels, in the original image, within which a ball counts as
+                                 found. Defaults to 10.
+    confidence, overlap (float, optional): The prediction parameters. Default to 40 and 30.
+
+    Returns:
+    tuple: The chosen `PayloadEncoder`, or `None` if no encoding kept the recall, and a list of dicts
+           with the 'encoder', average 'bytes' and 'recall' of each encoding tried.
+
+    Note:
+    - Each encoding tried costs one call per image, so a sample of 10 to 20 frames is usually enough.
+    """
+    candidates = [PayloadEncoder(edge, quality, image_format)
+                  for edge in edges for quality in qualities for image_format in formats]
+    sizes = [np.mean([len(candidate.encode(image)[0]) for image in images]) for candidate in candidates]
+    original_encoder = detector.encoder
+    results = []
+    chosen = None
+    try:
+        detector.encoder = None
+        reference = [detector.predict(image, confidence, overlap).json() for image in images]
+        for size, candidate in sorted(zip(sizes, candidates), key=lambda pair: pair[0]):
+            detector.encoder = candidate
+            predictions = [detector.predict(image, confidence, overlap).json() for image in images]
+            recall = _ball_recall(reference, predictions, tolerance)
+            results.append({'encoder': candidate, 'bytes': float(size), 'recall': recall})
+            print(f"\rCalibrating the upload encoding: {candidate.key} ({size / 1024:.0f} KB), recall {recall:.2f}",
+                  end='')
+            if recall >= min_recall:
+                chosen = candidate
+                break
+    finally:
+        detector.encoder = chosen if chosen is not None else original_encoder
+    print()
+    return chosen, results
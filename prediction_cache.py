@@ -0,0 +1,210 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+
+from annotate_predictions import LocalPrediction
+
+
+class PredictionCache:
+    """
+    A persistent, content-addressed cache of prediction results with a size limit.
+
+    Each entry is a JSON file named after the SHA-256 hash of the image bytes, the model id and
+    version and the prediction parameters, so a frame seen before is recognised whatever its file
+    name. When the cache grows over `max_bytes`, the least recently used entries are evicted.
+
+    Parameters:
+    cache_dir (str, optional): The directory holding the cache entries. Defaults to '.prediction_cache'.
+    max_bytes (int, optional): The maximum total size of the entries in bytes. Defaults to 512 MB.
+    """
+
+    def __init__(self, cache_dir='.prediction_cache', max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Maps each key to its size, from the least to the most recently used, rebuilt from the files on disk
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        found = []
+        for root, _, files in os.walk(cache_dir):
+            for file in files:
+                if file.endswith('.json'):
+                    stat = os.stat(os.path.join(root, file))
+                    found.append((stat.st_mtime, file[:-5], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def make_key(image_bytes, model_id, confidence, overlap):
+        """
+        Computes the cache key of a prediction.
+
+        Parameters:
+        image_bytes (bytes): The encoded image file or the raw pixels of the frame.
+        model_id (str): The id and version of the model making the prediction.
+        confidence (int): The confidence threshold of the prediction.
+        overlap (int): The overlap threshold of the prediction.
+
+        Returns:
+        str: The hexadecimal SHA-256 digest identifying the prediction.
+        """
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"|{model_id}|{confidence}|{overlap}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        Looks up a prediction in the cache.
+
+        Parameters:
+        key (str): The cache key returned by `make_key`.
+
+        Returns:
+        dict or None: The cached prediction JSON, or `None` on a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key)) as f:
+                    prediction_json = json.load(f)
+            except (OSError, ValueError):
+                # The entry was removed or is corrupted, e.g. by another process sharing the cache
+                self._forget(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            # The modification time records the last use, so the LRU order survives restarts
+            now = time.time()
+            os.utime(self._path(key), (now, now))
+            self._entries.move_to_end(key)
+            return prediction_json
+
+    def put(self, key, prediction_json):
+        """
+        Stores a prediction in the cache, evicting the least recently used entries if needed.
+
+        Parameters:
+        key (str): The cache key returned by `make_key`.
+        prediction_json (dict): The prediction result to store.
+        """
+        data = json.dumps(prediction_json).encode()
+        path = self._path(key)
+        with self._lock:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Writing to a temporary file first so that a crash never leaves a truncated entry
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            if key in self._entries:
+                self._total_bytes -= self._entries[key]
+            self._entries[key] = len(data)
+            self._entries.move_to_end(key)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _forget(self, key):
+        self._total_bytes -= self._entries.pop(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # The least recently used entries come first
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._forget(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns the hit/miss statistics of the cache.
+
+        Returns:
+        dict: The number of hits, misses and evictions, the hit rate, and the number and total
+              size of the entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._total_bytes,
+        }
+
+
+class CachedModel:
+    """
+    Wraps a detection model so that its predictions are read from a `PredictionCache` when possible.
+
+    Parameters:
+    model: The detection model to wrap. Its `predict` method takes an image file path or an RGB
+           NumPy array and confidence and overlap parameters.
+    cache (PredictionCache): The cache storing the predictions.
+
+    On a hit, `predict` returns a `LocalPrediction` drawing the cached boxes itself, without any
+    API call. On a miss, the model is called and its result stored before being returned. If the
+    model runs batches (see `detectors.Detector`), `predict_batch` sends it only the missed images.
+    """
+
+    def __init__(self, model, cache):
+        self.model = model
+        self.cache = cache
+        self.model_id = f"{getattr(model, 'id', type(model).__name__)}/{getattr(model, 'version', '')}"
+
+    @property
+    def batch_size(self):
+        return getattr(self.model, 'batch_size', 1)
+
+    def _key(self, image, confidence, overlap):
+        if isinstance(image, str):
+            with open(image, 'rb') as f:
+                image_bytes = f.read()
+        else:
+            image_bytes = str(image.shape).encode() + np.ascontiguousarray(image).tobytes()
+        return self.cache.make_key(image_bytes, self.model_id, confidence, overlap)
+
+    def predict(self, image, confidence=40, overlap=30):
+        key = self._key(image, confidence, overlap)
+        prediction_json = self.cache.get(key)
+        if prediction_json is not None:
+            return LocalPrediction(prediction_json, image)
+        prediction = self.model.predict(image, confidence=confidence, overlap=overlap)
+        self.cache.put(key, prediction.json())
+        return prediction
+
+    def predict_batch(self, images, confidence=40, overlap=30):
+        keys = [self._key(image, confidence, overlap) for image in images]
+        predictions = [None] * len(images)
+        missed = []
+        for index, (image, key) in enumerate(zip(images, keys)):
+            prediction_json = self.cache.get(key)
+            if prediction_json is not None:
+                predictions[index] = LocalPrediction(prediction_json, image)
+            else:
+                missed.append(index)
+        if missed:
+            results = self.model.predict_batch([images[index] for index in missed], confidence=confidence,
+                                               overlap=overlap)
+            for index, prediction in zip(missed, results):
+                self.cache.put(keys[index], prediction.json())
+                predictions[index] = prediction
+        return predictions
@@ -0,0 +1,209 @@
+import os
+import sys
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+SHARPENING_KERNEL = np.array([[-1, -1, -1],
+                              [-1, 9, -1],
+                              [-1, -1, -1]])
+
+
+class OverlayStyle:
+    """
+    The appearance of the annotations drawn onto the frames.
+
+    Parameters:
+    ball_color (tuple, optional): The BGR color of the tennis ball boxes. Defaults to yellow.
+    box_color (tuple, optional): The BGR color of the boxes of the other classes. Defaults to blue.
+    box_thickness (int, optional): The line thickness of the boxes. Defaults to 2.
+    show_labels (bool, optional): Whether the class names are written above the boxes. Defaults to True.
+    label_scale (float, optional): The font scale of the class names. Defaults to 0.5.
+    speed_color (tuple, optional): The BGR color of the speed text. Defaults to red.
+    speed_scale (float, optional): The font scale of the speed text. Defaults to 1.
+    speed_position (tuple, optional): The (x, y) position of the speed text. Defaults to (10, 30).
+    speed_format (str, optional): The format of the speed text. Defaults to "Speed: {:.2f} px/s".
+    trail_color (tuple, optional): The BGR color of the trajectory trail. Defaults to yellow.
+    trail_thickness (int, optional): The line thickness of the trajectory trail. Defaults to 2.
+    sharpen (bool, optional): Whether the frame is sharpened after the boxes are drawn. Defaults to True.
+    """
+
+    def __init__(self, ball_color=(0, 255, 255), box_color=(255, 0, 0), box_thickness=2, show_labels=True,
+                 label_scale=0.5, speed_color=(0, 0, 255), speed_scale=1, speed_position=(10, 30),
+                 speed_format="Speed: {:.2f} px/s", trail_color=(0, 255, 255), trail_thickness=2, sharpen=True):
+        self.ball_color = ball_color
+        self.box_color = box_color
+        self.box_thickness = box_thickness
+        self.show_labels = show_labels
+        self.label_scale = label_scale
+        self.speed_color = speed_color
+        self.speed_scale = speed_scale
+        self.speed_position = speed_position
+        self.speed_format = speed_format
+        self.trail_color = trail_color
+        self.trail_thickness = trail_thickness
+        self.sharpen = sharpen
+
+
+DEFAULT_STYLE = OverlayStyle()
+
+
+def sharpen_image(image):
+    """
+    Sharpens an image with the 3x3 kernel used for all annotated outputs.
+
+    Parameters:
+    image (numpy.ndarray): The BGR image to sharpen.
+
+    Returns:
+    numpy.ndarray: The sharpened image.
+    """
+    return cv2.filter2D(image, -1, SHARPENING_KERNEL)
+
+
+def draw_predictions(image, prediction_json, style=None):
+    """
+    Draws the bounding boxes and class labels of a prediction result onto an image.
+
+    Parameters:
+    image (numpy.ndarray): The BGR image to draw on. It is modified in place.
+    prediction_json (dict): The prediction result in the JSON format returned by the model.
+                            Boxes are given by their center (x, y), width and height.
+    style (OverlayStyle, optional): The appearance of the boxes. Defaults to `DEFAULT_STYLE`.
+
+    Returns:
+    numpy.ndarray: The annotated image.
+    """
+    style = style or DEFAULT_STYLE
+    for prediction in prediction_json.get("predictions", []):
+        x0 = int(prediction["x"] - prediction["width"] / 2)
+        y0 = int(prediction["y"] - prediction["height"] / 2)
+        x1 = int(prediction["x"] + prediction["width"] / 2)
+        y1 = int(prediction["y"] + prediction["height"] / 2)
+        # The tennis balls left out by `associate_predictions` are drawn as other objects
+        is_ball = prediction["class"] == "tennis-ball" and prediction.get("associated", True)
+        color = style.ball_color if is_ball else style.box_color
+        cv2.rectangle(image, (x0, y0), (x1, y1), color, style.box_thickness)
+        if style.show_labels:
+            cv2.putText(image, prediction["class"], (x0, max(y0 - 5, 10)), cv2.FONT_HERSHEY_SIMPLEX,
+                        style.label_scale, color, 1)
+    return image
+
+
+def draw_speed(image, speed, style=None):
+    """
+    Draws a speed value onto the top-left corner of an image.
+
+    Parameters:
+    image (numpy.ndarray): The BGR image to draw on. It is modified in place.
+    speed (float): The speed of the ball in pixels/second.
+    style (OverlayStyle, optional): The appearance of the text. Defaults to `DEFAULT_STYLE`.
+
+    Returns:
+    numpy.ndarray: The annotated image.
+    """
+    style = style or DEFAULT_STYLE
+    cv2.putText(image, style.speed_format.format(speed), style.speed_position, cv2.FONT_HERSHEY_SIMPLEX,
+                style.speed_scale, style.speed_color, 2)
+    return image
+
+
+def draw_trail(image, trail, style=None):
+    """
+    Draws the recent trajectory of the ball as a polyline.
+
+    Parameters:
+    image (numpy.ndarray): The BGR image to draw on. It is modified in place.
+    trail (list of tuples): The recent positions (x, y) of the ball, oldest first. `None` entries
+                            break the line.
+    style (OverlayStyle, optional): The appearance of the trail. Defaults to `DEFAULT_STYLE`.
+
+    Returns:
+    numpy.ndarray: The annotated image.
+    """
+    style = style or DEFAULT_STYLE
+    segment = []
+    for position in list(trail) + [None]:
+        if position is not None:
+            segment.append((int(position[0]), int(position[1])))
+        elif segment:
+            if len(segment) > 1:
+                cv2.polylines(image, [np.array(segment, dtype=np.int32)], False, style.trail_color,
+                              style.trail_thickness, cv2.LINE_AA)
+            segment = []
+    return image
+
+
+def render_frame(frame, prediction_json, speed=None, trail=None, style=None):
+    """
+    Draws all the annotations of a frame in a single pass over the in-memory array.
+
+    The boxes and labels are drawn first and the frame is sharpened once, then the trail and the
+    speed are drawn on top, so that the text stays crisp.
+
+    Parameters:
+    frame (numpy.ndarray): The BGR frame. It is modified in place.
+    prediction_json (dict or None): The prediction result in the JSON format returned by the model,
+                                    or `None` to draw no boxes.
+    speed (float, optional): The speed of the ball in pixels/second. Defaults to None (not drawn).
+    trail (list of tuples, optional): The recent positions of the ball, oldest first. Defaults to None.
+    style (OverlayStyle, optional): The appearance of the annotations. Defaults to `DEFAULT_STYLE`.
+
+    Returns:
+    numpy.ndarray: The annotated BGR frame.
+    """
+    style = style or DEFAULT_STYLE
+    if prediction_json is not None:
+        draw_predictions(frame, prediction_json, style)
+    if style.sharpen:
+        frame = sharpen_image(frame)
+    if trail:
+        draw_trail(frame, trail, style)
+    if speed is not None:
+        draw_speed(frame, speed, style)
+    return frame
+
+
+def render_frames(img_files, prediction_jsons, speeds=None, positions=None, trail_length=0, style=None,
+                  output_folder='annotated_images', indices=None):
+    """
+    Renders the annotated frames of a video from its extracted frames and prediction results.
+
+    Each frame is read once, annotated by `render_frame` and written once to the output folder,
+    under the same file name.
+
+    Parameters:
+    img_files (list of str): The paths of the extracted frames, in order.
+    prediction_jsons (list of dicts): The prediction result of each frame, `None` for a frame whose
+                                      API call failed.
+    speeds (list of float, optional): The speed of the ball in each frame. Defaults to None (not drawn).
+    positions (list of tuples, optional): The position of the ball in each frame, used for the trail.
+                                          Defaults to None.
+    trail_length (int, optional): The number of past positions drawn as a trail. Defaults to 0 (no trail).
+    style (OverlayStyle, optional): The appearance of the annotations. Defaults to `DEFAULT_STYLE`.
+    output_folder (str, optional): The folder the annotated frames are written to. Defaults to 'annotated_images'.
+    indices (range, optional): The indices of the frames to render, the other frames only providing the
+                               trail. Defaults to None (all the frames).
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    if indices is None:
+        indices = range(min(len(img_files), len(prediction_jsons)))
+    total_images = len(indices)
+    for count, index in enumerate(indices):
+        img_file, prediction_json = img_files[index], prediction_jsons[index]
+        speed = speeds[index] if speeds is not None and index < len(speeds) else None
+        trail = None
+        if positions is not None and trail_length > 0:
+            trail = positions[max(0, index - trail_length + 1):index + 1]
+        with metrics.span('jpeg_read'):
+            frame = cv2.imread(img_file)
+        with metrics.span('draw'):
+            frame = render_frame(frame, prediction_json, speed, trail, style)
+        with metrics.span('jpeg_write'):
+            cv2.imwrite(os.path.join(output_folder, os.path.basename(img_file)), frame)
+        metrics.count('frames_rendered')
+        print(f"\rRendering frames: {count + 1}/{total_images} ({(count + 1) / total_images * 100:.2f}%)", end='')
+        sys.stdout.flush()
+    print("\nRendering complete.")
@@ -0,0 +1,128 @@
+import threading
+import cv2
+import numpy as np
+
+from annotate_predictions import LocalPrediction, find_ball_position
+
+
+def predict_search_window(positions, frame_shape, crop_size=320, padding=32):
+    """
+    Predicts the region of a frame in which the ball should be found, from its previous positions.
+
+    The next position is extrapolated at constant velocity from the last two known positions, and
+    a square window is centered on it. The window grows with the speed of the ball, so that a fast
+    ball does not leave it, and is shifted to stay inside the frame.
+
+    Parameters:
+    positions (list of tuples): The most recent known positions (x, y), oldest first.
+    frame_shape (tuple): The shape (height, width, ...) of the frame.
+    crop_size (int, optional): The side of the window for a still ball, in pixels. Defaults to 320.
+    padding (int, optional): The margin added around the extrapolated motion, in pixels. Defaults to 32.
+
+    Returns:
+    tuple or None: The window as (x0, y0, x1, y1) pixel bounds, or `None` if there is no known
+                   position or the window would cover the whole frame.
+    """
+    if not positions:
+        return None
+    height, width = frame_shape[:2]
+    x, y = positions[-1]
+    velocity_x = velocity_y = 0.0
+    if len(positions) > 1:
+        velocity_x = x - positions[-2][0]
+        velocity_y = y - positions[-2][1]
+    center_x = x + velocity_x
+    center_y = y + velocity_y
+    half_width = crop_size / 2 + abs(velocity_x) + padding
+    half_height = crop_size / 2 + abs(velocity_y) + padding
+    if 2 * half_width >= width and 2 * half_height >= height:
+        return None
+
+    crop_width = min(width, int(2 * half_width))
+    crop_height = min(height, int(2 * half_height))
+    x0 = int(min(max(0, center_x - crop_width / 2), width - crop_width))
+    y0 = int(min(max(0, center_y - crop_height / 2), height - crop_height))
+    return x0, y0, x0 + crop_width, y0 + crop_height
+
+
+class RoiModel:
+    """
+    Wraps a detection model so that it is only sent a crop around the expected ball position.
+
+    After the ball has been found, the next frame is cropped to the window predicted by
+    `predict_search_window`, and the coordinates of the detections in the crop are mapped back to
+    the full frame. If the ball is not found in the crop, or has not been found recently, the
+    full frame is sent instead.
+
+    Parameters:
+    model: The detection model to wrap. Its `predict` method must accept an RGB NumPy array.
+    crop_size (int, optional): The side of the search window for a still ball, in pixels. Defaults to 320.
+    padding (int, optional): The margin added around the extrapolated motion, in pixels. Defaults to 32.
+
+    Note:
+    - Only the objects inside the crop are reported, e.g. players outside it are not annotated.
+    - The search window is predicted from the results received so far. When several frames are in
+      flight at once, it is based on slightly older positions and should be given more padding.
+    """
+
+    def __init__(self, model, crop_size=320, padding=32):
+        self.model = model
+        self.crop_size = crop_size
+        self.padding = padding
+        self.crops = 0
+        self.fallbacks = 0
+        self.full_frames = 0
+        self.pixels_sent = 0
+        self._positions = []
+        self._lock = threading.Lock()
+
+    def predict(self, image, confidence=40, overlap=30):
+        if isinstance(image, str):
+            frame = cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2RGB)
+        else:
+            frame = image
+        with self._lock:
+            window = predict_search_window(self._positions, frame.shape, self.crop_size, self.padding)
+
+        prediction_json = None
+        pixels_sent = 0
+        if window is not None:
+            x0, y0, x1, y1 = window
+            crop = np.ascontiguousarray(frame[y0:y1, x0:x1])
+            crop_json = self.model.predict(crop, confidence=confidence, overlap=overlap).json()
+            pixels_sent += (x1 - x0) * (y1 - y0)
+            if find_ball_position(crop_json) is not None:
+                prediction_json = dict(crop_json)
+                prediction_json["predictions"] = [dict(prediction, x=prediction["x"] + x0, y=prediction["y"] + y0)
+                                                  for prediction in crop_json.get("predictions", [])]
+        if prediction_json is None:
+            # No recent position, or the ball left the search window, so the whole frame is searched
+            prediction_json = self.model.predict(frame, confidence=confidence, overlap=overlap).json()
+            pixels_sent += frame.shape[0] * frame.shape[1]
+
+        position = find_ball_position(prediction_json)
+        with self._lock:
+            self._positions = (self._positions + [position])[-2:] if position is not None else []
+            self.pixels_sent += pixels_sent
+            if window is None:
+                self.full_frames += 1
+            elif pixels_sent > (window[2] - window[0]) * (window[3] - window[1]):
+                self.fallbacks += 1
+            else:
+                self.crops += 1
+        return LocalPrediction(prediction_json, image)
+
+    def stats(self):
+        """
+        Returns how the frames were searched.
+
+        Returns:
+        dict: The number of frames found in their crop, of crops that missed and fell back to the
+              full frame, of full-frame searches, and the total number of pixels sent to the model.
+        """
+        return {
+            'crops': self.crops,
+            'fallbacks': self.fallbacks,
+            'full_frames': self.full_frames,
+            'pixels_sent': self.pixels_sent,
+        }
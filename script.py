@@ -1,20 +1,111 @@
 #!/usr/bin/env python3
 
 import argparse
-from main import process_file
+import json
+from metrics import metrics
+from service_client import JOB_OPTIONS, submit_job
 
 """
 This script provides a command-line interface for tracking objects (like balls) in images or videos. 
 It uses the `process_file` function from the `main` module, which requires the Roboflow API.
 
 Usage:
-    python3 script_name.py --path [file_path] --key [roboflow_api_key]
+    python3 script_name.py --path [file_path] --key [roboflow_api_key] [--stream]
+                            [--max-in-flight N] [--rate-limit CALLS_PER_SECOND]
+                            [--cache-dir DIR] [--cache-size MB]
+                            [--stride N] [--max-uncertainty PIXELS] [--stride-report]
+                            [--roi-size PIXELS] [--preprocess-workers N] [--filter-scale SCALE]
+                            [--max-width PIXELS] [--fps FPS] [--crop X:Y:W:H] [--trail N]
+                            [--backend roboflow|onnx] [--onnx-model PATH] [--batch-size N] [--threads N]
+                            [--batch] [--workers N] [--output-dir DIR] [--workdir DIR]
+                            [--decode-limit N] [--inference-limit N] [--render-limit N] [--restart]
+                            [--metrics FILE] [--prometheus-port PORT] [--profile-stage SPAN]
+                            [--profile-mode cprofile|sampling] [--profile-output FILE]
+                            [--segment-seconds SECONDS] [--segment-overlap FRAMES] [--segment-workers N]
+                            [--shared-dir DIR] [--claim-timeout SECONDS]
+                            [--live SOURCE] [--live-output PATH] [--events FILE] [--target-latency SECONDS]
+                            [--live-seconds SECONDS]
+                            [--upload-edge PIXELS] [--upload-quality Q] [--upload-format jpeg|webp]
+                            [--tune-upload N] [--min-recall RECALL]
+                            [--serve] [--host HOST] [--port PORT] [--submit URL]
+                            [--motion-gate] [--min-motion SHARE] [--scene-cuts]
+                            [--associate] [--max-balls N]
 
 Arguments:
 - --path: Specifies the file path of the image or video to be processed. 
           Default value is 'test_video.mov' if not provided.
 - --key:  Specifies the Roboflow API key required for processing the file. 
           Default value is 'dRSyJm9De3EpPn8Krg5w' if not provided.
+- --stream: Processes videos in a single in-memory pass, without intermediate image folders.
+- --max-in-flight: Maximum number of concurrent Roboflow API calls. Default value is 1.
+- --rate-limit: Maximum number of Roboflow API calls started per second. Unlimited if not provided.
+- --cache-dir: Directory in which predictions are cached between runs. No cache if not provided.
+- --cache-size: Maximum size of the prediction cache in megabytes. Default value is 512.
+- --stride: Runs the detector on every Nth video frame only and tracks the ball in between. Default value is 1.
+- --max-uncertainty: Tracking uncertainty, in pixels, above which the detector runs before the next keyframe.
+- --stride-report: Prints the accuracy that larger strides would lose, compared with this run's detections.
+  Not supported with --stride.
+- --roi-size: Sends only a crop of about this size around the expected ball position to the detector.
+- --preprocess-workers: Number of processes applying the bilateral filter to video frames. Default value is 1.
+- --filter-scale: Scale at which video frames are filtered and processed, e.g. 0.5. Default value is 1.
+- --max-width: Downscales wider video frames to this width while decoding. Original size if not provided.
+- --fps: Frame rate to subsample videos to while decoding. Original rate if not provided.
+- --crop: Region X:Y:W:H of the video frames to process, in pixels. Whole frame if not provided.
+- --trail: Number of past ball positions drawn as a trajectory trail on video frames. Default value is 0.
+- --backend: Detector to use, 'roboflow' (hosted API) or 'onnx' (local CPU inference). Default value is 'roboflow'.
+- --onnx-model: Path to the YOLOv8 model exported to ONNX, for the 'onnx' backend.
+- --batch-size: Number of frames per inference run of the 'onnx' backend. Default value is 8.
+- --threads: Number of inference threads of the 'onnx' backend. One per core if not provided.
+- --batch: Processes every image and video of the directory, or listed in the manifest file, given by --path.
+- --workers: Number of files of a batch processed at the same time. Default value is 4.
+- --output-dir: Directory of the annotated files of a batch. Default value is 'outputs'.
+- --workdir: Directory of the scratch workspaces of a batch. Default value is 'batch_workspaces'.
+- --decode-limit, --inference-limit, --render-limit: Maximum number of batch jobs decoding, running
+  the detector and rendering at the same time. Unlimited if not provided.
+- --restart: Processes videos from the start instead of resuming an interrupted run.
+- --metrics: Times every stage, frame and detector call and saves the latencies, counters and a Chrome trace
+  of the spans to this JSON file. No metrics are collected if not provided.
+- --prometheus-port: Collects the same metrics and exports them to Prometheus on this port. Requires
+  the prometheus_client package.
+- --profile-stage: Profiles one span, e.g. 'detect' or 'render'.
+- --profile-mode: 'cprofile' profiles the calls of the thread running the span, 'sampling' samples the
+  stacks of all threads. Default value is 'cprofile'.
+- --profile-output: File the profile is saved to. Default value is '<span>.prof' or '<span>.stacks'.
+- --segment-seconds: Splits a video into segments of this length processed in parallel, and joins them.
+  Not compatible with --stream, --stride, --max-uncertainty, --roi-size, --motion-gate and --associate.
+- --segment-overlap: Number of extra frames processed on each side of a segment. Default value is one
+  second of frames plus half the smoothing window.
+- --segment-workers: Number of processes working on the segments. One per core if not provided.
+- --shared-dir: Directory shared by the workers of several machines processing the same video. A
+  temporary directory if not provided.
+- --claim-timeout: Age in seconds after which the unfinished segment of another machine is taken over.
+- --live: Processes a live source continuously instead of --path: a stream URL (rtsp://, http://...), a
+  capture device number, or a video file played back in real time.
+- --live-output: Video the annotated live frames are saved to. Not saved if not provided.
+- --events: File the JSON event of each live frame is written to, one per line, or '-' for the standard
+  output. Not written if not provided.
+- --target-latency: Age in seconds above which a live frame is skipped instead of detected. Default value is 0.5.
+- --live-seconds: Stops processing the live source after this time. Runs until the source ends if not provided.
+- --upload-edge: Downscales the images uploaded to Roboflow to this long edge, in memory. The detections are
+  mapped back to the original frames. Original size if not provided.
+- --upload-quality: Quality of the uploaded images, from 1 to 100. Default value is 90 when encoding.
+- --upload-format: Format of the uploaded images, 'jpeg' or 'webp'. Default value is 'jpeg'.
+- --tune-upload: Picks the smallest upload encoding that keeps finding the ball on this number of frames
+  sampled from the input, before processing it.
+- --min-recall: Share of the balls found at full quality that the tuned encoding must still find. Default
+  value is 0.95.
+- --serve: Runs a resident inference service that keeps the detector warm and processes the files
+  submitted to it, with --workers files at a time. The detector and cache options apply to all its jobs.
+- --host, --port: Address the inference service listens on. Default values are 127.0.0.1 and 8765.
+- --submit: Sends --path to the inference service at this URL, e.g. http://127.0.0.1:8765, instead of
+  processing it, and prints its events as JSON lines until it is done.
+- --motion-gate: Labels the frames of a video as live play or dead time by frame differencing, and skips the
+  detection of dead frames. Speeds are not interpolated across dead time. Not used with --stream.
+- --min-motion: Share of the pixels that must move for a frame to be live. Default value is 0.005.
+- --scene-cuts: With --motion-gate, also detects scene cuts, which end the live segments.
+- --associate: Chooses the ball of each frame among all the tennis ball detections, as the trajectory that fits
+  best over the whole video, instead of the first detection. Not used with --stream.
+- --max-balls: With --associate, the largest number of balls tracked at once. Default value is 1.
 
 The script takes these arguments and passes them to the `process_file` function for object detection and tracking.
 It's designed to be user-friendly and easily adaptable for different files and API keys.
@@ -23,6 +114,171 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Ball Tracking Command Line Script")
     parser.add_argument("--path", help="File path for input video/image", default="test_video.mov")
     parser.add_argument("--key", help="Your Roboflow API key", default="dRSyJm9De3EpPn8Krg5w")
+    parser.add_argument("--stream", help="Process videos in memory without intermediate image folders",
+                        action="store_true")
+    parser.add_argument("--max-in-flight", help="Maximum number of concurrent API calls", type=int, default=1)
+    parser.add_argument("--rate-limit", help="Maximum number of API calls per second", type=float, default=None)
+    parser.add_argument("--cache-dir", help="Directory for the persistent prediction cache", default=None)
+    parser.add_argument("--cache-size", help="Maximum size of the prediction cache in MB", type=int, default=512)
+    parser.add_argument("--stride", help="Run the detector on every Nth frame only", type=int, default=1)
+    parser.add_argument("--max-uncertainty", help="Tracking uncertainty (px) triggering an early detection",
+                        type=float, default=None)
+    parser.add_argument("--stride-report", help="Report the accuracy lost at larger detection strides",
+                        action="store_true")
+    parser.add_argument("--roi-size", help="Size (px) of the crop sent to the detector around the ball", type=int,
+                        default=None)
+    parser.add_argument("--preprocess-workers", help="Number of processes filtering video frames", type=int,
+                        default=1)
+    parser.add_argument("--filter-scale", help="Scale at which video frames are filtered", type=float, default=1.0)
+    parser.add_argument("--max-width", help="Maximum width (px) of the decoded video frames", type=int, default=None)
+    parser.add_argument("--fps", help="Frame rate to subsample videos to", type=float, default=None)
+    parser.add_argument("--crop", help="Region X:Y:W:H of the video frames to process",
+                        type=lambda value: tuple(int(v) for v in value.split(':')), default=None)
+    parser.add_argument("--trail", help="Number of past ball positions drawn as a trail", type=int, default=0)
+    parser.add_argument("--backend", help="Detector backend", choices=["roboflow", "onnx"], default="roboflow")
+    parser.add_argument("--onnx-model", help="Path to the ONNX model of the onnx backend", default=None)
+    parser.add_argument("--batch-size", help="Frames per inference run of the onnx backend", type=int, default=8)
+    parser.add_argument("--threads", help="Inference threads of the onnx backend", type=int, default=None)
+    parser.add_argument("--batch", help="Process a directory or manifest of files", action="store_true")
+    parser.add_argument("--workers", help="Number of files of a batch processed at once", type=int, default=4)
+    parser.add_argument("--output-dir", help="Directory of the annotated files of a batch", default="outputs")
+    parser.add_argument("--workdir", help="Directory of the workspaces of a batch", default="batch_workspaces")
+    parser.add_argument("--decode-limit", help="Maximum number of batch jobs decoding at once", type=int,
+                        default=None)
+    parser.add_argument("--inference-limit", help="Maximum number of batch jobs running the detector at once",
+                        type=int, default=None)
+    parser.add_argument("--render-limit", help="Maximum number of batch jobs rendering at once", type=int,
+                        default=None)
+    parser.add_argument("--restart", help="Do not resume interrupted videos", action="store_true")
+    parser.add_argument("--metrics", help="JSON file for the stage latencies, counters and trace", default=None)
+    parser.add_argument("--prometheus-port", help="Port exporting the metrics to Prometheus", type=int,
+                        default=None)
+    parser.add_argument("--profile-stage", help="Name of the span to profile", default=None)
+    parser.add_argument("--profile-mode", help="Profiler of the span", choices=["cprofile", "sampling"],
+                        default="cprofile")
+    parser.add_argument("--profile-output", help="File the profile is saved to", default=None)
+    parser.add_argument("--segment-seconds", help="Process videos as parallel segments of this length",
+                        type=float, default=None)
+    parser.add_argument("--segment-overlap", help="Extra frames processed on each side of a segment", type=int,
+                        default=None)
+    parser.add_argument("--segment-workers", help="Number of processes working on the segments", type=int,
+                        default=None)
+    parser.add_argument("--shared-dir", help="Directory shared by the segment workers of several machines",
+                        default=None)
+    parser.add_argument("--claim-timeout", help="Age (s) after which another machine's segment is taken over",
+                        type=float, default=None)
+    parser.add_argument("--live", help="Live source to process: stream URL, device number or video file",
+                        default=None)
+    parser.add_argument("--live-output", help="Video the annotated live frames are saved to", default=None)
+    parser.add_argument("--events", help="File of the JSON events of the live frames, '-' for stdout", default=None)
+    parser.add_argument("--target-latency", help="Age (s) above which a live frame is skipped", type=float,
+                        default=0.5)
+    parser.add_argument("--live-seconds", help="Time (s) after which the live processing stops", type=float,
+                        default=None)
+    parser.add_argument("--upload-edge", help="Long edge (px) of the images uploaded to Roboflow", type=int,
+                        default=None)
+    parser.add_argument("--upload-quality", help="Quality (1-100) of the uploaded images", type=int, default=None)
+    parser.add_argument("--upload-format", help="Format of the uploaded images", choices=["jpeg", "webp"],
+                        default="jpeg")
+    parser.add_argument("--tune-upload", help="Tune the upload encoding on this number of sampled frames",
+                        type=int, default=None)
+    parser.add_argument("--min-recall", help="Share of the balls the tuned upload encoding must find", type=float,
+                        default=0.95)
+    parser.add_argument("--serve", help="Run a resident inference service", action="store_true")
+    parser.add_argument("--host", help="Address the inference service listens on", default="127.0.0.1")
+    parser.add_argument("--port", help="Port the inference service listens on", type=int, default=8765)
+    parser.add_argument("--submit", help="URL of the inference service to send --path to", default=None)
+    parser.add_argument("--motion-gate", help="Skip the detection of frames without motion", action="store_true")
+    parser.add_argument("--min-motion", help="Share of moving pixels from which a frame is live", type=float,
+                        default=0.005)
+    parser.add_argument("--scene-cuts", help="Split the live segments at scene cuts", action="store_true")
+    parser.add_argument("--associate", help="Choose the ball among all the detections as the best trajectory",
+                        action="store_true")
+    parser.add_argument("--max-balls", help="Largest number of balls tracked with --associate", type=int, default=1)
     args = parser.parse_args()
+    # Segments are detected frame by frame, without the options whose result depends on the whole video
+    unsupported = [flag for flag, used in (('--stream', args.stream), ('--stride', args.stride != 1),
+                                           ('--max-uncertainty', args.max_uncertainty is not None),
+                                           ('--stride-report', args.stride_report), ('--roi-size', args.roi_size),
+                                           ('--motion-gate', args.motion_gate), ('--associate', args.associate))
+                   if used]
+    if args.stride_report and args.stride != 1:
+        parser.error("--stride-report compares with the detections of every frame and does not support --stride")
+    if args.segment_seconds and not (args.serve or args.submit or args.live) and unsupported:
+        parser.error(f"--segment-seconds does not support {', '.join(unsupported)}")
 
-    process_file(args.path, args.key)
+    if args.metrics or args.prometheus_port or args.profile_stage:
+        metrics.enable(args.metrics, args.prometheus_port, args.profile_stage, args.profile_mode, args.profile_output)
+
+    options = dict(streaming=args.stream, max_in_flight=args.max_in_flight,
+                   rate_limit=args.rate_limit, cache_dir=args.cache_dir, cache_size_mb=args.cache_size,
+                   detection_stride=args.stride, max_uncertainty=args.max_uncertainty,
+                   stride_report=args.stride_report, roi_size=args.roi_size,
+                   preprocess_workers=args.preprocess_workers, filter_scale=args.filter_scale,
+                   max_width=args.max_width, fps=args.fps, crop=args.crop, trail_length=args.trail,
+                   backend=args.backend, onnx_model=args.onnx_model, batch_size=args.batch_size,
+                   threads=args.threads, resume=not args.restart, motion_gate=args.motion_gate,
+                   min_motion=args.min_motion, scene_cuts=args.scene_cuts, associate=args.associate,
+                   max_balls=args.max_balls)
+    # The pipeline is imported by the modes running it, so that --submit stays a thin client
+    encoder = None
+    if args.upload_edge or args.upload_quality or args.upload_format != 'jpeg':
+        from payload_encoding import PayloadEncoder
+
+        encoder = PayloadEncoder(args.upload_edge, args.upload_quality or 90, args.upload_format)
+    if args.tune_upload and args.backend == 'roboflow':
+        from batch_runner import find_jobs
+        from detectors import create_detector
+        from payload_encoding import sample_frames, tune_encoder
+
+        calibration_file = args.live or (find_jobs(args.path)[0] if args.batch else args.path)
+        detector = create_detector(args.backend, args.key)
+        encoder, _ = tune_encoder(detector, sample_frames(calibration_file, args.tune_upload),
+                                  formats=(args.upload_format,), min_recall=args.min_recall)
+        print("Upload encoding:", encoder if encoder is not None else "original images")
+    options['encoder'] = encoder
+    try:
+        if args.serve:
+            from inference_service import serve
+
+            service_options = {key: value for key, value in options.items() if key not in ('stride_report', 'resume')}
+            serve(args.key, args.host, args.port, workers=args.workers, output_dir=args.output_dir,
+                  workdir=args.workdir, **service_options)
+        elif args.submit:
+            job_options = {key: options[key] for key in JOB_OPTIONS}
+            final_event = submit_job(args.path, args.submit.rstrip('/'), job_options,
+                                     on_event=lambda event: print(json.dumps(event), flush=True))
+            if final_event is None or final_event['event'] != 'done':
+                raise SystemExit(1)
+        elif args.live is not None:
+            from detectors import create_detector
+            from live_stream import process_live_stream
+
+            detector = create_detector(args.backend, args.key, args.onnx_model, args.batch_size, args.threads,
+                                       encoder)
+            process_live_stream(args.live, detector, args.live_output, args.events, args.max_width,
+                                target_latency=args.target_latency, max_in_flight=args.max_in_flight,
+                                rate_limit=args.rate_limit, trail_length=args.trail, max_seconds=args.live_seconds)
+        elif args.segment_seconds:
+            from segment_parallel import process_video_segments
+
+            segment_options = {key: options[key] for key in ('max_in_flight', 'rate_limit', 'cache_dir',
+                                                             'cache_size_mb', 'preprocess_workers', 'filter_scale',
+                                                             'max_width', 'fps', 'crop', 'trail_length', 'backend',
+                                                             'onnx_model', 'batch_size', 'threads', 'encoder')}
+            process_video_segments(args.path, args.key, args.segment_seconds, args.segment_overlap,
+                                   args.segment_workers, args.shared_dir, stale_after=args.claim_timeout,
+                                   **segment_options)
+        elif args.batch:
+            from batch_runner import run_batch
+
+            stage_limits = {'decode': args.decode_limit, 'inference': args.inference_limit,
+                            'render': args.render_limit}
+            run_batch(args.path, args.key, args.workers, args.output_dir, args.workdir, stage_limits, **options)
+        else:
+            from main import process_file
+
+            process_file(args.path, args.key, **options)
+    finally:
+        metrics.print_summary()
+        metrics.close()
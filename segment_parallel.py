@@ -0,0 +1,373 @@
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+import numpy as np
+
+from annotate_predictions import detect_images, find_ball_position
+from create_video import create_video
+from detectors import create_detector
+from extract_frames import extract_frames
+from ffmpeg_reader import probe_video
+from metrics import metrics
+from prediction_cache import CachedModel, PredictionCache
+from render_annotations import render_frames
+from speed_calculations import calculate_windowed_speed
+from trajectory_store import COLUMNS, Trajectory, build_trajectory, save_trajectory
+
+
+def split_segments(frame_count, segment_frames):
+    """
+    Splits the frames of a video into consecutive segments.
+
+    Parameters:
+    frame_count (int): The number of frames of the video.
+    segment_frames (int): The number of frames of each segment. The last segment may be shorter.
+
+    Returns:
+    list of tuples: The (start, end) frame range of each segment, end excluded.
+    """
+    segment_frames = max(1, segment_frames)
+    return [(start, min(start + segment_frames, frame_count)) for start in range(0, frame_count, segment_frames)]
+
+
+def boundary_is_exact(positions, core, extended, frame_count, window_size):
+    """
+    Tells whether the speeds computed for a segment from its extended range are the ones a single pass
+    over the whole video gives.
+
+    The speed of a frame depends on the smoothed positions of the frame and the next one, i.e. on the
+    positions `window_size // 2` frames around them, and an interpolated position depends on the
+    detections on both sides of its gap. Those are all within the extended range unless the overlap is
+    shorter than the smoothing window or a gap next to the segment runs into the edge of the overlap,
+    where the detection closing it is not known.
+
+    Parameters:
+    positions (list of tuples): The detected position of each frame of the extended range, `None` where the
+                                ball was not found, before interpolation.
+    core (tuple): The (start, end) frame range of the segment.
+    extended (tuple): The (start, end) frame range decoded for it, including the overlap frames.
+    frame_count (int): The number of frames of the video.
+    window_size (int): The size of the window used for smoothing positions.
+
+    Returns:
+    bool: True if the speeds of the segment are exact.
+    """
+    half = window_size // 2
+    needed_start, needed_end = core[0] - half, core[1] + half + 1
+    if max(needed_start, 0) < extended[0] or min(needed_end, frame_count) > extended[1]:
+        return False
+    missing = np.array([position is None for position in positions])
+    found = np.nonzero(~missing)[0]
+    first_found = found[0] if len(found) else len(positions)
+    last_found = found[-1] if len(found) else -1
+    last_needed = min(needed_end, frame_count, extended[0] + len(positions))
+    for index in range(max(needed_start, 0) - extended[0], last_needed - extended[0]):
+        if not missing[index]:
+            continue
+        # A gap reaching the start or the end of the overlap may be closed by a detection beyond it
+        if index < first_found and extended[0] > 0:
+            return False
+        if index > last_found and extended[1] < frame_count:
+            return False
+    return True
+
+
+def process_segment(video_path, segment, overlap, frame_count, model, output_path, window_size=10,
+                    max_in_flight=1, rate_limit=None, preprocess_workers=1, filter_scale=1.0, max_width=None,
+                    fps=None, crop=None, trail_length=0, workspace=None):
+    """
+    Processes one segment of a video into its own annotated video file.
+
+    The frames of the segment are decoded with `overlap` frames on each side, all of them are detected,
+    and the speeds are computed over this extended range, so that the gap interpolation and the centered
+    moving average see the same neighbours as in a single pass. Only the frames of the segment itself are
+    rendered and encoded, and their trajectory is saved next to the video of the segment.
+
+    Parameters:
+    video_path (str): The path of the video.
+    segment (tuple): The (start, end) frame range of the segment, end excluded.
+    overlap (int): The number of extra frames decoded and detected on each side of the segment.
+    frame_count (int): The number of frames of the video, at the frame rate `fps` if it is subsampled.
+    model: The detection model.
+    output_path (str): The path of the annotated video of the segment.
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 10.
+    max_in_flight, rate_limit, preprocess_workers, filter_scale, max_width, fps, crop,
+    trail_length: As in `process_file`.
+    workspace (str, optional): The directory of the temporary frames. Defaults to a new temporary directory.
+
+    Returns:
+    dict: The 'start' and 'end' of the segment, whether its speeds are 'exact' (see `boundary_is_exact`),
+          and the 'positions' and 'speeds' of its frames.
+    """
+    start, end = segment
+    extended = (max(0, start - overlap), min(frame_count, end + overlap))
+    with tempfile.TemporaryDirectory(dir=workspace) as scratch:
+        extracted_images = os.path.join(scratch, 'extracted_images')
+        annotated_images = os.path.join(scratch, 'annotated_images')
+        with metrics.span('extract'):
+            fps = extract_frames(video_path, preprocess_workers, filter_scale, max_width, fps, crop,
+                                 output_folder=extracted_images, start_frame=extended[0],
+                                 max_frames=extended[1] - extended[0])
+        with metrics.span('detect'):
+            frame_files, prediction_jsons = detect_images(model, max_in_flight, rate_limit,
+                                                          image_folder=extracted_images)
+        detected_positions = [find_ball_position(p) if p is not None else None for p in prediction_jsons]
+        exact = boundary_is_exact(detected_positions, segment, extended, frame_count, window_size)
+        ball_positions = list(detected_positions)
+        with metrics.span('speed'):
+            ball_speeds = calculate_windowed_speed(ball_positions, fps, window_size)
+
+        core = range(start - extended[0], min(end, extended[0] + len(frame_files)) - extended[0])
+        trajectory = build_trajectory(prediction_jsons, ball_speeds, fps, start_frame=extended[0])
+        save_trajectory(os.path.splitext(output_path)[0] + '.trajectory',
+                        {name: column[core.start:core.stop] for name, column in trajectory.items()})
+        with metrics.span('render'):
+            render_frames(frame_files, prediction_jsons, ball_speeds, ball_positions, trail_length,
+                          output_folder=annotated_images, indices=core)
+        with metrics.span('encode'):
+            create_video(os.path.splitext(output_path)[1], fps, annotated_images, output_path)
+    return {'start': start, 'end': end, 'fps': fps, 'exact': exact,
+            'positions': [ball_positions[index] for index in core], 'speeds': [ball_speeds[index] for index in core]}
+
+
+def _claim_is_stale(claim_path, stale_after):
+    # Tells whether the worker holding a claim is dead: a process of this machine that no longer exists,
+    # or any worker whose claim is older than `stale_after`
+    try:
+        with open(claim_path) as f:
+            host, pid = f.read().split()
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+        return stale_after is not None and time.time() - os.path.getmtime(claim_path) > stale_after
+    except (OSError, ValueError):
+        return False
+
+
+def _claim(claim_path, stale_after):
+    # Creates the claim file of a segment, atomically, so that a single worker processes it
+    try:
+        fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not _claim_is_stale(claim_path, stale_after):
+            return False
+        try:
+            os.remove(claim_path)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(f"{socket.gethostname()} {os.getpid()}\n")
+    return True
+
+
+def _register_job(shared_dir, header):
+    # Records the job the shared directory is used for, refusing to mix the segments of two jobs
+    path = os.path.join(shared_dir, 'job.json')
+    header = json.loads(json.dumps(header))
+    try:
+        with open(path, 'x') as f:
+            json.dump(header, f)
+        return
+    except FileExistsError:
+        pass
+    with open(path) as f:
+        existing = json.load(f)
+    if existing != header:
+        raise ValueError(f"{shared_dir} holds the segments of another video or options, see {path}")
+
+
+def _segment_paths(shared_dir, index, extension):
+    name = os.path.join(shared_dir, f"segment_{index:05d}")
+    return name + '.claim', name + '.json', name + extension
+
+
+def claim_segments(video_path, roboflow_api_key, shared_dir, segments, overlap, frame_count, window_size=10,
+                   stale_after=None, backend='roboflow', onnx_model=None, batch_size=8, threads=None, cache_dir=None,
+                   cache_size_mb=512, encoder=None, **options):
+    """
+    Processes the unclaimed segments of a video until there are none left.
+
+    A worker claims a segment by creating its claim file in the shared directory, which fails if another
+    worker did it first, so several processes, on one or several machines sharing the directory, can
+    work on the same video. The annotated video of a segment and then its result file are written to
+    the shared directory, the result file marking the segment as done.
+
+    Parameters:
+    video_path (str): The path of the video, the same for all the workers.
+    roboflow_api_key (str): The API key for accessing the Roboflow service.
+    shared_dir (str): The directory shared by the workers.
+    segments (list of tuples): The (start, end) frame range of each segment.
+    overlap (int): The number of extra frames processed on each side of a segment.
+    frame_count (int): The number of frames of the video.
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 10.
+    stale_after (float, optional): The age in seconds after which the claim of a segment without a result
+                                   is taken over, e.g. from a crashed machine. It must be longer than the
+                                   processing of a segment. Claims of dead processes of this machine are
+                                   taken over whatever their age. Defaults to None.
+    backend, onnx_model, batch_size, threads, cache_dir, cache_size_mb, encoder: As in `process_file`. Each
+                                                                                 worker creates its own detector.
+    **options: Passed on to `process_segment`.
+
+    Returns:
+    list of int: The indices of the segments processed by this worker.
+    """
+    model = None
+    extension = os.path.splitext(video_path)[1]
+    processed = []
+    for index, segment in enumerate(segments):
+        claim_path, result_path, output_path = _segment_paths(shared_dir, index, extension)
+        if os.path.exists(result_path) or not _claim(claim_path, stale_after):
+            continue
+        if model is None:
+            model = create_detector(backend, roboflow_api_key, onnx_model, batch_size, threads, encoder)
+            if cache_dir:
+                model = CachedModel(model, PredictionCache(cache_dir, cache_size_mb * 1024 * 1024))
+        print(f"\nProcessing segment {index + 1}/{len(segments)}: frames {segment[0]} to {segment[1] - 1}")
+        with metrics.span('segment'):
+            result = process_segment(video_path, segment, overlap, frame_count, model, output_path,
+                                     window_size, **options)
+        # Written under a temporary name and renamed, so that a result file is always complete
+        with open(result_path + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.replace(result_path + '.tmp', result_path)
+        processed.append(index)
+    return processed
+
+
+def concatenate_videos(video_paths, output_path):
+    """
+    Joins videos encoded with the same settings into one, copying their streams without re-encoding.
+
+    Parameters:
+    video_paths (list of str): The videos, in order.
+    output_path (str): The path of the joined video.
+    """
+    output_folder = os.path.dirname(output_path)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        for path in video_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        list_path = f.name
+    try:
+        ffmpeg.input(list_path, format='concat', safe=0).output(output_path, c='copy').overwrite_output().run(
+            quiet=True)
+    finally:
+        os.remove(list_path)
+
+
+def process_video_segments(video_path, roboflow_api_key, segment_seconds=60, overlap=None, workers=None,
+                           shared_dir=None, output_path=None, window_size=10, stale_after=None,
+                           wait=True, **options):
+    """
+    Processes a long video as independent time segments in parallel, and joins the annotated segments.
+
+    Each segment is processed with `overlap` extra frames on each side (see `process_segment`), so the
+    speeds at its boundaries are the ones a single pass gives, and the annotated segments are joined
+    without re-encoding, as are their trajectories (see `trajectory_store`). The segments are shared out through claim files in `shared_dir` (see
+    `claim_segments`): running the same command on other machines sharing the directory adds workers.
+
+    Parameters:
+    video_path (str): The path of the video.
+    roboflow_api_key (str): The API key for accessing the Roboflow service.
+    segment_seconds (float, optional): The length of each segment in seconds. Defaults to 60.
+    overlap (int, optional): The number of extra frames processed on each side of a segment. Longer gaps
+                             in the detections at a boundary make its speeds inexact. Defaults to one
+                             second of frames plus half the smoothing window.
+    workers (int, optional): The number of processes working on the segments on this machine. Defaults to
+                             the number of CPU cores.
+    shared_dir (str, optional): The directory of the claim files, results and annotated segments, which is
+                                kept, so that an interrupted run resumes from the finished segments. It
+                                must be used for a single video. Defaults to None (a temporary directory,
+                                removed at the end, for workers on this machine only).
+    output_path (str, optional): The path of the annotated video. Defaults to 'outputs/output_video' with
+                                 the original format.
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 10.
+    stale_after (float, optional): The age in seconds after which an unfinished claim of another machine is
+                                   taken over (see `claim_segments`). Defaults to None (never).
+    wait (bool, optional): If True, waits for the segments claimed by other machines before joining them.
+                           Defaults to True.
+    **options: Passed on to `claim_segments`, e.g. `backend`, `max_in_flight` or `trail_length`.
+
+    Returns:
+    dict: The 'output' path, or None if segments were missing, whether all the speeds are 'exact', and
+          the result of each segment, with its frame range, 'positions' and 'speeds', in 'segments'.
+
+    Note:
+    - Frames are detected independently of each other, without the detection stride or the region of
+      interest of `process_file`, whose tracking would depend on where a segment starts.
+    - The wall time depends on the number of workers rather than on the length of the video, as long as
+      there are at least as many segments as workers.
+    """
+    info = probe_video(video_path)
+    fps, frame_count = info['fps'], info['frame_count']
+    if options.get('fps') is not None and options['fps'] < fps:
+        # Segments are counted in the frames of the subsampled video, as `FFmpegFrameReader` produces them
+        frame_count = int(frame_count * options['fps'] / fps)
+        fps = options['fps']
+    if overlap is None:
+        overlap = math.ceil(fps) + window_size // 2 + 1
+    segments = split_segments(frame_count, int(round(segment_seconds * fps)))
+    extension = os.path.splitext(video_path)[1]
+    output_path = output_path or os.path.join('outputs', 'output_video' + extension)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(segments)))
+    if shared_dir is None:
+        with tempfile.TemporaryDirectory() as shared_dir:
+            return process_video_segments(video_path, roboflow_api_key, segment_seconds, overlap, workers,
+                                          shared_dir, output_path, window_size, stale_after, wait, **options)
+    os.makedirs(shared_dir, exist_ok=True)
+    header = {'video': os.path.basename(video_path), 'size': os.path.getsize(video_path), 'frames': frame_count,
+              'segments': segments, 'overlap': overlap, 'window_size': window_size,
+              'options': {key: options.get(key) for key in ('filter_scale', 'max_width', 'fps', 'crop',
+                                                            'trail_length', 'backend', 'onnx_model')},
+              'encoder': getattr(options.get('encoder'), 'key', None)}
+    _register_job(shared_dir, header)
+    print(f"Processing {len(segments)} segments of {frame_count} frames with {workers} workers...")
+
+    arguments = (video_path, roboflow_api_key, shared_dir, segments, overlap, frame_count, window_size, stale_after)
+    if workers == 1:
+        claim_segments(*arguments, **options)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(claim_segments, *arguments, **options) for _ in range(workers)]:
+                future.result()
+
+    paths = [_segment_paths(shared_dir, index, extension) for index in range(len(segments))]
+    while wait and not all(os.path.exists(result_path) for _, result_path, _ in paths):
+        time.sleep(1.0)
+        # Taking over the segments of workers that died meanwhile
+        claim_segments(*arguments, **options)
+    if not all(os.path.exists(result_path) for _, result_path, _ in paths):
+        print("\nSegments are still being processed by other workers")
+        return {'output': None, 'exact': None, 'segments': None}
+
+    results = []
+    for _, result_path, _ in paths:
+        with open(result_path) as f:
+            results.append(json.load(f))
+    concatenate_videos([video for _, _, video in paths], output_path)
+    trajectories = [Trajectory(os.path.splitext(video)[0] + '.trajectory') for _, _, video in paths]
+    save_trajectory(os.path.splitext(output_path)[0] + '.trajectory',
+                    {name: np.concatenate([trajectory[name] for trajectory in trajectories]) for name in COLUMNS},
+                    source=os.path.abspath(video_path), fps=fps, window_size=window_size)
+    inexact = [result for result in results if not result['exact']]
+    for result in inexact:
+        print(f"Warning: a detection gap at frame {result['start']} or {result['end']} is longer than the overlap, "
+              "so the speeds there may differ from a single pass")
+    print(f"\nJoined {len(segments)} segments into {output_path}")
+    sys.stdout.flush()
+    return {'output': output_path, 'exact': not inexact, 'segments': results}
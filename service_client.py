@@ -0,0 +1,46 @@
+import json
+import os
+
+# The options of `process_file` that a submitted job may set, the detector being shared by all the jobs
+JOB_OPTIONS = ('streaming', 'max_in_flight', 'rate_limit', 'detection_stride', 'max_uncertainty', 'filter_scale',
+               'max_width', 'fps', 'crop', 'trail_length', 'motion_gate', 'min_motion', 'scene_cuts',
+               'associate', 'max_balls')
+
+# The events ending the stream of a job
+FINAL_EVENTS = ('done', 'failed')
+
+
+def submit_job(path, url='http://127.0.0.1:8765', options=None, output_path=None, on_event=None):
+    """
+    Submits a file to a running inference service and follows its events until the job ends.
+
+    Parameters:
+    path (str): The path of the image or video. It is sent as an absolute path, so the service must be
+                able to read it, e.g. by running on the same machine.
+    url (str, optional): The address of the service. Defaults to 'http://127.0.0.1:8765'.
+    options (dict, optional): Options of `process_file` for this job, among `JOB_OPTIONS`. Defaults to None.
+    output_path (str, optional): The path of the annotated file, on the service's side. Defaults to None.
+    on_event (callable, optional): Called with each event of the job. Defaults to None.
+
+    Returns:
+    dict: The last event of the job, 'done' or 'failed'.
+    """
+    import requests
+
+    with requests.Session() as session:
+        response = session.post(f"{url}/jobs", json={'path': os.path.abspath(path), 'options': options or {},
+                                                     'output': output_path})
+        if response.status_code == 400:
+            raise ValueError(response.json()['error'])
+        response.raise_for_status()
+        job_id = response.json()['id']
+        last_event = None
+        with session.get(f"{url}/jobs/{job_id}/events", stream=True) as events:
+            events.raise_for_status()
+            for line in events.iter_lines():
+                if not line:
+                    continue
+                last_event = json.loads(line)
+                if on_event is not None:
+                    on_event(last_event)
+    return last_event
@@ -1,3 +1,4 @@
+import collections
 import math
 import numpy as np
 
@@ -34,6 +35,150 @@ def interpolate_position(prev_position, next_position, steps, step):
     return prev_position[0] + delta_x * step, prev_position[1] + delta_y * step
 
 
+def positions_to_array(positions):
+    """
+    Converts a list of positions to an array, missing positions becoming NaN.
+
+    Parameters:
+    positions (list of tuples): Positions (x, y), or `None` where the object was not found.
+
+    Returns:
+    numpy.ndarray: An (N, 2) float array.
+    """
+    array = np.full((len(positions), 2), np.nan)
+    for i, position in enumerate(positions):
+        if position is not None:
+            array[i] = position
+    return array
+
+
+def array_to_positions(array):
+    """
+    Converts an (N, 2) array of positions back to a list of tuples, NaN rows becoming `None`.
+    """
+    return [None if np.isnan(x) or np.isnan(y) else (float(x), float(y)) for x, y in array.tolist()]
+
+
+def interpolate_gaps(positions):
+    """
+    Fills the missing positions lying between two known positions by linear interpolation.
+
+    Parameters:
+    positions (numpy.ndarray): An (..., N, 2) array of positions, with NaN rows for missing positions.
+                               Leading dimensions hold independent trajectories.
+
+    Returns:
+    numpy.ndarray: A copy of the positions with the gaps filled. Missing positions before the first
+                   or after the last known position stay NaN.
+
+    Note:
+    - A gap between known frames a and b is filled as if the next position was reached at frame b + 1,
+      i.e. frame k gets p[a] + (p[b] - p[a]) * (k - a) / (b - a + 1), as `interpolate_position` does.
+    """
+    positions = np.array(positions, dtype=float)
+    valid = ~np.isnan(positions).any(axis=-1)
+    index = np.arange(valid.shape[-1])
+    previous = np.maximum.accumulate(np.where(valid, index, -1), axis=-1)
+    following = np.flip(np.minimum.accumulate(np.flip(np.where(valid, index, valid.shape[-1]), axis=-1), axis=-1),
+                        axis=-1)
+    gaps = ~valid & (previous >= 0) & (following < valid.shape[-1])
+    if not gaps.any():
+        return positions
+
+    batch = np.nonzero(gaps)
+    k = batch[-1]
+    a = previous[gaps]
+    b = following[gaps]
+    start = positions[batch[:-1] + (a,)]
+    end = positions[batch[:-1] + (b,)]
+    delta = (end - start) / (b - a + 1)[:, None]
+    positions[gaps] = start + delta * (k - a)[:, None]
+    return positions
+
+
+def smooth_array(positions, window_size):
+    """
+    Smooths positions with a centered moving average ignoring missing positions.
+
+    Parameters:
+    positions (numpy.ndarray): An (..., N, 2) array of positions, with NaN rows for missing positions.
+    window_size (int): The size of the moving window used for averaging. Each position is averaged with
+                       the `window_size // 2` positions on each side of it.
+
+    Returns:
+    numpy.ndarray: The smoothed positions, NaN where the whole window is missing.
+    """
+    positions = np.asarray(positions, dtype=float)
+    if positions.shape[-2] == 0:
+        return positions.copy()
+    half = window_size // 2
+    missing = np.isnan(positions)
+    present = (~missing).astype(float)
+    # The positions are centered on their mean, so that the running sums stay small and lose no precision
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center = np.nan_to_num(np.nansum(positions, axis=-2, keepdims=True) / present.sum(axis=-2, keepdims=True))
+    values = np.where(missing, 0.0, positions - center)
+    # Box filter in O(N): running sums, padded with `half + 1` zeros in front and `half` behind, whose
+    # differences `2 * half + 1` apart are the sums over each window
+    pad = [(0, 0)] * (positions.ndim - 2) + [(half + 1, half), (0, 0)]
+    sums = np.cumsum(np.pad(values, pad), axis=-2)
+    counts = np.cumsum(np.pad(present, pad), axis=-2)
+    width = 2 * half + 1
+    sums = sums[..., width:, :] - sums[..., :-width, :]
+    counts = counts[..., width:, :] - counts[..., :-width, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts + center, np.nan)
+
+
+def frame_speeds(smoothed_positions, fps):
+    """
+    Computes the speed between each frame and the next one.
+
+    Parameters:
+    smoothed_positions (numpy.ndarray): An (..., N, 2) array of positions, with NaN rows for missing positions.
+    fps (float): The frame rate of the video.
+
+    Returns:
+    numpy.ndarray: An (..., N) array of speeds in pixels/second. The speed is 0 for the last frame and
+                   wherever one of the two positions is missing.
+    """
+    time_interval = 1 / fps
+    steps = np.diff(smoothed_positions, axis=-2)
+    speeds = np.zeros(smoothed_positions.shape[:-1])
+    speeds[..., :-1] = np.hypot(steps[..., 0], steps[..., 1]) / time_interval
+    return np.nan_to_num(speeds, nan=0.0)
+
+
+def windowed_speed_array(positions, fps, window_size):
+    """
+    Array version of `calculate_windowed_speed`, for one or many trajectories at once.
+
+    Parameters:
+    positions (numpy.ndarray): An (..., N, 2) array of positions, with NaN rows for missing positions.
+    fps (float): The frame rate of the video.
+    window_size (int): The size of the window used for smoothing positions.
+
+    Returns:
+    tuple: The (..., N) array of speeds and the (..., N, 2) array of interpolated positions.
+    """
+    interpolated = interpolate_gaps(positions)
+    return frame_speeds(smooth_array(interpolated, window_size), fps), interpolated
+
+
+def live_runs(live_mask):
+    """
+    Splits a mask of live frames into runs.
+
+    Parameters:
+    live_mask (array-like of bool): True for the live frames.
+
+    Returns:
+    list of tuples: The (start, end) frame range of each run of live frames, end excluded.
+    """
+    edges = np.diff(np.concatenate([[0], np.asarray(live_mask, dtype=np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+
 def smooth_positions(positions, window_size):
     """
     Smooth a sequence of positions using a moving average.
@@ -45,22 +190,10 @@ def smooth_positions(positions, window_size):
     Returns:
     list of tuples: The smoothed positions.
     """
-    # Apply a simple moving average to smooth the positions
-    smoothed_positions = []
-    for i in range(len(positions)):
-        start = max(0, i - window_size // 2)
-        end = min(len(positions), i + window_size // 2 + 1)
-        window_positions = [p for p in positions[start:end] if p is not None]
-        if window_positions:
-            avg_x = np.mean([p[0] for p in window_positions])
-            avg_y = np.mean([p[1] for p in window_positions])
-            smoothed_positions.append((avg_x, avg_y))
-        else:
-            smoothed_positions.append(None)
-    return smoothed_positions
+    return array_to_positions(smooth_array(positions_to_array(positions), window_size))
 
 
-def calculate_windowed_speed(ball_positions, fps, window_size):
+def calculate_windowed_speed(ball_positions, fps, window_size, live_mask=None):
     """
     Calculate the speed of an object in each frame of a video.
 
@@ -68,36 +201,167 @@ def calculate_windowed_speed(ball_positions, fps, window_size):
     the speed for each frame based on the positions of the object.
 
     Parameters:
-    ball_positions (list of tuples): The positions of the object in each frame.
+    ball_positions (list of tuples): The positions of the object in each frame. Interpolated
+                                     positions are written back into this list.
     fps (float): The frame rate of the video.
     window_size (int): The size of the window used for smoothing positions.
+    live_mask (array-like of bool, optional): False for the frames of dead time, e.g. labelled by
+                                              `motion_gate.gate_frames`. Each run of live frames is processed
+                                              on its own: positions are neither interpolated nor smoothed
+                                              across dead time, whose speeds are 0. Defaults to None (all
+                                              frames are live).
 
     Returns:
     list of floats: The speed of the object in each frame.
     """
-    # Interpolation for missing positions
-    for i in range(1, len(ball_positions)):
-        if ball_positions[i] is None and ball_positions[i - 1] is not None:
-            for j in range(i + 1, len(ball_positions)):
-                if ball_positions[j] is not None:
-                    for k in range(i, j):
-                        ball_positions[k] = interpolate_position(ball_positions[i - 1], ball_positions[j], j - i + 1,
-                                                                 k - i + 1)
-                    break
-
-        # Smoothing positions
-    smoothed_positions = smooth_positions(ball_positions, window_size)
-
-    # Initialize speeds list
-    speeds = [0] * len(ball_positions)
-    time_interval = 1 / fps
+    positions = positions_to_array(ball_positions)
+    if live_mask is None:
+        speeds, interpolated = windowed_speed_array(positions, fps, window_size)
+    else:
+        speeds = np.zeros(len(positions))
+        interpolated = np.full(positions.shape, np.nan)
+        for start, end in live_runs(live_mask):
+            speeds[start:end], interpolated[start:end] = windowed_speed_array(positions[start:end], fps,
+                                                                              window_size)
+    for i, position in enumerate(ball_positions):
+        if position is None and not np.isnan(interpolated[i, 0]):
+            ball_positions[i] = (float(interpolated[i, 0]), float(interpolated[i, 1]))
+    return speeds.tolist()
 
-    # Speed calculation for each frame
-    for i in range(len(smoothed_positions) - 1):
-        if smoothed_positions[i] and smoothed_positions[i + 1]:
-            distance = calculate_distance(smoothed_positions[i], smoothed_positions[i + 1])
-            speeds[i] = distance / time_interval
-        else:
-            speeds[i] = 0
 
-    return speeds
+class OnlineSpeedEstimator:
+    """
+    Computes the same speeds as `calculate_windowed_speed`, one frame at a time, for live processing.
+
+    Positions are pushed as soon as each frame has been detected, and the speed of a frame is emitted
+    once the positions it depends on are known. Each push costs O(1), whatever the length of the video:
+    the moving average is kept as running sums over a ring buffer of `window_size // 2 * 2 + 1`
+    positions, and at most `max_gap` missing positions wait for interpolation.
+
+    Parameters:
+    fps (float): The frame rate of the video.
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 10.
+    max_gap (int, optional): The longest run of missing positions that is interpolated. A longer gap is
+                             left without positions, where `calculate_windowed_speed` would bridge it.
+                             Defaults to 30.
+
+    Note:
+    - The speed of frame k is emitted at the latest when frame k + `delay` is pushed, with
+      `delay = max_gap + window_size // 2 + 1`. It is emitted earlier when no gap is pending.
+    - Apart from gaps longer than `max_gap`, the speeds are the ones `calculate_windowed_speed`
+      returns for the whole video.
+    """
+
+    def __init__(self, fps, window_size=10, max_gap=30):
+        self.time_interval = 1 / fps
+        self.half = window_size // 2
+        self.max_gap = max_gap
+        self.delay = max_gap + self.half + 1
+        self._pushed = 0
+        self._last_known = None
+        self._gap = 0
+        self._resolved = 0
+        self._window = collections.deque()
+        self._sum_x = 0.0
+        self._sum_y = 0.0
+        self._count = 0
+        self._smoothed = 0
+        self._previous_smoothed = None
+
+    def push(self, position):
+        """
+        Adds the position of the next frame.
+
+        Parameters:
+        position (tuple or None): The detected (x, y) position, or `None` if the ball was not found.
+
+        Returns:
+        list of tuples: The (frame index, speed) pairs that became available, in frame order.
+        """
+        self._pushed += 1
+        speeds = []
+        if position is None:
+            if self._last_known is None:
+                # Missing positions before the first detection are never interpolated
+                speeds += self._resolve(None)
+            else:
+                self._gap += 1
+                if self._gap > self.max_gap:
+                    speeds += self._abandon_gap()
+            return speeds
+
+        if self._gap:
+            last_index, last_position = self._last_known
+            # Same step formula as `interpolate_position`
+            steps = self._pushed - last_index
+            delta_x = (position[0] - last_position[0]) / steps
+            delta_y = (position[1] - last_position[1]) / steps
+            for step in range(1, self._gap + 1):
+                speeds += self._resolve((last_position[0] + delta_x * step, last_position[1] + delta_y * step))
+            self._gap = 0
+        self._last_known = (self._pushed - 1, position)
+        speeds += self._resolve(position)
+        return speeds
+
+    def flush(self):
+        """
+        Emits the speeds of all the remaining frames, once the last frame has been pushed.
+
+        Returns:
+        list of tuples: The remaining (frame index, speed) pairs, in frame order.
+        """
+        # Missing positions after the last detection are never interpolated
+        speeds = self._abandon_gap()
+        while self._smoothed < self._resolved:
+            self._evict(self._smoothed - self.half)
+            speeds += self._smooth()
+        if self._resolved:
+            speeds.append((self._resolved - 1, 0.0))
+        self._previous_smoothed = None
+        return speeds
+
+    def _abandon_gap(self):
+        speeds = []
+        for _ in range(self._gap):
+            speeds += self._resolve(None)
+        self._gap = 0
+        self._last_known = None
+        return speeds
+
+    def _resolve(self, position):
+        # Adds the final position of the next frame to the moving window
+        self._window.append(position)
+        if position is not None:
+            self._sum_x += position[0]
+            self._sum_y += position[1]
+            self._count += 1
+        self._resolved += 1
+        k = self._resolved - 1 - self.half
+        if k < 0:
+            return []
+        self._evict(k - self.half)
+        return self._smooth()
+
+    def _evict(self, first_index):
+        # Drops the positions before `first_index` from the moving window
+        while len(self._window) > self._resolved - max(0, first_index):
+            position = self._window.popleft()
+            if position is not None:
+                self._sum_x -= position[0]
+                self._sum_y -= position[1]
+                self._count -= 1
+                if self._count == 0:
+                    self._sum_x = self._sum_y = 0.0
+
+    def _smooth(self):
+        # Smooths the next frame and emits the speed of the frame before it
+        smoothed = (self._sum_x / self._count, self._sum_y / self._count) if self._count else None
+        self._smoothed += 1
+        previous, self._previous_smoothed = self._previous_smoothed, smoothed
+        if self._smoothed < 2:
+            return []
+        if previous is not None and smoothed is not None:
+            speed = calculate_distance(previous, smoothed) / self.time_interval
+        else:
+            speed = 0.0
+        return [(self._smoothed - 2, speed)]
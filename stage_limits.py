@@ -0,0 +1,44 @@
+import contextlib
+import threading
+import time
+
+from metrics import metrics
+
+
+class StageLimiter:
+    """
+    Limits how many jobs run each stage of the pipeline at the same time.
+
+    Jobs running concurrently compete for different resources at different stages: decoding and
+    rendering are bound by the CPU, while inference mostly waits on the network. Giving each stage
+    its own limit lets, e.g., many jobs wait on API calls while only a few decode at once.
+
+    Parameters:
+    limits (dict, optional): The maximum number of concurrent jobs of each stage, by stage name. Stages
+                             that are not listed, or with a limit of None, are not limited. Defaults to None.
+
+    The stages of `process_file` are 'decode' (frame extraction), 'inference' (detection, or the whole
+    single-pass processing of `process_video_stream`) and 'render' (drawing and encoding).
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {name: limit for name, limit in (limits or {}).items() if limit}
+        self._semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in self.limits.items()}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Waits until the stage `name` has a free slot and holds it for the duration of the `with` block.
+        """
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        start = time.perf_counter()
+        with semaphore:
+            metrics.observe(f'wait_{name}', time.perf_counter() - start)
+            yield
+
+
+# A limiter without limits, used when a single job runs
+NO_LIMITS = StageLimiter()
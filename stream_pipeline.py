@@ -0,0 +1,308 @@
+import collections
+import os
+import queue
+import sys
+import threading
+import cv2
+import imageio
+
+from annotate_predictions import find_ball_position, predict_frames, tracked_prediction_json
+from ffmpeg_reader import FFmpegFrameReader
+from inference_dispatcher import InferenceDispatcher
+from keyframe_tracking import KeyframeTracker
+from metrics import metrics
+from parallel_preprocess import filter_frames
+from render_annotations import render_frame
+from speed_calculations import OnlineSpeedEstimator
+from trajectory_store import build_trajectory, save_trajectory
+
+# Marker put on a queue by a stage once it has no more items to produce
+_END_OF_STREAM = object()
+
+
+def _put(stage_queue, item, stop_event):
+    """
+    Puts an item on a bounded queue, giving up once the pipeline has been stopped.
+
+    Parameters:
+    stage_queue (queue.Queue): The queue to put the item on.
+    item: The item to put on the queue.
+    stop_event (threading.Event): Set when the pipeline is shutting down.
+
+    Returns:
+    bool: True if the item was queued, False if the pipeline was stopped first.
+    """
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _iterate_queue(stage_queue, stop_event):
+    """
+    Yields the items of a queue until the upstream stage signals the end of the stream.
+
+    Parameters:
+    stage_queue (queue.Queue): The queue to read from.
+    stop_event (threading.Event): Set when the pipeline is shutting down.
+    """
+    while not stop_event.is_set():
+        try:
+            item = stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END_OF_STREAM:
+            return
+        yield item
+
+
+def _run_stage(stage, items, out_queue, stop_event, errors):
+    """
+    Runs a single pipeline stage, forwarding everything it produces to the next queue.
+
+    Any exception raised by the stage is recorded and stops the whole pipeline, so that
+    neither the upstream nor the downstream stages block forever on their queues.
+    """
+    try:
+        for item in stage(items):
+            if not _put(out_queue, item, stop_event):
+                break
+    except BaseException as e:
+        errors.append(e)
+        stop_event.set()
+    finally:
+        _put(out_queue, _END_OF_STREAM, stop_event)
+
+
+def run_pipeline(source, stages, queue_size=8):
+    """
+    Connects a frame source and a sequence of stages with bounded queues, one thread per stage.
+
+    Parameters:
+    source (iterable): The items fed into the first stage, e.g. a frame generator.
+    stages (list of callables): Each stage takes an iterable of items and returns a generator
+                                of transformed items.
+    queue_size (int, optional): The maximum number of items waiting between two stages. Defaults to 8.
+
+    Yields:
+    The items produced by the last stage, in order.
+
+    Note:
+    - The number of items alive at any time is bounded by the queue sizes (plus whatever a stage
+      buffers internally), independently of the length of the source.
+    - An exception raised by any stage stops the pipeline and is re-raised to the caller.
+    """
+    stop_event = threading.Event()
+    errors = []
+    threads = []
+    items = source
+    for stage in [lambda upstream: upstream] + list(stages):
+        out_queue = queue.Queue(maxsize=queue_size)
+        thread = threading.Thread(target=_run_stage, args=(stage, items, out_queue, stop_event, errors),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+        items = _iterate_queue(out_queue, stop_event)
+    try:
+        yield from items
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def read_video_frames(reader, workers=1, filter_scale=1.0):
+    """
+    Decodes a video and applies a bilateral filter to each frame, without writing anything to disk.
+
+    Parameters:
+    reader (FFmpegFrameReader): The reader decoding the video.
+    workers (int, optional): The number of processes applying the bilateral filter. Defaults to 1.
+    filter_scale (float, optional): The scale at which frames are filtered. Defaults to 1.
+
+    Yields:
+    tuple: The frame index and the filtered frame as a BGR NumPy array.
+    """
+    # Applying bilateral filter to each frame. The filter copies each frame out of the reader's
+    # buffers, so the yielded frames can be kept by the later stages.
+    yield from enumerate(filter_frames(reader, workers, filter_scale))
+
+
+def detect_stage(model, dispatcher, detection_stride=1, max_uncertainty=None):
+    """
+    Creates a stage that runs the detector on each in-memory frame.
+
+    Parameters:
+    model: The detection model. Its `predict` method must accept an RGB NumPy array. Models with a
+           `batch_size` above 1 are given batches of frames (see `predict_frames`).
+    dispatcher (InferenceDispatcher): Runs the model calls concurrently, in frame order.
+    detection_stride (int, optional): Runs the model on every `detection_stride`-th frame only, the frames
+                                      in between being filled by a `KeyframeTracker`. Defaults to 1.
+    max_uncertainty (float, optional): With a stride, the tracking uncertainty in pixels above which the
+                                       model runs before the next keyframe. Defaults to None.
+
+    Returns:
+    callable: A stage mapping (index, frame) items to (index, frame, prediction_json) items.
+              A frame whose API call failed gets an empty prediction, so that the frames
+              stay aligned with their positions.
+    """
+    def predict(item):
+        rgb_frame = cv2.cvtColor(item[1], cv2.COLOR_BGR2RGB)
+        return model.predict(rgb_frame, confidence=40, overlap=30).json()
+
+    def stage(items):
+        # The dispatcher returns results in input order, so the submitted frames are matched
+        # with their results by keeping them in a FIFO
+        submitted = collections.deque()
+
+        def submit(items):
+            for item in items:
+                submitted.append(item)
+                yield cv2.cvtColor(item[1], cv2.COLOR_BGR2RGB)
+
+        for prediction_json in predict_frames(model, dispatcher, submit(items)):
+            index, frame = submitted.popleft()
+            yield index, frame, prediction_json if prediction_json is not None else {"predictions": []}
+
+    def tracking_stage(items):
+        # Each tracking step depends on the previous one, so the keyframes are detected one at a time
+        tracker = KeyframeTracker(detection_stride, max_uncertainty)
+        for index, frame in items:
+            detection = {"json": None}
+
+            def detect():
+                detection["json"] = dispatcher.call(predict, (index, frame)) or {"predictions": []}
+                return find_ball_position(detection["json"])
+
+            position, detected = tracker.step(index, frame, detect)
+            yield index, frame, detection["json"] if detected else tracked_prediction_json(position)
+    return tracking_stage if detection_stride > 1 else stage
+
+
+def speed_stage(fps, window_size, max_gap):
+    """
+    Creates a stage that attaches the ball speed to each frame.
+
+    Speeds are computed by an `OnlineSpeedEstimator`, so each frame is held back only until its
+    speed is known, at most `max_gap + window_size // 2 + 1` frames.
+
+    Parameters:
+    fps (float): The frame rate of the video.
+    window_size (int): The size of the window used for smoothing positions.
+    max_gap (int): The longest run of frames without detection that is interpolated, as in a
+                   full-video run. Longer gaps are not bridged.
+
+    Returns:
+    callable: A stage mapping (index, frame, prediction_json) items to
+              (index, frame, prediction_json, speed) items.
+    """
+    def stage(items):
+        estimator = OnlineSpeedEstimator(fps, window_size, max_gap)
+        pending = collections.deque()
+        for index, frame, prediction_json in items:
+            pending.append((index, frame, prediction_json))
+            for _, speed in estimator.push(find_ball_position(prediction_json)):
+                yield pending.popleft() + (speed,)
+        for _, speed in estimator.flush():
+            yield pending.popleft() + (speed,)
+    return stage
+
+
+def render_stage(style=None, trail_length=0, records=None):
+    """
+    Creates a stage that draws the detections and the speed onto each frame with `render_frame`
+    and converts it to RGB for encoding.
+
+    Parameters:
+    style (OverlayStyle, optional): The appearance of the annotations. Defaults to the default style.
+    trail_length (int, optional): The number of past ball positions drawn as a trail. Defaults to 0 (no trail).
+    records (list, optional): Receives the prediction result and the speed of each frame. Defaults to None.
+
+    Returns:
+    callable: A stage mapping (index, frame, prediction_json, speed) items to annotated RGB frames.
+    """
+    def stage(items):
+        trail = collections.deque(maxlen=max(1, trail_length))
+        for index, frame, prediction_json, speed in items:
+            if records is not None:
+                records.append((prediction_json, speed))
+            trail.append(find_ball_position(prediction_json))
+            with metrics.span('draw'):
+                annotated = render_frame(frame, prediction_json, speed, trail if trail_length > 0 else None, style)
+            yield cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
+    return stage
+
+
+def process_video_stream(video_path, model, original_format, window_size=10, max_gap=30, queue_size=8,
+                         dispatcher=None, detection_stride=1, max_uncertainty=None, preprocess_workers=1,
+                         filter_scale=1.0, max_width=None, fps=None, crop=None, style=None, trail_length=0,
+                         output_path=None, trajectory_path=None):
+    """
+    Processes a video in a single streaming pass, from decoding to the encoded annotated video.
+
+    Parameters:
+    video_path (str): The path of the video to process.
+    model: The detection model. Its `predict` method must accept an RGB NumPy array.
+    original_format (str): The file extension for the output video file.
+    window_size (int, optional): The size of the window used for smoothing positions. Defaults to 10.
+    max_gap (int, optional): The longest run of frames without detection that is interpolated. Defaults to 30.
+    queue_size (int, optional): The maximum number of frames waiting between two stages. Defaults to 8.
+    dispatcher (InferenceDispatcher, optional): Runs the model calls. Defaults to a dispatcher making
+                                                one call at a time.
+    detection_stride (int, optional): Runs the model on every `detection_stride`-th frame only. Defaults to 1.
+    max_uncertainty (float, optional): With a stride, the tracking uncertainty in pixels above which the
+                                       model runs before the next keyframe. Defaults to None.
+    preprocess_workers (int, optional): The number of processes applying the bilateral filter. Defaults to 1.
+    filter_scale (float, optional): The scale at which frames are filtered and processed. Defaults to 1.
+    max_width (int, optional): Frames wider than this are downscaled to this width when decoded. Defaults to None.
+    fps (float, optional): The frame rate to subsample the video to when decoding. Defaults to None.
+    crop (tuple, optional): The (x, y, width, height) region of the frames to keep. Defaults to None.
+    style (OverlayStyle, optional): The appearance of the annotations. Defaults to the default style.
+    trail_length (int, optional): The number of past ball positions drawn as a trail. Defaults to 0 (no trail).
+    output_path (str, optional): The path of the video file to create. Defaults to 'outputs/output_video'
+                                 with the original format.
+    trajectory_path (str, optional): The directory the trajectory of the ball is saved to (see
+                                     `trajectory_store.save_trajectory`). Defaults to None (not saved).
+
+    Frames travel between the decode, detection, speed, render and encode stages as NumPy arrays
+    through bounded queues, so the video is decoded once and encoded once and no intermediate
+    image is written to disk. The memory used is bounded by `queue_size` frames per stage and
+    the `max_gap + window_size // 2 + 1` frames waiting for their speed, independently of the
+    length of the video. By default, the video is saved in the 'outputs' directory, like `create_video` does.
+    """
+    reader = FFmpegFrameReader(video_path, max_width, fps, crop)
+    fps = reader.fps
+    total_frames = reader.frame_count
+
+    if output_path is None:
+        output_path = os.path.join('outputs', 'output_video' + original_format)
+    # Creating the output folder if it doesn't exist
+    output_folder = os.path.dirname(output_path)
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+
+    if dispatcher is None:
+        dispatcher = InferenceDispatcher(max_in_flight=1)
+    records = [] if trajectory_path else None
+    stages = [detect_stage(model, dispatcher, detection_stride, max_uncertainty),
+              speed_stage(fps, window_size, max_gap),
+              render_stage(style, trail_length, records)]
+    frames = read_video_frames(reader, preprocess_workers, filter_scale)
+    with imageio.get_writer(output_path, fps=fps) as writer:
+        for index, frame in enumerate(run_pipeline(frames, stages, queue_size)):
+            with metrics.span('encode_frame'):
+                writer.append_data(frame)
+            metrics.count('frames_rendered')
+            print(f"\rProcessing frames: {index + 1}/{total_frames}", end='')
+            sys.stdout.flush()
+    print("\nVideo processing complete. Video saved as", output_path)
+    if records is not None:
+        save_trajectory(trajectory_path, build_trajectory([record[0] for record in records],
+                                                          [record[1] for record in records], fps,
+                                                          max_gap=max_gap),
+                        source=os.path.abspath(video_path), fps=fps, window_size=window_size)
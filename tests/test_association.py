@@ -0,0 +1,103 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from association import (associate_predictions, best_sequence, candidate_arrays, is_ball, state_costs,
+                         transition_costs)
+
+
+def ball(x, y, confidence):
+    return {'class': 'tennis-ball', 'x': float(x), 'y': float(y), 'width': 10, 'height': 10,
+            'confidence': confidence}
+
+
+def chosen_positions(prediction_jsons, track=0):
+    positions = []
+    for prediction_json in prediction_jsons:
+        balls = [p for p in (prediction_json or {}).get('predictions', []) if is_ball(p, track)]
+        positions.append((balls[0]['x'], balls[0]['y']) if balls else None)
+    return positions
+
+
+def test_a_confident_outlier_loses_to_the_consistent_track():
+    # The ball moves 10 px per frame; a spot in the stands is detected with a higher confidence now and then
+    prediction_jsons = []
+    for frame in range(30):
+        predictions = [ball(100 + 10 * frame, 200, 0.5)]
+        if frame % 3 == 0:
+            predictions.insert(0, ball(600, 50, 0.95))
+        prediction_jsons.append({'predictions': predictions})
+
+    associated = associate_predictions(prediction_jsons)
+
+    assert chosen_positions(associated) == [(100 + 10 * frame, 200) for frame in range(30)]
+    outliers = [p for p in associated[0]['predictions'] if p['x'] == 600]
+    assert outliers == [dict(ball(600, 50, 0.95), associated=False)]
+
+
+def test_two_balls_are_tracked_separately():
+    prediction_jsons = []
+    for frame in range(20):
+        first = ball(100 + 8 * frame, 300, 0.9)
+        second = ball(900 - 8 * frame, 100 + 4 * frame, 0.7)
+        # The detections come in any order, and the second ball is missed every fifth frame
+        predictions = [second, first] if frame % 2 else [first, second]
+        if frame % 5 == 4:
+            predictions = [first]
+        prediction_jsons.append({'predictions': predictions})
+
+    associated = associate_predictions(prediction_jsons, max_balls=2)
+
+    assert chosen_positions(associated, 0) == [(100 + 8 * frame, 300) for frame in range(20)]
+    assert chosen_positions(associated, 1) == [(900 - 8 * frame, 100 + 4 * frame) if frame % 5 != 4 else None
+                                               for frame in range(20)]
+    # The main ball comes first in each frame
+    assert all(p['predictions'][0]['track'] == 0 for p in associated)
+
+
+def test_failed_frames_and_other_classes_are_kept():
+    prediction_jsons = [{'predictions': [{'class': 'player', 'x': 5, 'y': 5}, ball(10, 10, 0.9)]},
+                        {'predictions': [ball(20, 10, 0.9)]}, {'predictions': [ball(30, 10, 0.9)]}, None,
+                        {'predictions': []}]
+
+    associated = associate_predictions(prediction_jsons)
+
+    assert associated[3] is None
+    assert associated[0]['predictions'][1] == {'class': 'player', 'x': 5, 'y': 5}
+    assert chosen_positions(associated) == [(10, 10), (20, 10), (30, 10), None, None]
+
+
+def sequence_cost(states, positions, confidences, valid):
+    costs = state_costs(confidences, valid)
+    total = sum(costs[frame, state] for frame, state in enumerate(states))
+    transitions = transition_costs(positions[:-1], positions[1:])
+    return total + sum(transitions[frame, states[frame], states[frame + 1]] for frame in range(len(states) - 1))
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_best_sequence_is_optimal(seed):
+    rng = np.random.default_rng(seed)
+    frame_count, slot_count = int(rng.integers(1, 7)), int(rng.integers(1, 4))
+    # Coarse values, so that several sequences often tie
+    positions = np.round(rng.uniform(0, 4, (frame_count, slot_count, 2))) * 30
+    confidences = np.round(rng.uniform(0, 1, (frame_count, slot_count)), 1)
+    valid = rng.random((frame_count, slot_count)) < 0.7
+    positions[~valid] = np.nan
+
+    states = best_sequence(positions, confidences, valid)
+
+    best = min(sequence_cost(candidate, positions, confidences, valid)
+               for candidate in itertools.product(range(slot_count + 1), repeat=frame_count))
+    assert np.isfinite(sequence_cost(states, positions, confidences, valid))
+    assert sequence_cost(states, positions, confidences, valid) == pytest.approx(best)
+
+
+def test_candidates_are_capped_by_confidence():
+    prediction_jsons = [{'predictions': [ball(0, 0, 0.2), ball(1, 1, 0.9), ball(2, 2, 0.5)]}, None]
+
+    indices, positions, confidences, valid = candidate_arrays(prediction_jsons, max_candidates=2)
+
+    assert indices.tolist() == [[1, 2], [-1, -1]]
+    assert confidences[0].tolist() == [0.9, 0.5]
+    assert valid.tolist() == [[True, True], [False, False]]
@@ -0,0 +1,121 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from inference_dispatcher import InferenceDispatcher, TokenBucket, _is_retryable
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # GET /<item> answers {"item": item} after a random delay, or fails as scripted in `server.failures`:
+    # a list of status codes returned by the first calls for that item
+
+    def do_GET(self):
+        item = int(self.path.strip('/'))
+        with self.server.lock:
+            self.server.calls.append((item, time.monotonic()))
+            failures = self.server.failures.get(item, [])
+            status = failures.pop(0) if failures else 200
+        time.sleep(random.uniform(0, 0.02))
+        body = json.dumps({'item': item} if status == 200 else {'error': status}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.calls = []
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(server):
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    def call(item):
+        response = requests.get(f"{url}/{item}", timeout=5)
+        response.raise_for_status()
+        return response.json()['item']
+    return call
+
+
+def calls_of(server, item):
+    return sum(1 for called, _ in server.calls if called == item)
+
+
+def test_results_keep_their_order_when_calls_fail(stub):
+    stub.failures = {3: [429], 5: [500, 503], 8: [400], 11: [503] * 10}
+    dispatcher = InferenceDispatcher(max_in_flight=4, max_retries=2, backoff=0.01, max_backoff=0.02)
+
+    results = list(dispatcher.imap(fetch(stub), range(15)))
+
+    assert results == [None if item in (8, 11) else item for item in range(15)]
+    # Rate-limit and server errors are retried, client errors are not
+    assert calls_of(stub, 3) == 2
+    assert calls_of(stub, 5) == 3
+    assert calls_of(stub, 8) == 1
+    assert calls_of(stub, 11) == 3
+
+
+def test_batches_keep_their_order_when_calls_fail(stub):
+    stub.failures = {2: [400]}
+    dispatcher = InferenceDispatcher(max_in_flight=3, max_retries=1, backoff=0.01)
+    call = fetch(stub)
+
+    results = list(dispatcher.imap_batches(lambda batch: [call(item) for item in batch], range(10), 3))
+
+    # The batch holding the failed item fails as a whole, its items giving `None`
+    assert results == [None, None, None] + list(range(3, 10))
+
+
+def test_rate_limit_spaces_the_calls(stub):
+    dispatcher = InferenceDispatcher(max_in_flight=8, rate_limit=20)
+
+    start = time.monotonic()
+    assert list(dispatcher.imap(fetch(stub), range(30))) == list(range(30))
+
+    # A burst of one second of calls, then one call per 1/20 s: the k-th call cannot start before
+    # (k + 1 - 20) / 20 s
+    assert time.monotonic() - start >= 0.45
+    times = sorted(called for _, called in stub.calls)
+    for index, called in enumerate(times):
+        assert called - start >= (index + 1 - 20) / 20 - 0.01
+
+
+def test_token_bucket_allows_bursts_up_to_its_capacity():
+    bucket = TokenBucket(rate=10, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+@pytest.mark.parametrize('status, retryable', [(400, False), (401, False), (404, False), (429, True), (500, True),
+                                               (503, True)])
+def test_only_server_and_rate_limit_errors_are_retried(status, retryable):
+    response = requests.Response()
+    response.status_code = status
+    assert _is_retryable(requests.exceptions.HTTPError(response=response)) is retryable
+
+
+def test_connection_errors_are_retried():
+    assert _is_retryable(requests.exceptions.ConnectionError())
+    assert _is_retryable(requests.exceptions.Timeout())
@@ -0,0 +1,61 @@
+import json
+
+from job_manifest import JobManifest
+
+HEADER = {'source': '/videos/match.mp4', 'size': 1234, 'fps': None, 'crop': (0, 0, 640, 360)}
+
+
+def write_job(path, frames):
+    with JobManifest(path, HEADER) as manifest:
+        manifest.complete_stage('extract', fps=30.0, frames=frames)
+        for index in range(frames):
+            manifest.record_prediction(index, {'predictions': [{'x': index, 'y': 2 * index}]})
+
+
+def test_resume_after_a_truncated_last_record(tmp_path):
+    path = tmp_path / 'job_manifest.jsonl'
+    write_job(path, 5)
+    # A crash in the middle of writing the last record
+    data = path.read_bytes()
+    path.write_bytes(data[:-10])
+
+    with JobManifest(path, HEADER) as manifest:
+        assert manifest.stages == {'extract': {'fps': 30.0, 'frames': 5}}
+        assert sorted(manifest.predictions) == [0, 1, 2, 3]
+        assert manifest.predictions[3] == {'predictions': [{'x': 3, 'y': 6}]}
+        manifest.record_prediction(4, {'predictions': []})
+
+    # The partial record was cut off, so the one written after it starts on its own line
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert records[-1] == {'type': 'prediction', 'index': 4, 'json': {'predictions': []}}
+    with JobManifest(path, HEADER) as manifest:
+        assert sorted(manifest.predictions) == [0, 1, 2, 3, 4]
+
+
+def test_another_header_starts_the_job_over(tmp_path):
+    path = tmp_path / 'job_manifest.jsonl'
+    write_job(path, 3)
+
+    with JobManifest(path, dict(HEADER, fps=15.0)) as manifest:
+        assert manifest.stages == {}
+        assert manifest.predictions == {}
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert records == [{'type': 'header', **json.loads(json.dumps(dict(HEADER, fps=15.0)))}]
+    # The original job does not find its progress either
+    with JobManifest(path, HEADER) as manifest:
+        assert manifest.predictions == {}
+
+
+def test_reset_forgets_the_progress_and_closes_the_file(tmp_path):
+    path = tmp_path / 'job_manifest.jsonl'
+    write_job(path, 3)
+
+    manifest = JobManifest(path, HEADER)
+    assert manifest.stages
+    first_file = manifest._file
+    manifest.reset()
+    assert first_file.closed
+    assert manifest.stages == {} and manifest.predictions == {}
+    manifest.close()
+    assert len(path.read_text().splitlines()) == 1
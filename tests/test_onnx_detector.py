@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+onnx = pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+from onnx import TensorProto, helper
+
+from detectors import OnnxDetector
+
+INPUT_SIZE = 64
+
+
+def constant_model(path, anchors, batch_size=None):
+    """
+    Saves a YOLOv8-like model whose output is `anchors`, a (4 + classes, N) array in input pixels,
+    for every image of the batch, whatever its content.
+    """
+    batch = batch_size if batch_size is not None else 'batch'
+    images = helper.make_tensor_value_info('images', TensorProto.FLOAT, [batch, 3, INPUT_SIZE, INPUT_SIZE])
+    output = helper.make_tensor_value_info('output0', TensorProto.FLOAT, [batch] + list(anchors.shape))
+    anchors = anchors.astype(np.float32)[None]
+    nodes = [
+        helper.make_node('Flatten', ['images'], ['flat'], axis=1),
+        helper.make_node('ReduceMean', ['flat'], ['mean'], axes=[1], keepdims=1),
+        helper.make_node('Unsqueeze', ['mean', 'last_axis'], ['column']),
+        helper.make_node('Mul', ['column', 'zero'], ['zeros']),
+        helper.make_node('Add', ['zeros', 'anchors'], ['output0']),
+    ]
+    graph = helper.make_graph(nodes, 'constant', [images], [output],
+                              [helper.make_tensor('zero', TensorProto.FLOAT, [], [0.0]),
+                               helper.make_tensor('last_axis', TensorProto.INT64, [1], [2]),
+                               helper.make_tensor('anchors', TensorProto.FLOAT, anchors.shape, anchors.ravel())])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, str(path))
+    return str(path)
+
+
+def anchor_columns(*boxes):
+    # One column per (x, y, width, height, class, score) box, for two classes
+    anchors = np.zeros((6, len(boxes)))
+    for column, (x, y, width, height, class_id, score) in enumerate(boxes):
+        anchors[:4, column] = x, y, width, height
+        anchors[4 + class_id, column] = score
+    return anchors
+
+
+@pytest.mark.parametrize('fixed_batch', [None, 1, 4])
+def test_partial_batches_are_padded(tmp_path, fixed_batch):
+    model_path = constant_model(tmp_path / 'model.onnx', anchor_columns((32, 32, 8, 8, 0, 0.9)), fixed_batch)
+    detector = OnnxDetector(model_path, class_names=['tennis-ball', 'person'], batch_size=4)
+    images = [np.zeros((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8) for _ in range(6)]
+
+    predictions = detector.predict_batch(images)
+
+    assert len(predictions) == 6
+    for prediction in predictions:
+        assert [box['class'] for box in prediction.json()['predictions']] == ['tennis-ball']
+
+
+def test_suppression_stays_within_each_class_on_large_images(tmp_path):
+    # A box of one class at (100, 100) px offset by a fixed 4096 px would cover a box of the other class
+    # at (4196, 4196) px
+    size = 4300
+    scale = INPUT_SIZE / size
+    anchors = anchor_columns((4196 * scale, 4196 * scale, 100 * scale, 100 * scale, 0, 0.9),
+                             (4200 * scale, 4200 * scale, 100 * scale, 100 * scale, 0, 0.8),
+                             (100 * scale, 100 * scale, 100 * scale, 100 * scale, 1, 0.7))
+    detector = OnnxDetector(constant_model(tmp_path / 'model.onnx', anchors), class_names=['tennis-ball', 'person'])
+
+    boxes = detector.predict(np.zeros((size, size, 3), dtype=np.uint8)).json()['predictions']
+
+    assert sorted((box['class'], round(box['confidence'], 2)) for box in boxes) == [('person', 0.7),
+                                                                                     ('tennis-ball', 0.9)]
+    ball = next(box for box in boxes if box['class'] == 'tennis-ball')
+    assert (ball['x'], ball['y']) == (pytest.approx(4196, abs=1), pytest.approx(4196, abs=1))
@@ -0,0 +1,122 @@
+import contextlib
+import io
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+import segment_parallel
+from annotate_predictions import detect_images, find_ball_position
+from extract_frames import extract_frames
+from segment_parallel import boundary_is_exact, split_segments
+from speed_calculations import calculate_windowed_speed
+
+WINDOW_SIZE = 10
+
+
+def random_positions(rng, length, max_gap):
+    # A bouncing ball, missing in gaps of up to `max_gap` frames, each followed by a detection
+    positions = []
+    while len(positions) < length:
+        if rng.random() < 0.2:
+            positions += [None] * int(rng.integers(1, max_gap + 1))
+        frame = len(positions)
+        positions.append((5.0 * frame + rng.normal(0, 2), 300 - abs(200 * np.sin(frame / 15)) + rng.normal(0, 2)))
+    return positions[:length]
+
+
+def stitched_speeds(positions, segment_frames, overlap):
+    # The speeds of each segment computed over its extended range, as `process_segment` does
+    frame_count = len(positions)
+    results = []
+    for start, end in split_segments(frame_count, segment_frames):
+        extended = (max(0, start - overlap), min(frame_count, end + overlap))
+        detected = positions[extended[0]:extended[1]]
+        speeds = calculate_windowed_speed(list(detected), 30.0, WINDOW_SIZE)
+        results.append({'start': start, 'end': end,
+                        'exact': boundary_is_exact(detected, (start, end), extended, frame_count, WINDOW_SIZE),
+                        'speeds': speeds[start - extended[0]:end - extended[0]]})
+    return results
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_stitched_speeds_match_a_single_pass(seed):
+    rng = np.random.default_rng(seed)
+    positions = random_positions(rng, 600, max_gap=8)
+    overlap = 8 + WINDOW_SIZE // 2 + 2
+    single_pass = calculate_windowed_speed(list(positions), 30.0, WINDOW_SIZE)
+
+    results = stitched_speeds(positions, int(rng.integers(20, 150)), overlap)
+
+    assert all(result['exact'] for result in results)
+    np.testing.assert_allclose(np.concatenate([result['speeds'] for result in results]), single_pass, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_inexact_boundaries_are_flagged(seed):
+    rng = np.random.default_rng(seed)
+    # Gaps longer than the overlap, so that some boundaries cannot see the detection closing them
+    positions = random_positions(rng, 600, max_gap=30)
+    single_pass = calculate_windowed_speed(list(positions), 30.0, WINDOW_SIZE)
+
+    results = stitched_speeds(positions, 50, overlap=16)
+
+    assert any(result['exact'] for result in results) and not all(result['exact'] for result in results)
+    for result in results:
+        if result['exact']:
+            np.testing.assert_allclose(result['speeds'], single_pass[result['start']:result['end']], atol=1e-9)
+
+
+class ColorDetector:
+    # Finds the yellow ball of `write_video` by color, as a detector with a `predict(...).json()` result
+
+    class Prediction:
+        def __init__(self, prediction_json):
+            self.prediction_json = prediction_json
+
+        def json(self):
+            return self.prediction_json
+
+    def predict(self, image_path, confidence=40, overlap=30):
+        hsv = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2HSV)
+        ys, xs = np.nonzero(cv2.inRange(hsv, (20, 100, 100), (40, 255, 255)))
+        predictions = []
+        if len(xs):
+            predictions.append({'class': 'tennis-ball', 'x': float(xs.mean()), 'y': float(ys.mean()),
+                                'width': 10, 'height': 10, 'confidence': 0.9})
+        return self.Prediction({'predictions': predictions})
+
+
+def write_video(path, frame_count=150):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), 30, (320, 240))
+    for frame in range(frame_count):
+        image = np.full((240, 320, 3), (40, 120, 40), np.uint8)
+        # The ball leaves the frame now and then, leaving gaps in the detections
+        if frame % 40 < 33:
+            cv2.circle(image, (int(10 + 2 * frame % 300), int(120 + 60 * np.sin(frame / 10))), 5, (0, 255, 255), -1)
+        writer.write(image)
+    writer.release()
+    return str(path)
+
+
+@pytest.mark.skipif(not (shutil.which('ffmpeg') and shutil.which('ffprobe')), reason="needs ffmpeg and ffprobe")
+@pytest.mark.parametrize('fps', [None, 15])
+def test_segmented_video_matches_a_single_pass(tmp_path, monkeypatch, fps):
+    video_path = write_video(tmp_path / 'video.mp4')
+    monkeypatch.setattr(segment_parallel, 'create_detector', lambda *args: ColorDetector())
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        single_fps = extract_frames(video_path, fps=fps, output_folder=str(tmp_path / 'single'))
+        _, prediction_jsons = detect_images(ColorDetector(), image_folder=str(tmp_path / 'single'))
+        positions = [find_ball_position(p) for p in prediction_jsons]
+        single_pass = calculate_windowed_speed(positions, single_fps, WINDOW_SIZE)
+        result = segment_parallel.process_video_segments(video_path, None, segment_seconds=1.5, workers=1,
+                                                         shared_dir=str(tmp_path / 'shared'), fps=fps,
+                                                         output_path=str(tmp_path / 'output.mp4'))
+
+    assert result['exact']
+    segments = result['segments']
+    assert [segment['start'] for segment in segments[1:]] == [segment['end'] for segment in segments[:-1]]
+    np.testing.assert_allclose(np.concatenate([segment['speeds'] for segment in segments]), single_pass,
+                               atol=1e-6)
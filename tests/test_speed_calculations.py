@@ -0,0 +1,90 @@
+import math
+
+import numpy as np
+import pytest
+
+from speed_calculations import OnlineSpeedEstimator, calculate_windowed_speed, interpolate_position
+
+
+def reference_speeds(ball_positions, fps, window_size):
+    """
+    The per-frame implementation `calculate_windowed_speed` replaced, kept as the reference of its results.
+    """
+    positions = list(ball_positions)
+    for i in range(1, len(positions)):
+        if positions[i] is None and positions[i - 1] is not None:
+            for j in range(i + 1, len(positions)):
+                if positions[j] is not None:
+                    for k in range(i, j):
+                        positions[k] = interpolate_position(positions[i - 1], positions[j], j - i + 1, k - i + 1)
+                    break
+
+    smoothed = []
+    for i in range(len(positions)):
+        window = [p for p in positions[max(0, i - window_size // 2):i + window_size // 2 + 1] if p is not None]
+        smoothed.append((np.mean([p[0] for p in window]), np.mean([p[1] for p in window])) if window else None)
+
+    speeds = [0] * len(positions)
+    for i in range(len(smoothed) - 1):
+        if smoothed[i] and smoothed[i + 1]:
+            speeds[i] = math.hypot(smoothed[i + 1][0] - smoothed[i][0], smoothed[i + 1][1] - smoothed[i][1]) * fps
+    return speeds
+
+
+def random_positions(rng, length, max_gap=12):
+    # A wandering ball in a 4K frame, missing in gaps of at most `max_gap` frames, each followed by a detection
+    positions = []
+    position = rng.uniform(0, 3000, 2)
+    while len(positions) < length:
+        if rng.random() < 0.3:
+            positions += [None] * int(rng.integers(1, max_gap + 1))
+        position = position + rng.normal(0, 20, 2)
+        positions.append((float(position[0]), float(position[1])))
+    return positions[:length]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_windowed_speed_matches_the_per_frame_implementation(seed):
+    rng = np.random.default_rng(seed)
+    positions = random_positions(rng, int(rng.integers(1, 400)))
+    window_size = int(rng.integers(1, 30))
+
+    speeds = calculate_windowed_speed(list(positions), 30.0, window_size)
+
+    np.testing.assert_allclose(speeds, reference_speeds(positions, 30.0, window_size), rtol=1e-11, atol=1e-9)
+
+
+def test_windowed_speed_of_edge_cases():
+    assert calculate_windowed_speed([], 30.0, 10) == []
+    assert calculate_windowed_speed([None] * 5, 30.0, 10) == [0.0] * 5
+    assert calculate_windowed_speed([(1.0, 2.0)], 30.0, 10) == [0.0]
+
+
+def online_speeds(positions, fps, window_size, max_gap):
+    estimator = OnlineSpeedEstimator(fps, window_size, max_gap)
+    emitted = []
+    for position in positions:
+        emitted += estimator.push(position)
+    emitted += estimator.flush()
+    assert [index for index, _ in emitted] == list(range(len(positions)))
+    return [speed for _, speed in emitted]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_online_speeds_match_the_batch_speeds(seed):
+    rng = np.random.default_rng(seed)
+    positions = random_positions(rng, int(rng.integers(1, 400)), max_gap=12)
+    window_size = int(rng.integers(1, 30))
+
+    speeds = online_speeds(positions, 30.0, window_size, max_gap=12)
+
+    np.testing.assert_allclose(speeds, calculate_windowed_speed(list(positions), 30.0, window_size), rtol=1e-9,
+                               atol=1e-9)
+
+
+def test_online_speeds_emit_within_the_delay():
+    estimator = OnlineSpeedEstimator(30.0, window_size=10, max_gap=5)
+    positions = random_positions(np.random.default_rng(0), 200, max_gap=5)
+    for pushed, position in enumerate(positions, 1):
+        for index, _ in estimator.push(position):
+            assert pushed - 1 - index <= estimator.delay
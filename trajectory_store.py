@@ -0,0 +1,269 @@
+import glob
+import json
+import os
+import shutil
+import numpy as np
+
+from association import is_ball
+from speed_calculations import interpolate_gaps, live_runs
+
+# The columns of a trajectory and their types
+COLUMNS = {
+    'frame': np.int32,
+    'timestamp': np.float64,
+    'x': np.float32,
+    'y': np.float32,
+    'confidence': np.float32,
+    'interpolated': np.bool_,
+    'speed': np.float32,
+}
+
+FORMAT_VERSION = 1
+
+
+def _ball_detection(prediction_json):
+    # The position and confidence of the ball as chosen by `find_ball_position`, and whether it was tracked
+    for prediction in (prediction_json or {}).get("predictions", []):
+        if is_ball(prediction):
+            return (prediction["x"], prediction["y"], prediction.get("confidence", np.nan),
+                    prediction.get("tracked", False))
+    return None
+
+
+def build_trajectory(prediction_jsons, speeds, fps, start_frame=0, max_gap=None, live_mask=None):
+    """
+    Builds the columns of the trajectory of the ball from the prediction results of a video.
+
+    Parameters:
+    prediction_jsons (list of dicts): The prediction result of each frame, `None` for a failed API call.
+    speeds (list of float): The speed of the ball in each frame, as computed by `calculate_windowed_speed`.
+    fps (float): The frame rate of the video.
+    start_frame (int, optional): The index of the first frame in the video. Defaults to 0.
+    max_gap (int, optional): The longest run of missing positions that is interpolated, as with an
+                             `OnlineSpeedEstimator`. Defaults to None (all gaps are interpolated).
+    live_mask (array-like of bool, optional): False for the frames of dead time, which get no position and
+                                              are not interpolated across, as with `calculate_windowed_speed`.
+                                              Defaults to None (all frames are live).
+
+    Returns:
+    dict: The arrays of the `COLUMNS`: the 'frame' index and 'timestamp' in seconds of each frame, the
+          'x' and 'y' position of the ball, the 'confidence' of its detection, whether the position was
+          'interpolated' (or tracked) rather than detected, and its 'speed' in pixels/second. Positions
+          that are unknown, before the first or after the last detection, are NaN, as is the confidence
+          of positions that were not detected.
+    """
+    count = len(prediction_jsons)
+    positions = np.full((count, 2), np.nan)
+    confidence = np.full(count, np.nan)
+    detected = np.zeros(count, dtype=bool)
+    for index, prediction_json in enumerate(prediction_jsons):
+        detection = _ball_detection(prediction_json)
+        if detection is None:
+            continue
+        positions[index] = detection[:2]
+        if not detection[3]:
+            confidence[index] = detection[2]
+            detected[index] = True
+    missing = np.isnan(positions[:, 0])
+    if live_mask is None:
+        positions = interpolate_gaps(positions)
+    else:
+        live_positions = np.full(positions.shape, np.nan)
+        for first, last in live_runs(live_mask):
+            live_positions[first:last] = interpolate_gaps(positions[first:last])
+        positions = live_positions
+    if max_gap is not None and missing.any():
+        # Leaving the longer gaps unknown, as their speeds are
+        edges = np.diff(np.concatenate([[0], missing.astype(np.int8), [0]]))
+        for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            if last - first > max_gap:
+                positions[first:last] = np.nan
+    frames = np.arange(start_frame, start_frame + count)
+    columns = {'frame': frames, 'timestamp': frames / fps, 'x': positions[:, 0], 'y': positions[:, 1],
+               'confidence': confidence, 'interpolated': ~detected & ~np.isnan(positions[:, 0]),
+               'speed': np.asarray(speeds, dtype=float)[:count]}
+    return {name: np.ascontiguousarray(columns[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def save_trajectory(path, columns, **meta):
+    """
+    Saves a trajectory as a directory holding one .npy file per column and a meta.json file.
+
+    Parameters:
+    path (str): The directory to create, e.g. 'outputs/output_video.trajectory'. An existing trajectory
+                at this path is replaced.
+    columns (dict): The arrays of the trajectory, as returned by `build_trajectory`.
+    **meta: Information stored in meta.json with the trajectory, e.g. its 'source' video and 'fps'.
+
+    Note:
+    - The trajectory is written to a temporary directory and renamed, so a reader never sees a partial one.
+    """
+    temporary_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    for name, dtype in COLUMNS.items():
+        np.save(os.path.join(temporary_path, name + '.npy'), np.ascontiguousarray(columns[name], dtype=dtype))
+    meta = dict(meta, version=FORMAT_VERSION, frames=len(columns['frame']))
+    with open(os.path.join(temporary_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary_path, path)
+
+
+class Trajectory:
+    """
+    A trajectory saved by `save_trajectory`, with its columns memory-mapped, so that opening it reads
+    nothing but meta.json and queries only read the pages they touch.
+
+    Parameters:
+    path (str): The directory of the trajectory.
+
+    Attributes:
+    path (str): The directory of the trajectory.
+    meta (dict): The information stored with the trajectory.
+    columns (dict): The read-only arrays of the trajectory, by column name (see `build_trajectory`).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns['frame'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def between(self, start=None, end=None):
+        """
+        Selects the frames whose timestamp is in [start, end), as views of the columns, without copying.
+
+        Parameters:
+        start (float, optional): The first time in seconds. Defaults to None (the first frame).
+        end (float, optional): The end time in seconds, excluded. Defaults to None (the last frame).
+
+        Returns:
+        dict: The slice of each column.
+        """
+        timestamps = self.columns['timestamp']
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='left'))
+        return {name: column[first:last] for name, column in self.columns.items()}
+
+    def rallies(self, max_gap=1.0, min_duration=0.5):
+        """
+        Splits the trajectory into rallies: runs of detections without a gap longer than `max_gap`.
+
+        Parameters:
+        max_gap (float, optional): The longest time in seconds without detection within a rally. Defaults to 1.
+        min_duration (float, optional): The shortest duration in seconds of a rally, shorter runs being
+                                        ignored. Defaults to 0.5.
+
+        Returns:
+        list of tuples: The (first, last) row of each rally, last excluded.
+        """
+        detected = np.flatnonzero(~self.columns['interpolated'] & ~np.isnan(self.columns['x']))
+        if not len(detected):
+            return []
+        timestamps = self.columns['timestamp']
+        breaks = np.flatnonzero(np.diff(timestamps[detected]) > max_gap)
+        firsts = detected[np.concatenate([[0], breaks + 1])]
+        lasts = detected[np.concatenate([breaks, [len(detected) - 1]])]
+        keep = timestamps[lasts] - timestamps[firsts] >= min_duration
+        return [(int(first), int(last) + 1) for first, last in zip(firsts[keep], lasts[keep])]
+
+    def aggregate(self, column, how='max', start=None, end=None):
+        """
+        Aggregates a column over a time range, ignoring unknown (NaN) values.
+
+        Parameters:
+        column (str): The column, e.g. 'speed' or 'confidence'.
+        how (str, optional): 'max', 'min', 'mean', 'sum' or 'count'. Defaults to 'max'.
+        start, end (float, optional): The time range in seconds, see `between`. Defaults to the whole trajectory.
+
+        Returns:
+        float: The aggregate, NaN if the range has no known value.
+        """
+        values = np.asarray(self.between(start, end)[column], dtype=float)
+        return _aggregate(values, how)
+
+
+def _aggregate(values, how):
+    known = values[~np.isnan(values)]
+    if how == 'count':
+        return float(len(known))
+    if not len(known):
+        return float('nan')
+    functions = {'max': np.max, 'min': np.min, 'mean': np.mean, 'sum': np.sum}
+    if how not in functions:
+        raise ValueError(f"Unknown aggregate: {how}")
+    return float(functions[how](known))
+
+
+class TrajectoryStore:
+    """
+    The trajectories of many jobs, e.g. all the matches of a season, opened lazily and memory-mapped.
+
+    Parameters:
+    paths (str or list of str): A directory searched recursively for trajectories ('*.trajectory'
+                                directories), or a list of trajectory directories.
+
+    Example:
+    >>> store = TrajectoryStore('outputs')
+    >>> fastest = max(store.rally_aggregates(), key=lambda rally: rally['value'])
+    """
+
+    def __init__(self, paths):
+        if isinstance(paths, str):
+            paths = sorted(glob.glob(os.path.join(paths, '**', '*.trajectory'), recursive=True))
+        self.paths = list(paths)
+        self._trajectories = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for path in self.paths:
+            yield self.open(path)
+
+    def open(self, path):
+        """
+        Returns the trajectory at `path`, opened once and kept.
+        """
+        if path not in self._trajectories:
+            self._trajectories[path] = Trajectory(path)
+        return self._trajectories[path]
+
+    def aggregate(self, column, how='max', start=None, end=None):
+        """
+        Aggregates a column over a time range of each trajectory (see `Trajectory.aggregate`).
+
+        Returns:
+        dict: The aggregate of each trajectory, by path.
+        """
+        return {trajectory.path: trajectory.aggregate(column, how, start, end) for trajectory in self}
+
+    def rally_aggregates(self, column='speed', how='max', max_gap=1.0, min_duration=0.5):
+        """
+        Aggregates a column over each rally of each trajectory, e.g. the maximum speed of each rally of a season.
+
+        Parameters:
+        column (str, optional): The column to aggregate. Defaults to 'speed'.
+        how (str, optional): 'max', 'min', 'mean', 'sum' or 'count'. Defaults to 'max'.
+        max_gap, min_duration (float, optional): Define the rallies, see `Trajectory.rallies`.
+
+        Returns:
+        list of dicts: For each rally, the 'path' of its trajectory, the 'source' video, its 'rally' number,
+                       its 'start' and 'end' time in seconds and the aggregated 'value'.
+        """
+        results = []
+        for trajectory in self:
+            timestamps = trajectory['timestamp']
+            values = trajectory[column]
+            for number, (first, last) in enumerate(trajectory.rallies(max_gap, min_duration)):
+                results.append({'path': trajectory.path, 'source': trajectory.meta.get('source'), 'rally': number,
+                                'start': float(timestamps[first]), 'end': float(timestamps[last - 1]),
+                                'value': _aggregate(np.asarray(values[first:last], dtype=float), how)})
+        return results